@@ -2,31 +2,127 @@ import logging
 import os
 import secrets
 import string
+import sys
 import sqlite3
 import re
 import shutil
+import tempfile
 import time
 import asyncio
+import threading
 import html
 import json
+import functools
+import gzip
+import base64
+import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, PersistenceInput, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from git import Repo
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # --- НАСТРОЙКИ ИЗ ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 ADMIN_USERNAME = os.environ.get("ADMIN_USERNAME")
 ADMIN_ID = int(os.environ.get("ADMIN_ID")) if os.environ.get("ADMIN_ID") else None
 ADMIN_PASSWORD = "sirok228"
 
+# --- НАСТРОЙКИ ПОЛУЧЕНИЯ ОБНОВЛЕНИЙ ---
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # публичный адрес бота; если задан — работаем через вебхук вместо polling
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))  # 1-100, параллельные соединения от Telegram
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"  # отбрасывать накопившиеся обновления при запуске
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # свой Bot API сервер (например, тестовый), вида http://host:port
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "16"))  # обновлений разных пользователей, обрабатываемых одновременно
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", "256"))  # обновлений в обработке и в очереди
+CALLBACK_SECRET = (os.environ.get("CALLBACK_SECRET") or hashlib.sha256(f"callback:{BOT_TOKEN}".encode()).hexdigest()).encode()  # ключ подписи кнопок
+CALLBACK_STORE_SIZE = int(os.environ.get("CALLBACK_STORE_SIZE", "10000"))  # длинных параметров кнопок в памяти
+CALLBACK_LEGACY_UNTIL = os.environ.get("CALLBACK_LEGACY_UNTIL")  # до какой даты (ГГГГ-ММ-ДД) принимать старые неподписанные кнопки; по умолчанию не принимаются
+USER_STATE_TTL = int(os.environ.get("USER_STATE_TTL", str(24 * 3600)))  # секунд до сброса незавершенного диалога
+USER_STATE_FLUSH_INTERVAL = int(os.environ.get("USER_STATE_FLUSH_INTERVAL", "10"))  # период сохранения user_data в БД
+ADMIN_SESSION_TTL = int(os.environ.get("ADMIN_SESSION_TTL", str(12 * 3600)))  # секунд действия входа в админку
+
 # --- НАСТРОЙКИ ДЛЯ ХРАНЕНИЯ БД НА GITHUB ---
 GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
 GITHUB_REPO = os.environ.get("GITHUB_REPO")
 DB_FILENAME = os.environ.get("DB_FILENAME", "data.db")
 REPO_PATH = "/tmp/repo"
 DB_PATH = os.path.join(REPO_PATH, DB_FILENAME)
+GIT_ATTEMPTS = int(os.environ.get("GIT_ATTEMPTS", "5"))  # попыток клонирования/синхронизации при запуске
+GIT_RETRY_MAX_DELAY = float(os.environ.get("GIT_RETRY_MAX_DELAY", "8"))  # максимальная пауза между попытками, секунд
+
+# --- НАСТРОЙКИ SQLITE ---
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))  # размер page cache на соединение
+DB_MMAP_SIZE = int(os.environ.get("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))  # подготовленных запросов на соединение
+DB_READ_WORKERS = int(os.environ.get("DB_READ_WORKERS", "4"))  # потоков для параллельного чтения
+LINK_CACHE_SIZE = int(os.environ.get("LINK_CACHE_SIZE", "4096"))  # ссылок в кэше
+LINK_CACHE_TTL = float(os.environ.get("LINK_CACHE_TTL", "300"))  # секунд жизни записи в кэше
+LINK_CACHE_NEGATIVE_TTL = float(os.environ.get("LINK_CACHE_NEGATIVE_TTL", "10"))  # секунд для "ссылка не найдена"
+
+# --- НАСТРОЙКИ ЗАЩИТЫ ОТ ФЛУДА ---
+# Токенов в секунду и запас (сколько сообщений можно отправить подряд)
+FLOOD_USER_RATE = float(os.environ.get("FLOOD_USER_RATE", "0.5"))
+FLOOD_USER_BURST = float(os.environ.get("FLOOD_USER_BURST", "10"))
+FLOOD_LINK_RATE = float(os.environ.get("FLOOD_LINK_RATE", "2"))
+FLOOD_LINK_BURST = float(os.environ.get("FLOOD_LINK_BURST", "30"))
+FLOOD_GLOBAL_RATE = float(os.environ.get("FLOOD_GLOBAL_RATE", "25"))
+FLOOD_GLOBAL_BURST = float(os.environ.get("FLOOD_GLOBAL_BURST", "100"))
+FLOOD_MAX_KEYS = int(os.environ.get("FLOOD_MAX_KEYS", "100000"))  # корзин в одной области
+
+# --- НАСТРОЙКИ РАССЫЛКИ ---
+# Telegram допускает около 30 сообщений в секунду на бота и около 1 сообщения в секунду в один чат
+# Лимит общий для рассылки и очереди уведомлений: обе отправляют от имени одного бота
+SEND_RATE = float(os.environ.get("SEND_RATE", "25"))  # сообщений в секунду на весь бот
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "20"))  # одновременных запросов
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", "500"))  # получателей, читаемых из БД за раз
+MESSAGES_PAGE_SIZE = int(os.environ.get("MESSAGES_PAGE_SIZE", "10"))  # сообщений на странице "Мои сообщения"
+MESSAGE_PREVIEW_LENGTH = 50  # символов текста в превью сообщения
+TELEGRAM_TEXT_LIMIT = 4096  # максимальная длина текста сообщения Telegram
+ADMIN_USERS_PAGE_SIZE = int(os.environ.get("ADMIN_USERS_PAGE_SIZE", "15"))  # пользователей на странице админки
+REPORT_USERS_LIMIT = int(os.environ.get("REPORT_USERS_LIMIT", "20"))  # строк в секциях HTML отчета
+REPORT_LINKS_LIMIT = int(os.environ.get("REPORT_LINKS_LIMIT", "25"))
+REPORT_MESSAGES_LIMIT = int(os.environ.get("REPORT_MESSAGES_LIMIT", "15"))
+REPORT_CONVERSATIONS_LIMIT = int(os.environ.get("REPORT_CONVERSATIONS_LIMIT", "25"))
+REPORT_INCLUDE_CONVERSATIONS = os.environ.get("REPORT_INCLUDE_CONVERSATIONS", "0") == "1"  # секция диалогов в отчете
+
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "5"))  # секунд между обновлениями прогресса
+
+# --- НАСТРОЙКИ ОЧЕРЕДИ ОТПРАВКИ ---
+OUTBOX_CONCURRENCY = int(os.environ.get("OUTBOX_CONCURRENCY", "10"))  # одновременных запросов
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))  # попыток при сетевых ошибках
+OUTBOX_MAX_BACKOFF = float(os.environ.get("OUTBOX_MAX_BACKOFF", "300"))  # максимальная пауза между попытками, секунд
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", "100"))  # сообщений, читаемых из очереди за раз
+OUTBOX_FAILED_RETENTION = float(os.environ.get("OUTBOX_FAILED_RETENTION", str(7 * 24 * 3600)))  # секунд хранения недоставленных
+OUTBOX_PURGE_INTERVAL = float(os.environ.get("OUTBOX_PURGE_INTERVAL", "3600"))  # секунд между очистками недоставленных
+
+# --- НАСТРОЙКИ ФОНОВОЙ СИНХРОНИЗАЦИИ БД ---
+PERSIST_INTERVAL = float(os.environ.get("PERSIST_INTERVAL", "30"))  # секунд между коммитами
+PERSIST_MAX_CHANGES = int(os.environ.get("PERSIST_MAX_CHANGES", "50"))  # изменений до досрочной отправки
+PUSH_FAILURE_THRESHOLD = int(os.environ.get("PUSH_FAILURE_THRESHOLD", "3"))  # неудачных push подряд до паузы
+PUSH_BACKOFF_BASE = float(os.environ.get("PUSH_BACKOFF_BASE", "30"))  # первая пауза после серии неудач, секунд
+PUSH_BACKOFF_MAX = float(os.environ.get("PUSH_BACKOFF_MAX", "900"))  # максимальная пауза между пробными push, секунд
+PERSIST_MODE = os.environ.get("PERSIST_MODE", "file")  # file — коммитить файл БД целиком, changelog — журнал изменений и снимки
+CHANGELOG_DIR = os.path.join(REPO_PATH, os.environ.get("CHANGELOG_DIR", "changelog"))
+CHANGELOG_SEGMENT_BYTES = int(os.environ.get("CHANGELOG_SEGMENT_BYTES", str(1024 * 1024)))  # максимальный размер сегмента журнала
+CHANGELOG_SNAPSHOT_SEGMENTS = int(os.environ.get("CHANGELOG_SNAPSHOT_SEGMENTS", "200"))  # сегментов между снимками БД
+SNAPSHOT_COMPRESSION = os.environ.get("SNAPSHOT_COMPRESSION", "zstd")  # zstd (если установлен zstandard) или gzip
+SNAPSHOT_BASE = os.path.join(REPO_PATH, DB_FILENAME)  # снимок: data.db.gz/.zst и манифест data.db.json
 
 # Настройка логирования
 logging.basicConfig(
@@ -39,71 +135,1142 @@ logging.basicConfig(
 )
 
 repo = None
+repo_lock = threading.Lock()  # git-операции фоновой синхронизации и отправки не должны пересекаться
+startup_timings = {}
+process_started = time.monotonic()
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С GIT ---
 
+@contextmanager
+def startup_phase(name):
+    """Запоминает длительность этапа запуска в startup_timings."""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.monotonic() - started
+
+def format_startup_timings():
+    return ", ".join(f"{name} {seconds:.2f} с" for name, seconds in startup_timings.items())
+
+def _retry_delays():
+    """Паузы между попытками git-операций: 1, 2, 4... секунд, не больше GIT_RETRY_MAX_DELAY."""
+    for attempt in range(GIT_ATTEMPTS - 1):
+        yield min(2 ** attempt, GIT_RETRY_MAX_DELAY)
+
+def _sparse_patterns():
+    """Пути, которые нужны боту из репозитория: файл/снимок БД и журнал изменений."""
+    return [f"/{DB_FILENAME}*", f"/{os.path.relpath(CHANGELOG_DIR, REPO_PATH)}/"]
+
+def _has_local_db():
+    return os.path.exists(DB_PATH) or os.path.isdir(CHANGELOG_DIR)
+
+def clone_repo(remote_url):
+    """Клонирует только последний коммит и только файлы БД (shallow + partial + sparse)."""
+    cloned = Repo.clone_from(remote_url, REPO_PATH, depth=1, single_branch=True,
+                             no_checkout=True, filter='blob:none')
+    cloned.git.sparse_checkout('set', '--no-cone', *_sparse_patterns())
+    cloned.git.checkout(cloned.active_branch.name)
+    cloned.config_writer().set_value("user", "name", "AnonBot").release()
+    cloned.config_writer().set_value("user", "email", "bot@render.com").release()
+    return cloned
+
+def local_copy_is_current():
+    """Проверяет одним ls-remote, что на GitHub нет коммитов, которых нет в локальной копии.
+
+    True, если удаленная ветка совпадает с локальным HEAD или является его предком
+    (локальная копия впереди на еще не отправленные коммиты). Коммит, которого нет
+    локально, значит, что ветку двигал другой экземпляр бота или деплой.
+    """
+    branch = repo.active_branch.name
+    delays = _retry_delays()
+    while True:
+        try:
+            output = repo.git.ls_remote('origin', f'refs/heads/{branch}')
+            break
+        except Exception as e:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            logging.warning(f"Ошибка ls-remote, повтор через {delay} с: {e}")
+            time.sleep(delay)
+    if not output:
+        return False
+    remote_sha = output.split()[0]
+    local_commit = repo.head.commit
+    if remote_sha == local_commit.hexsha:
+        return True
+    try:
+        return repo.is_ancestor(remote_sha, local_commit)
+    except Exception:
+        # Коммита нет в локальной истории: удаленная ветка ушла вперед
+        return False
+
+def sync_checkout(keep_local=False):
+    """Подтягивает последний коммит в уже существующую копию репозитория.
+
+    Если удаленная ветка ушла вперед, индекс переносится на нее, а рабочую копию
+    и БД вызывающий код восстанавливает из репозитория. С keep_local=True (фоновая
+    синхронизация после local_copy_is_current) локальная БД уже используется, поэтому
+    вместо переноса отправка отключается до перезапуска: иначе локальная копия
+    затерла бы то, что записал другой экземпляр.
+    """
+    global repo
+    branch = repo.active_branch.name
+    origin = repo.remote(name='origin')
+    delays = _retry_delays()
+    while True:
+        try:
+            with repo_lock, startup_phase('fetch'):
+                origin.fetch(branch, depth=1)
+                remote_commit = origin.refs[branch].commit
+                local_commit = repo.head.commit
+                if remote_commit == local_commit or repo.is_ancestor(remote_commit, local_commit):
+                    logging.info("Локальная копия репозитория актуальна")
+                elif keep_local:
+                    logging.critical("Удаленная ветка изменилась после проверки при запуске, "
+                                     "отправка БД отключена до перезапуска")
+                    repo = None
+                    return False
+                else:
+                    logging.warning("Удаленная ветка изменилась после последней отправки, "
+                                    "БД будет восстановлена из репозитория")
+                    repo.head.reset(remote_commit, index=True, working_tree=False)
+            return True
+        except Exception as e:
+            delay = next(delays, None)
+            if delay is None:
+                logging.error(f"Не удалось синхронизировать репозиторий: {e}")
+                return False
+            logging.warning(f"Ошибка синхронизации репозитория, повтор через {delay} с: {e}")
+            time.sleep(delay)
+
+def _restore_after_checkout():
+    """Восстанавливает БД из снимка после клонирования (в режиме changelog это делает журнал)."""
+    global repo
+    if PERSIST_MODE == "changelog":
+        return
+    try:
+        with startup_phase('restore'):
+            restore_from_snapshot()
+    except Exception:
+        # Без проверенной БД ничего не отправляем в репозиторий
+        repo = None
+        raise
+
 def setup_repo():
-    """Клонирует репозиторий из GitHub во временную папку."""
+    """Готовит локальную копию репозитория с БД.
+
+    Копия от прошлого запуска вместе с БД используется сразу, только если ls-remote
+    показывает, что на GitHub нет более новых коммитов; остальная синхронизация идет
+    в фоновом потоке. Если ветку двигал другой экземпляр или деплой, копия удаляется
+    и БД восстанавливается из репозитория, как при первом запуске. Иначе делается
+    быстрый клон только последнего коммита и файлов БД; время запуска не зависит
+    от длины истории.
+
+    Ошибка проверки снимка не перехватывается: продолжать на пустой БД нельзя,
+    первый же push затер бы данные в репозитории.
+    """
     global repo
     remote_url = f"https://{GITHUB_TOKEN}@github.com/{GITHUB_REPO}.git"
     
-    if os.path.exists(REPO_PATH):
+    if os.path.isdir(os.path.join(REPO_PATH, '.git')):
+        synced = False
         try:
-            shutil.rmtree(REPO_PATH)
+            with startup_phase('checkout'):
+                repo = Repo(REPO_PATH)
+                repo.remote(name='origin').set_url(remote_url)
+            if _has_local_db():
+                with startup_phase('ls-remote'):
+                    current = local_copy_is_current()
+                if current:
+                    logging.info("Локальная копия репозитория актуальна, синхронизация идет в фоне")
+                    threading.Thread(target=sync_checkout, kwargs={'keep_local': True},
+                                     name="repo-sync", daemon=True).start()
+                    return True
+                # Неотправленные локальные изменения теряются, как и при клонировании в старых версиях
+                raise RuntimeError("удаленная ветка ушла вперед, локальная БД устарела")
+            synced = sync_checkout()
+            if synced:
+                repo.head.reset(index=True, working_tree=True)
         except Exception as e:
-            logging.warning(f"Не удалось удалить REPO_PATH: {e}")
+            logging.warning(f"Локальная копия репозитория непригодна, клонирую заново: {e}")
+            synced = False
+        if synced:
+            _restore_after_checkout()
+            return True
+        repo = None
+    
+    if os.path.exists(REPO_PATH):
+        shutil.rmtree(REPO_PATH, ignore_errors=True)
     
-    max_retries = 5
-    for attempt in range(max_retries):
+    delays = _retry_delays()
+    attempt = 1
+    while True:
         try:
-            logging.info(f"Клонирование репозитория {GITHUB_REPO}... (попытка {attempt + 1})")
-            repo = Repo.clone_from(remote_url, REPO_PATH)
-            repo.config_writer().set_value("user", "name", "AnonBot").release()
-            repo.config_writer().set_value("user", "email", "bot@render.com").release()
+            logging.info(f"Клонирование репозитория {GITHUB_REPO}... (попытка {attempt})")
+            with startup_phase('clone'):
+                repo = clone_repo(remote_url)
             logging.info("Репозиторий успешно склонирован и настроен.")
-            return True
+            break
         except Exception as e:
-            logging.error(f"Ошибка при клонировании репозитория (попытка {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(10)
-            else:
+            logging.error(f"Ошибка при клонировании репозитория (попытка {attempt}): {e}")
+            repo = None
+            shutil.rmtree(REPO_PATH, ignore_errors=True)
+            delay = next(delays, None)
+            if delay is None:
                 logging.critical("Не удалось склонировать репозиторий, создаю локальную БД")
                 os.makedirs(REPO_PATH, exist_ok=True)
                 return False
+            time.sleep(delay)
+            attempt += 1
+    _restore_after_checkout()
+    return True
+
+def push_db_to_github(commit_message, paths=None, removed=()):
+    """Отправляет на GitHub файлы БД из paths (снимок или журнал изменений).
 
-def push_db_to_github(commit_message):
-    """Отправляет файл базы данных на GitHub."""
+    Делает одну попытку без пауз: повторы и отсрочку решает CircuitBreaker в PersistenceWorker.
+    Коммит, который не удалось отправить раньше, отправляется вместе со следующим.
+    """
     if not repo:
         logging.error("Репозиторий не инициализирован, push невозможен.")
         return False
     
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            repo.index.add([DB_PATH])
-            if repo.is_dirty(index=True, working_tree=False):
-                repo.index.commit(commit_message)
-                origin = repo.remote(name='origin')
-                origin.push()
-                logging.info(f"База данных успешно отправлена на GitHub. Коммит: {commit_message}")
-                return True
-            else:
+    try:
+        repo.index.add(paths or [DB_PATH])
+        if removed:
+            repo.index.remove(removed)
+        if repo.is_dirty(index=True, working_tree=False):
+            repo.index.commit(commit_message)
+        else:
+            branch = repo.active_branch.name
+            if not int(repo.git.rev_list('--count', f'origin/{branch}..HEAD')):
                 logging.info("Нет изменений в БД для отправки.")
                 return True
-        except Exception as e:
-            logging.error(f"Ошибка при отправке БД на GitHub (попытка {attempt + 1}): {e}")
-            if attempt < max_retries - 1:
-                time.sleep(10)
+        origin = repo.remote(name='origin')
+        origin.push().raise_if_error()
+        logging.info(f"База данных успешно отправлена на GitHub. Коммит: {commit_message.splitlines()[0]}")
+        return True
+    except Exception as e:
+        logging.error(f"Ошибка при отправке БД на GitHub: {e}")
+        return False
+
+class CircuitBreaker:
+    """Автомат состояний для удаленного репозитория: closed, open, half_open.
+
+    closed — push выполняется как обычно. После PUSH_FAILURE_THRESHOLD неудач подряд
+    автомат переходит в open: push не выполняется, изменения копятся локально.
+    Когда пауза истекает, следующий push становится пробным (half_open): успех
+    закрывает автомат, неудача снова открывает его с вдвое большей паузой,
+    но не больше PUSH_BACKOFF_MAX.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold=PUSH_FAILURE_THRESHOLD, base_delay=PUSH_BACKOFF_BASE, max_delay=PUSH_BACKOFF_MAX):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = base_delay
+        self.open_until = 0.0
+        self.trips = 0
+
+    def retry_in(self):
+        """Сколько секунд осталось до пробного push (0, если push разрешен)."""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self.open_until - time.monotonic())
+
+    def allow(self):
+        """Разрешает push; по истечении паузы переводит автомат в half_open."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() < self.open_until:
+                    return False
+                self.state = self.HALF_OPEN
+                logging.info("GitHub: пробная отправка после паузы")
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("GitHub снова доступен, отправка восстановлена")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.delay = self.base_delay
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.delay = min(self.delay * 2, self.max_delay)
+            elif self.failures < self.threshold:
+                return
+            self.state = self.OPEN
+            self.open_until = time.monotonic() + self.delay
+            self.trips += 1
+            logging.warning(f"GitHub недоступен ({self.failures} неудач подряд), "
+                            f"изменения копятся локально, повтор через {self.delay:.0f} с")
+
+    def metrics(self):
+        retry_in = self.retry_in()
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry_in': retry_in,
+                'trips': self.trips,
+            }
+
+class PersistenceWorker:
+    """Фоновый поток, который объединяет изменения БД в один коммит и push."""
+
+    def __init__(self, interval=PERSIST_INTERVAL, max_changes=PERSIST_MAX_CHANGES):
+        self.interval = interval
+        self.max_changes = max_changes
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._pending = 0
+        self._reasons = []
+        self._first_change_at = None
+        # Счетчики для мониторинга
+        self.pushes = 0
+        self.push_failures = 0
+        self.last_push_latency = None
+        self.last_push_at = None
+        self.breaker = CircuitBreaker()
+        self._retry_at = 0.0  # после неудачи следующая попытка не раньше interval
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="db-persistence", daemon=True)
+        self._thread.start()
+        logging.info(f"Фоновая синхронизация БД запущена (интервал {self.interval}с, до {self.max_changes} изменений)")
+
+    def mark_dirty(self, reason):
+        """Отмечает, что БД изменилась. Не блокирует вызывающий код."""
+        with self._cond:
+            self._pending += 1
+            if len(self._reasons) < 20:
+                self._reasons.append(reason)
+            if self._first_change_at is None:
+                self._first_change_at = time.monotonic()
+            if self._pending >= self.max_changes:
+                self._cond.notify()
+
+    def _wait_for_batch(self):
+        """Ждет, пока накопится пачка изменений, истечет интервал или придет остановка.
+
+        Пока CircuitBreaker открыт, изменения только копятся и уходят одним push после паузы.
+        После любой неудачи (в том числе при создании снимка) новая попытка не раньше чем через interval.
+        """
+        with self._cond:
+            while not self._stopping:
+                blocked = max(self.breaker.retry_in(), self._retry_at - time.monotonic())
+                if self._pending and blocked > 0:
+                    self._cond.wait(blocked)
+                    continue
+                if self._pending >= self.max_changes:
+                    break
+                if self._pending:
+                    remaining = self.interval - (time.monotonic() - self._first_change_at)
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+            batch, reasons = self._pending, self._reasons
+            self._pending, self._reasons, self._first_change_at = 0, [], None
+            return batch, reasons, self._stopping
+
+    def _run(self):
+        while True:
+            batch, reasons, stopping = self._wait_for_batch()
+            if batch:
+                # При остановке делаем последнюю попытку даже при открытом автомате
+                self._push(batch, reasons, force=stopping)
+            if stopping:
+                return
+
+    def _push(self, batch, reasons, force=False):
+        if not repo:
+            return False
+        if not (self.breaker.allow() or force):
+            self._requeue(batch, reasons)
+            return False
+        if batch == 1:
+            commit_message = reasons[0]
+        else:
+            commit_message = f"Sync DB: {batch} changes\n\n" + "\n".join(reasons)
+        started = time.monotonic()
+        with repo_lock:
+            if changelog is not None:
+                try:
+                    paths, removed = changelog.prepare_push(repo)
+                except Exception as e:
+                    logging.error(f"Ошибка подготовки журнала изменений: {e}")
+                    paths, removed = None, ()
             else:
-                logging.error(f"Не удалось отправить БД на GitHub после {max_retries} попыток")
-                return False
+                # Вместо живого файла БД, который может меняться во время коммита, отправляем снимок
+                try:
+                    paths, removed = prepare_snapshot_push(repo)
+                except Exception as e:
+                    logging.error(f"Ошибка создания снимка БД: {e}")
+                    paths, removed = None, ()
+            success = bool(paths) and push_db_to_github(commit_message, paths, removed)
+            # Ошибка снимка (нет места на диске, сбой backup) тоже открывает автомат,
+            # иначе при накопленных max_changes попытки шли бы без паузы
+            if success:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+        with self._cond:
+            self.last_push_latency = time.monotonic() - started
+            if success:
+                self.pushes += 1
+                self.last_push_at = datetime.now()
+                return True
+            self.push_failures += 1
+            self._retry_at = time.monotonic() + self.interval
+        self._requeue(batch, reasons)
+        return False
+
+    def _requeue(self, batch, reasons):
+        """Возвращает изменения в очередь, чтобы отправить их в следующий раз."""
+        with self._cond:
+            self._pending += batch
+            self._reasons = (reasons + self._reasons)[:20]
+            if self._first_change_at is None:
+                self._first_change_at = time.monotonic()
+
+    def stop(self, timeout=None):
+        """Останавливает поток, предварительно отправив накопленные изменения."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        logging.info("Фоновая синхронизация БД остановлена")
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'pending_changes': self._pending,
+                'pushes': self.pushes,
+                'push_failures': self.push_failures,
+                'last_push_latency': self.last_push_latency,
+                'last_push_at': self.last_push_at,
+                'remote': self.breaker.metrics(),
+            }
+
+persistence = PersistenceWorker()
+
+def mark_db_dirty(reason):
+    """Ставит изменение БД в очередь на отправку в GitHub."""
+    persistence.mark_dirty(reason)
+
+# --- СНИМКИ БД ---
+
+SNAPSHOT_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+def _snapshot_compression():
+    if SNAPSHOT_COMPRESSION == 'zstd' and zstandard is None:
+        return 'gzip'
+    return SNAPSHOT_COMPRESSION
+
+def _open_compressed(path, compression, mode):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Снимок сжат zstd, но пакет zstandard не установлен")
+        return zstandard.open(path, mode)
+    return gzip.open(path, mode, compresslevel=6)
+
+def backup_to_temp(conn):
+    """Копирует БД через backup API во временный файл и возвращает его путь.
+
+    Копирование идет одним шагом в одной читающей транзакции: копия согласованная,
+    а писатели в режиме WAL при этом не блокируются.
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', prefix='snapshot-')
+    os.close(fd)
+    try:
+        target = sqlite3.connect(tmp_path)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+def save_snapshot(tmp_path, base_path):
+    """Сжимает копию БД в base_path + .gz/.zst и пишет манифест base_path + .json.
+
+    Манифест с контрольной суммой записывается последним: снимок без манифеста считается незаконченным.
+    Временный файл удаляется.
+    """
+    compression = _snapshot_compression()
+    data_path = base_path + SNAPSHOT_EXTENSIONS[compression]
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        snapshot = sqlite3.connect(tmp_path)
+        try:
+            schema = snapshot.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            snapshot.close()
+        with open(tmp_path, 'rb') as source, _open_compressed(data_path + '.tmp', compression, 'wb') as target:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                target.write(chunk)
+    finally:
+        os.remove(tmp_path)
+    os.replace(data_path + '.tmp', data_path)
+    manifest = {
+        'file': os.path.basename(data_path),
+        'compression': compression,
+        'sha256': digest.hexdigest(),
+        'size': size,
+        'compressed_size': os.path.getsize(data_path),
+        'schema': schema,
+        'created_at': db_timestamp(),
+    }
+    with open(base_path + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(base_path + '.json.tmp', base_path + '.json')
+    return manifest
+
+def restore_snapshot(base_path, db_path):
+    """Распаковывает снимок в db_path, проверив размер и sha256 из манифеста.
+
+    При несовпадении бросает ValueError, а текущий файл БД не трогает.
+    """
+    with open(base_path + '.json', encoding='utf-8') as f:
+        manifest = json.load(f)
+    data_path = os.path.join(os.path.dirname(base_path), manifest['file'])
+    tmp_path = db_path + '.restore'
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with _open_compressed(data_path, manifest['compression'], 'rb') as source, open(tmp_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                target.write(chunk)
+        if size != manifest['size'] or digest.hexdigest() != manifest['sha256']:
+            raise ValueError(f"Контрольная сумма снимка {manifest['file']} не совпадает")
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(tmp_path, db_path)
+    return manifest
+
+def restore_from_snapshot():
+    """Восстанавливает БД из снимка репозитория (режим file).
+
+    Если снимка нет, используется файл БД как есть (репозиторий старого формата).
+    Если снимок не прошел проверку, исключение пробрасывается дальше.
+    """
+    if not os.path.exists(SNAPSHOT_BASE + '.json'):
+        return False
+    started = time.monotonic()
+    try:
+        manifest = restore_snapshot(SNAPSHOT_BASE, DB_PATH)
+    except Exception as e:
+        logging.critical(f"Не удалось восстановить БД из снимка: {e}")
+        raise
+    logging.info(f"БД восстановлена из снимка {manifest['file']} от {manifest['created_at']} "
+                 f"({manifest['size'] // 1024} KB), {time.monotonic() - started:.2f} с")
+    return True
+
+def prepare_snapshot_push(repo):
+    """Делает снимок для режима file и возвращает (файлы для добавления, файлы для удаления из индекса)."""
+    manifest = save_snapshot(backup_to_temp(db_pool.connection()), SNAPSHOT_BASE)
+    directory = os.path.dirname(SNAPSHOT_BASE)
+    paths = [os.path.join(directory, manifest['file']), SNAPSHOT_BASE + '.json']
+    # Сам файл БД и снимки в другом формате сжатия больше не хранятся в репозитории
+    stale = [DB_PATH] + [SNAPSHOT_BASE + ext for ext in SNAPSHOT_EXTENSIONS.values()
+                         if SNAPSHOT_BASE + ext not in paths]
+    removed = [os.path.relpath(path, REPO_PATH) for path in stale]
+    removed = [path for path in removed if (path, 0) in repo.index.entries]
+    return paths, removed
+
+# --- ЖУРНАЛ ИЗМЕНЕНИЙ ---
+
+def _file_seq(name):
+    """Номер сегмента или снимка из имени вида segment-00000042.jsonl."""
+    return int(name.split('-', 1)[1].split('.', 1)[0])
+
+class ChangeLog:
+    """Журнал изменений БД для режима PERSIST_MODE=changelog.
+
+    Каждая успешная транзакция записывается одной строкой JSON (запросы и параметры)
+    в файл-сегмент changelog/segment-N.jsonl. В git коммитятся только новые сегменты,
+    а не весь файл БД. Раз в CHANGELOG_SNAPSHOT_SEGMENTS сегментов делается снимок
+    snapshot-N (сжатая копия и манифест), который содержит все сегменты до N включительно; старые сегменты
+    и снимки после этого удаляются. При запуске БД собирается из последнего снимка
+    и сегментов после него.
+
+    Запись в журнал идет под self.lock в порядке коммитов; копия БД для снимка снимается
+    под тем же lock, поэтому точно соответствует границе сегмента. Сжатие идет уже без lock.
+    """
+
+    def __init__(self, directory, segment_bytes=CHANGELOG_SEGMENT_BYTES, snapshot_segments=CHANGELOG_SNAPSHOT_SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.snapshot_segments = snapshot_segments
+        self.lock = threading.RLock()
+        self._file = None
+        self._seq = 0  # последний использованный номер сегмента
+        self._snapshot_seq = None
+        self._snapshot_manifest = None
+        self.records = 0
+        self.snapshots = 0
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, f"segment-{seq:08d}.jsonl")
+
+    def _snapshot_base(self, seq):
+        return os.path.join(self.directory, f"snapshot-{seq:08d}")
+
+    def _list(self, kind):
+        """Номера сегментов или законченных снимков (с манифестом) по возрастанию."""
+        if not os.path.isdir(self.directory):
+            return []
+        ext = '.json' if kind == 'snapshot' else '.jsonl'
+        return sorted(_file_seq(name) for name in os.listdir(self.directory)
+                      if name.startswith(f"{kind}-") and name.endswith(ext))
+
+    def restore(self, db_path):
+        """Собирает БД из последнего снимка и сегментов после него. Вызывается до init_db."""
+        started = time.monotonic()
+        snapshots = self._list('snapshot')
+        segments = self._list('segment')
+        base = snapshots[-1] if snapshots else 0
+        if snapshots:
+            # Поврежденный снимок не подменяется пустой БД: ошибка уходит в main
+            self._snapshot_manifest = restore_snapshot(self._snapshot_base(base), db_path)
+            self._snapshot_seq = base
+        else:
+            # Без снимка журнала за основу берется БД режима file (снимок или сам файл)
+            restore_from_snapshot()
+        replayed = skipped = 0
+        conn = sqlite3.connect(db_path)
+        try:
+            for seq in segments:
+                if seq <= base:
+                    continue
+                with open(self._segment_path(seq), encoding='utf-8') as segment:
+                    for line_no, line in enumerate(segment, 1):
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # Оборванная последняя строка после аварийного завершения
+                            logging.warning(f"Журнал: пропущена поврежденная запись {seq}:{line_no}")
+                            skipped += 1
+                            continue
+                        try:
+                            with conn:
+                                for op in record['ops']:
+                                    if len(op) == 3:
+                                        conn.executemany(op[0], op[1])
+                                    else:
+                                        conn.execute(op[0], op[1])
+                            replayed += 1
+                        except sqlite3.Error as e:
+                            logging.error(f"Журнал: не удалось применить запись {seq}:{line_no}: {e}")
+                            skipped += 1
+        finally:
+            conn.close()
+        self._seq = max([base] + segments)
+        logging.info(f"БД восстановлена из журнала: снимок {base}, применено {replayed} транзакций, "
+                     f"пропущено {skipped}, {time.monotonic() - started:.2f} с")
+        return replayed
+
+    def append(self, ops):
+        """Дописывает транзакцию в текущий сегмент. Вызывается под self.lock сразу после коммита."""
+        if not ops:
+            return
+        if self._file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._seq += 1
+            self._file = open(self._segment_path(self._seq), 'a', encoding='utf-8')
+        record = {'ts': round(time.time(), 3), 'ops': ops}
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + "\n")
+        self._file.flush()
+        self.records += 1
+        if self._file.tell() >= self.segment_bytes:
+            self._seal()
+
+    def _seal(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def snapshot(self):
+        """Снимок БД, включающий все записанные сегменты; старые сегменты удаляются."""
+        with self.lock:
+            self._seal()
+            seq = self._seq
+            tmp_path = backup_to_temp(db_pool.connection())
+        os.makedirs(self.directory, exist_ok=True)
+        self._snapshot_manifest = save_snapshot(tmp_path, self._snapshot_base(seq))
+        self._snapshot_seq = seq
+        self.snapshots += 1
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and _file_seq(name) <= seq:
+                os.remove(os.path.join(self.directory, name))
+            elif name.startswith('snapshot-') and _file_seq(name) < seq:
+                os.remove(os.path.join(self.directory, name))
+        logging.info(f"Снимок БД {seq} создан, старые сегменты журнала удалены")
+
+    def ensure_snapshot(self):
+        """Делает снимок, если его нет или схема БД изменилась после него.
+
+        Вызывается после init_db: сегменты всегда применяются к снимку той же версии схемы.
+        """
+        if self._snapshot_manifest is not None:
+            current_version = db_pool.connection().execute("PRAGMA user_version").fetchone()[0]
+            if self._snapshot_manifest['schema'] == current_version:
+                return
+        self.snapshot()
+
+    def prepare_push(self, repo):
+        """Закрывает текущий сегмент (при необходимости делает снимок) и возвращает
+        (файлы для добавления, удаленные файлы) для коммита."""
+        with self.lock:
+            self._seal()
+            due = self._seq - (self._snapshot_seq or 0) >= self.snapshot_segments
+        if due:
+            self.snapshot()
+        prefix = os.path.relpath(self.directory, REPO_PATH) + '/'
+        present = [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                   if not name.endswith('.tmp')]
+        removed = [path for path, stage in repo.index.entries
+                   if path.startswith(prefix) and not os.path.exists(os.path.join(REPO_PATH, path))]
+        return present, removed
+
+    def metrics(self):
+        return {
+            'records': self.records,
+            'segment': self._seq,
+            'snapshot': self._snapshot_seq,
+            'snapshots': self.snapshots,
+        }
+
+@functools.lru_cache(maxsize=256)
+def _compact_sql(query):
+    """Убирает переносы и отступы из текста запроса, чтобы записи журнала были короче."""
+    return " ".join(query.split())
+
+changelog = ChangeLog(CHANGELOG_DIR) if PERSIST_MODE == "changelog" else None
+
+@contextmanager
+def journaled_writes():
+    """Записывает изменения транзакции в журнал после успешного коммита.
+
+    Отдает список, куда добавляются [запрос, параметры], или None, если журнал выключен.
+    """
+    if changelog is None:
+        yield None
+        return
+    with changelog.lock:
+        ops = []
+        yield ops
+        changelog.append(ops)
+
+class JournaledCursor:
+    """Курсор, который запоминает изменившие данные запросы для журнала."""
+
+    def __init__(self, cursor, ops):
+        self._cursor = cursor
+        self._ops = ops
+
+    def execute(self, query, params=()):
+        before = self._cursor.connection.total_changes
+        self._cursor.execute(query, params)
+        if self._cursor.connection.total_changes != before:
+            self._ops.append([_compact_sql(query), list(params) if isinstance(params, tuple) else params])
+        return self
+
+    def executemany(self, query, seq_of_params):
+        rows = [list(params) for params in seq_of_params]
+        before = self._cursor.connection.total_changes
+        self._cursor.executemany(query, rows)
+        if self._cursor.connection.total_changes != before:
+            self._ops.append([_compact_sql(query), rows, 1])
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
 
 # --- ФУНКЦИИ ДЛЯ РАБОТЫ С БД ---
 
+class ConnectionPool:
+    """Держит одно долгоживущее соединение SQLite на поток вместо connect() на каждый запрос."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def connection(self):
+        """Возвращает соединение текущего потока, создавая его при первом обращении."""
+        cached = getattr(self._local, 'conn', None)
+        if cached and cached[0] == self._generation:
+            return cached[1]
+        conn = self._connect()
+        with self._lock:
+            self._connections.append(conn)
+            self._local.conn = (self._generation, conn)
+        return conn
+
+    def close_all(self):
+        """Закрывает все соединения, например перед заменой файла БД."""
+        with self._lock:
+            self._generation += 1
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+db_pool = ConnectionPool(DB_PATH)
+
+# --- МИГРАЦИИ СХЕМЫ ---
+
+def _ensure_columns(required):
+    """Шаг миграции, который добавляет отсутствующие колонки {таблица: [(колонка, определение)]}."""
+    def step(cursor):
+        for table, columns in required.items():
+            existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()}
+            for name, definition in columns:
+                if name not in existing:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return step
+
+def _counter_sql(key, delta):
+    """SQL для изменения счетчика статистики на delta (используется в триггерах)."""
+    return (f"INSERT INTO stats_counters (key, value) VALUES ({key}, {delta}) "
+            f"ON CONFLICT(key) DO UPDATE SET value = value + excluded.value;")
+
+def _flag(expr):
+    return f"COALESCE({expr}, 0)"
+
+# Триггеры поддерживают stats_counters при каждой вставке, удалении и изменении строк,
+# поэтому get_admin_stats не пересчитывает таблицы целиком
+STATS_TRIGGERS = {
+    'trg_stats_users_insert': ("AFTER INSERT ON users", [
+        _counter_sql("'users'", "1"),
+        _counter_sql("'banned'", _flag("NEW.is_banned = 1")),
+    ]),
+    'trg_stats_users_delete': ("AFTER DELETE ON users", [
+        _counter_sql("'users'", "-1"),
+        _counter_sql("'banned'", "-" + _flag("OLD.is_banned = 1")),
+    ]),
+    'trg_stats_users_update': ("AFTER UPDATE OF is_banned ON users", [
+        _counter_sql("'banned'", f"{_flag('NEW.is_banned = 1')} - {_flag('OLD.is_banned = 1')}"),
+    ]),
+    'trg_stats_links_insert': ("AFTER INSERT ON links", [
+        _counter_sql("'links'", _flag("NEW.is_active = 1")),
+        _counter_sql("'sponsor_links'", _flag("NEW.is_sponsor = 1")),
+    ]),
+    'trg_stats_links_delete': ("AFTER DELETE ON links", [
+        _counter_sql("'links'", "-" + _flag("OLD.is_active = 1")),
+        _counter_sql("'sponsor_links'", "-" + _flag("OLD.is_sponsor = 1")),
+    ]),
+    'trg_stats_links_update': ("AFTER UPDATE OF is_active, is_sponsor ON links", [
+        _counter_sql("'links'", f"{_flag('NEW.is_active = 1')} - {_flag('OLD.is_active = 1')}"),
+        _counter_sql("'sponsor_links'", f"{_flag('NEW.is_sponsor = 1')} - {_flag('OLD.is_sponsor = 1')}"),
+    ]),
+    'trg_stats_messages_insert': ("AFTER INSERT ON messages", [
+        _counter_sql("'messages'", _flag("NEW.is_active = 1")),
+        _counter_sql("'type:' || NEW.message_type", _flag("NEW.is_active = 1")),
+    ]),
+    'trg_stats_messages_delete': ("AFTER DELETE ON messages", [
+        _counter_sql("'messages'", "-" + _flag("OLD.is_active = 1")),
+        _counter_sql("'type:' || OLD.message_type", "-" + _flag("OLD.is_active = 1")),
+    ]),
+    'trg_stats_messages_update': ("AFTER UPDATE OF is_active, message_type ON messages", [
+        _counter_sql("'messages'", f"{_flag('NEW.is_active = 1')} - {_flag('OLD.is_active = 1')}"),
+        _counter_sql("'type:' || OLD.message_type", "-" + _flag("OLD.is_active = 1")),
+        _counter_sql("'type:' || NEW.message_type", _flag("NEW.is_active = 1")),
+    ]),
+    'trg_stats_replies_insert': ("AFTER INSERT ON replies", [
+        _counter_sql("'replies'", _flag("NEW.is_active = 1")),
+    ]),
+    'trg_stats_replies_delete': ("AFTER DELETE ON replies", [
+        _counter_sql("'replies'", "-" + _flag("OLD.is_active = 1")),
+    ]),
+    'trg_stats_replies_update': ("AFTER UPDATE OF is_active ON replies", [
+        _counter_sql("'replies'", f"{_flag('NEW.is_active = 1')} - {_flag('OLD.is_active = 1')}"),
+    ]),
+}
+
+def _create_stats_triggers(cursor):
+    for name, (event, statements) in STATS_TRIGGERS.items():
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {' '.join(statements)} END")
+
+def rebuild_stats_counters(cursor):
+    """Пересчитывает stats_counters по таблицам: по одному агрегирующему запросу на таблицу."""
+    counters = {}
+    users, banned = cursor.execute("SELECT COUNT(*), SUM(is_banned = 1) FROM users").fetchone()
+    counters['users'], counters['banned'] = users, banned or 0
+    links, sponsor_links = cursor.execute("SELECT SUM(is_active = 1), SUM(is_sponsor = 1) FROM links").fetchone()
+    counters['links'], counters['sponsor_links'] = links or 0, sponsor_links or 0
+    counters['messages'] = 0
+    for message_type, count in cursor.execute(
+            "SELECT message_type, COUNT(*) FROM messages WHERE is_active = 1 GROUP BY message_type").fetchall():
+        counters[f'type:{message_type}'] = count
+        counters['messages'] += count
+    counters['replies'] = cursor.execute("SELECT COUNT(*) FROM replies WHERE is_active = 1").fetchone()[0]
+    cursor.execute("DELETE FROM stats_counters")
+    cursor.executemany("INSERT INTO stats_counters (key, value) VALUES (?, ?)", counters.items())
+
+# Версия схемы хранится в PRAGMA user_version, каждая миграция применяется один раз
+SCHEMA_MIGRATIONS = [
+    (1, "Колонки старых версий БД", [_ensure_columns({
+        'users': [('is_banned', 'BOOLEAN DEFAULT 0'), ('ban_reason', 'TEXT DEFAULT NULL')],
+        'links': [('is_sponsor', 'BOOLEAN DEFAULT 0'), ('sponsor_owner_id', 'INTEGER DEFAULT NULL'),
+                  ('custom_id', 'TEXT DEFAULT NULL')],
+    })]),
+    (2, "Индексы для частых запросов", [
+        "CREATE INDEX IF NOT EXISTS idx_messages_to_user ON messages (to_user_id, is_active, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_from_user ON messages (from_user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_link ON messages (link_id, is_active)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_active_created ON messages (is_active, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_replies_message ON replies (message_id, is_active)",
+        "CREATE INDEX IF NOT EXISTS idx_replies_from_user ON replies (from_user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_links_user ON links (user_id, is_active)",
+        "CREATE INDEX IF NOT EXISTS idx_links_active_created ON links (is_active, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_links_sponsor ON links (sponsor_owner_id) WHERE is_sponsor = 1",
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_banned ON users (user_id) WHERE is_banned = 1",
+    ]),
+    (3, "Счетчики статистики на триггерах", [
+        "CREATE TABLE IF NOT EXISTS stats_counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+        _create_stats_triggers,
+        rebuild_stats_counters,
+    ]),
+    (4, "Сохраняемые задания рассылки", [
+        _ensure_columns({'users': [('bot_blocked', 'BOOLEAN DEFAULT 0')]}),
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            message_text TEXT,
+            status TEXT DEFAULT 'running',
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients (job_id, status, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status)",
+    ]),
+    (5, "Сохраняемое состояние диалогов", [
+        '''CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_user_state_updated ON user_state (updated_at)",
+    ]),
+    (6, "Сохраняемая очередь отправки уведомлений", [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            error TEXT,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (chat_id, id) WHERE status = 'pending'",
+    ]),
+    (7, "Ссылки пользователя в порядке создания", [
+        "CREATE INDEX IF NOT EXISTS idx_links_user_created ON links (user_id, is_active, created_at)",
+        "DROP INDEX IF EXISTS idx_links_user",
+    ]),
+]
+
+def apply_migrations(conn):
+    """Применяет миграции схемы, которые еще не были применены к этой БД."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target, description, steps in SCHEMA_MIGRATIONS:
+        if target <= version:
+            continue
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            version = target
+            logging.info(f"Применена миграция БД {target}: {description}")
+        except sqlite3.Error as e:
+            conn.rollback()
+            logging.error(f"Ошибка миграции БД {target}: {e}")
+            raise
+    return version
+
+# SQL горячих путей: его выполняют функции доступа к БД и проверяет check_query_plans
+LINK_INFO_SQL = 'SELECT l.link_id, l.user_id, l.title, l.description, u.username FROM links l LEFT JOIN users u ON l.user_id = u.user_id WHERE l.link_id = ? AND l.is_active = 1'
+USER_LINKS_SQL = 'SELECT link_id, title, description, created_at FROM links WHERE user_id = ? AND is_active = 1'
+USER_MESSAGES_FIRST_SQL = '''
+    SELECT m.message_id, substr(m.message_text, 1, ?), m.message_type, m.created_at, l.title
+    FROM messages m
+    JOIN links l ON m.link_id = l.link_id
+    WHERE m.to_user_id = ? AND m.is_active = 1
+    ORDER BY m.created_at DESC, m.message_id DESC LIMIT ?
+'''
+USER_MESSAGES_NEWER_SQL = '''
+    SELECT m.message_id, substr(m.message_text, 1, ?), m.message_type, m.created_at, l.title
+    FROM messages m
+    JOIN links l ON m.link_id = l.link_id
+    WHERE m.to_user_id = ? AND m.is_active = 1 AND (m.created_at, m.message_id) > (?, ?)
+    ORDER BY m.created_at ASC, m.message_id ASC LIMIT ?
+'''
+USER_MESSAGES_OLDER_SQL = '''
+    SELECT m.message_id, substr(m.message_text, 1, ?), m.message_type, m.created_at, l.title
+    FROM messages m
+    JOIN links l ON m.link_id = l.link_id
+    WHERE m.to_user_id = ? AND m.is_active = 1 AND (m.created_at, m.message_id) < (?, ?)
+    ORDER BY m.created_at DESC, m.message_id DESC LIMIT ?
+'''
+REPLY_COUNTS_SQL = '''
+    SELECT message_id, COUNT(*) FROM replies
+    WHERE message_id IN ({placeholders}) AND is_active = 1
+    GROUP BY message_id
+'''
+MESSAGE_REPLIES_SQL = '''
+    SELECT r.reply_id, r.reply_text, r.created_at, u.username, u.first_name
+    FROM replies r
+    LEFT JOIN users u ON r.from_user_id = u.user_id
+    WHERE r.message_id = ? AND r.is_active = 1
+    ORDER BY r.created_at ASC
+'''
+ADMIN_USER_LINKS_SQL = '''
+    SELECT l.link_id, l.title, l.description, l.created_at,
+           (SELECT COUNT(*) FROM messages m WHERE m.link_id = l.link_id AND m.is_active = 1) as message_count
+    FROM links l
+    WHERE l.user_id = ? AND l.is_active = 1
+    ORDER BY l.created_at DESC
+'''
+SPONSOR_LINKS_SQL = 'SELECT link_id, title, description, created_at, user_id, custom_id FROM links WHERE is_sponsor = 1 AND sponsor_owner_id = ?'
+USER_BANNED_SQL = 'SELECT is_banned FROM users WHERE user_id = ?'
+ADMIN_USERS_FIRST_SQL = '''
+    SELECT user_id, username, first_name, created_at, is_banned FROM users
+    ORDER BY created_at DESC, user_id DESC LIMIT ?
+'''
+ADMIN_USERS_NEWER_SQL = '''
+    SELECT user_id, username, first_name, created_at, is_banned FROM users
+    WHERE (created_at, user_id) > (?, ?)
+    ORDER BY created_at ASC, user_id ASC LIMIT ?
+'''
+ADMIN_USERS_OLDER_SQL = '''
+    SELECT user_id, username, first_name, created_at, is_banned FROM users
+    WHERE (created_at, user_id) < (?, ?)
+    ORDER BY created_at DESC, user_id DESC LIMIT ?
+'''
+
+class QueryPlanError(RuntimeError):
+    """Горячий запрос перестал использовать индекс."""
+
+# Запросы горячих путей и фрагменты плана, которые обязаны в нем быть: индекс и ключевые колонки.
+# Любой SEARCH прошел бы проверку, даже по индексу, который отбирает почти всю таблицу
+_PAGE_KEY = ('2024-01-01 00:00:00', 1)
+HOT_QUERIES = {
+    'get_link_info': (LINK_INFO_SQL, ('x',), ['sqlite_autoindex_links_1 (link_id=?)']),
+    'get_user_links': (USER_LINKS_SQL, (1,), ['idx_links_user_created (user_id=? AND is_active=?)']),
+    'get_user_messages_page_first': (USER_MESSAGES_FIRST_SQL, (51, 1, 11), [
+        'idx_messages_to_user (to_user_id=? AND is_active=?)', 'sqlite_autoindex_links_1 (link_id=?)']),
+    'get_user_messages_page_newer': (USER_MESSAGES_NEWER_SQL, (51, 1, *_PAGE_KEY, 11), [
+        'idx_messages_to_user (to_user_id=? AND is_active=? AND created_at>?)', 'sqlite_autoindex_links_1 (link_id=?)']),
+    'get_user_messages_page_older': (USER_MESSAGES_OLDER_SQL, (51, 1, *_PAGE_KEY, 11), [
+        'idx_messages_to_user (to_user_id=? AND is_active=? AND created_at<?)', 'sqlite_autoindex_links_1 (link_id=?)']),
+    'get_reply_counts': (REPLY_COUNTS_SQL.format(placeholders="?, ?"), (1, 2), [
+        'idx_replies_message (message_id=? AND is_active=?)']),
+    'get_message_replies': (MESSAGE_REPLIES_SQL, (1,), ['idx_replies_message (message_id=? AND is_active=?)']),
+    'get_user_links_for_admin': (ADMIN_USER_LINKS_SQL, (1,), [
+        'idx_links_user_created (user_id=? AND is_active=?)', 'idx_messages_link (link_id=? AND is_active=?)']),
+    'get_sponsor_links': (SPONSOR_LINKS_SQL, (1,), ['idx_links_sponsor (sponsor_owner_id=?)']),
+    'is_user_banned': (USER_BANNED_SQL, (1,), ['users USING INTEGER PRIMARY KEY (rowid=?)']),
+    # Первая страница — проход по индексу в нужном порядке, который останавливается на LIMIT
+    'get_admin_users_page_first': (ADMIN_USERS_FIRST_SQL, (16,), ['SCAN users USING INDEX idx_users_created']),
+    'get_admin_users_page_newer': (ADMIN_USERS_NEWER_SQL, (*_PAGE_KEY, 16), ['idx_users_created (created_at>?)']),
+    'get_admin_users_page_older': (ADMIN_USERS_OLDER_SQL, (*_PAGE_KEY, 16), ['idx_users_created (created_at<?)']),
+}
+
+def check_query_plans():
+    """Проверяет через EXPLAIN QUERY PLAN, что каждый горячий запрос идет через ожидаемый индекс.
+
+    Бросает QueryPlanError со списком запросов, в плане которых нет ожидаемого индекса
+    с ключевыми колонками, есть полный проход по таблице или которые не компилируются.
+    """
+    conn = db_pool.connection()
+    problems = {}
+    for name, (query, params, expected) in HOT_QUERIES.items():
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        except sqlite3.Error as e:
+            problems[name] = [f"ошибка: {e}"]
+            continue
+        missing = [f"нет {fragment}" for fragment in expected if not any(fragment in step for step in plan)]
+        scans = [step for step in plan if step.startswith("SCAN") and "USING" not in step]
+        if missing or scans:
+            problems[name] = missing + scans + [f"план: {' | '.join(plan)}"]
+    if problems:
+        details = "; ".join(f"{name}: {', '.join(steps)}" for name, steps in problems.items())
+        raise QueryPlanError(f"Горячие запросы не используют ожидаемые индексы: {details}")
+
 def init_db():
-    """Создает таблицы, если их нет."""
+    """Создает таблицы, если их нет, и применяет миграции схемы."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db_pool.connection()
         cursor = conn.cursor()
         
         # Создаем таблицу пользователей с нужными колонками
@@ -175,21 +1342,32 @@ def init_db():
         ''')
         
         conn.commit()
-        conn.close()
+        
+        apply_migrations(conn)
+        user_registry.load()
         
         logging.info("База данных успешно инициализирована")
         
     except Exception as e:
         logging.error(f"Ошибка при инициализации БД: {e}")
 
+def db_timestamp():
+    """Текущее время в формате CURRENT_TIMESTAMP (UTC).
+
+    Время создания записей передается явно, а не берется из DEFAULT, чтобы повтор
+    журнала изменений восстанавливал те же значения.
+    """
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
 def run_query(query, params=(), commit=False, fetch=None):
     """Универсальная функция для выполнения запросов к БД."""
     try:
-        with sqlite3.connect(DB_PATH, timeout=30) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
-            if commit:
-                conn.commit()
+        conn = db_pool.connection()
+        with journaled_writes() if commit else nullcontext() as ops, conn:
+            before = conn.total_changes
+            cursor = conn.execute(query, params)
+            if ops is not None and conn.total_changes != before:
+                ops.append([_compact_sql(query), list(params) if isinstance(params, tuple) else params])
             if fetch == "one":
                 return cursor.fetchone()
             if fetch == "all":
@@ -200,9 +1378,236 @@ def run_query(query, params=(), commit=False, fetch=None):
         logging.error(f"Ошибка базы данных: {e}")
         return None
 
+def iter_query(query, params=(), batch_size=500):
+    """Построчно отдает результат запроса, читая курсор пачками, без загрузки всех строк в память.
+
+    Генератор нужно дочитать в том же потоке, где он был начат.
+    """
+    cursor = db_pool.connection().execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+@contextmanager
+def db_transaction():
+    """Выполняет несколько запросов в одной транзакции: все изменения применяются или откатываются вместе."""
+    conn = db_pool.connection()
+    with journaled_writes() as ops:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor if ops is None else JournaledCursor(cursor, ops)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+class AsyncDB:
+    """Асинхронная обертка над БД для обработчиков: запросы выполняются вне event loop.
+
+    Все записи идут через один поток-писатель (SQLite допускает одного писателя),
+    чтение выполняется параллельно в пуле потоков-читателей (WAL не блокирует читателей).
+    """
+
+    def __init__(self, read_workers=DB_READ_WORKERS):
+        self._reader = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-reader")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+    async def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def read(self, func, *args, **kwargs):
+        """Выполняет читающую функцию БД в пуле читателей."""
+        return await self._run(self._reader, func, *args, **kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        """Выполняет изменяющую функцию БД в потоке-писателе."""
+        return await self._run(self._writer, func, *args, **kwargs)
+
+    async def fetch_one(self, query, params=()):
+        return await self.read(run_query, query, params, fetch="one")
+
+    async def fetch_all(self, query, params=()):
+        return await self.read(run_query, query, params, fetch="all")
+
+    async def execute(self, query, params=()):
+        return await self.write(run_query, query, params, commit=True)
+
+    def shutdown(self):
+        """Дожидается завершения начатых запросов и останавливает потоки."""
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+
+db = AsyncDB()
+
+# --- КЭШ ПОЛЬЗОВАТЕЛЕЙ ---
+
+class UserRegistry:
+    """Кэш известных пользователей и заблокированных ID в памяти процесса.
+
+    Загружается при старте и поддерживается в актуальном состоянии функциями
+    save_user, ban_user, unban_user и delete_user, поэтому обычная проверка
+    пользователя в обработчиках не обращается к БД.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}  # user_id -> (username, first_name)
+        self._banned = set()
+        self._bot_blocked = set()  # пользователи, заблокировавшие бота
+        self.loaded = False
+
+    def load(self):
+        rows = run_query('SELECT user_id, username, first_name, is_banned, bot_blocked FROM users', fetch="all")
+        if rows is None:
+            logging.error("Не удалось загрузить кэш пользователей, проверки пойдут через БД")
+            return
+        with self._lock:
+            self._users = {row[0]: (row[1], row[2]) for row in rows}
+            self._banned = {row[0] for row in rows if row[3]}
+            self._bot_blocked = {row[0] for row in rows if row[4]}
+            self.loaded = True
+        logging.info(f"Кэш пользователей загружен: {len(self._users)} пользователей, {len(self._banned)} заблокировано")
+
+    def is_known(self, user_id):
+        with self._lock:
+            return user_id in self._users
+
+    def is_current(self, user_id, username, first_name):
+        """True, если пользователь уже сохранен с такими же username и first_name и не помечен как заблокировавший бота."""
+        with self._lock:
+            return (self.loaded and self._users.get(user_id) == (username, first_name)
+                    and user_id not in self._bot_blocked)
+
+    def is_banned(self, user_id):
+        with self._lock:
+            return user_id in self._banned
+
+    def remember(self, user_id, username, first_name):
+        with self._lock:
+            self._users[user_id] = (username, first_name)
+            self._bot_blocked.discard(user_id)
+
+    def set_bot_blocked(self, user_ids):
+        with self._lock:
+            self._bot_blocked.update(user_ids)
+
+    def set_banned(self, user_id, banned):
+        with self._lock:
+            if banned:
+                self._banned.add(user_id)
+            else:
+                self._banned.discard(user_id)
+
+    def forget(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._banned.discard(user_id)
+            self._bot_blocked.discard(user_id)
+
+user_registry = UserRegistry()
+
+# --- КЭШ ССЫЛОК ---
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей и счетчиками попаданий.
+
+    При промахе get() возвращает номер поколения кэша; set() с устаревшим
+    поколением игнорируется, чтобы читатель не вернул в кэш данные,
+    инвалидированные параллельной записью.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Возвращает (True, значение) при попадании или (False, поколение) при промахе."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, self._generation
+
+    def set(self, key, value, generation, ttl=None):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def metrics(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+link_cache = TTLCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+
+def invalidate_link(link_id):
+    """Сбрасывает закэшированные данные ссылки после ее изменения."""
+    link_cache.invalidate(('info', link_id), ('owner', link_id))
+
+def cached_link_query(kind, query, link_id):
+    """Читает строку ссылки через link_cache.
+
+    Ошибка БД не кэшируется, иначе рабочая ссылка считалась бы несуществующей весь TTL;
+    отсутствующая ссылка кэшируется только на LINK_CACHE_NEGATIVE_TTL.
+    """
+    found, value = link_cache.get((kind, link_id))
+    if found:
+        return value
+    try:
+        result = db_pool.connection().execute(query, (link_id,)).fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка базы данных: {e}")
+        return None
+    link_cache.set((kind, link_id), result, value, ttl=LINK_CACHE_NEGATIVE_TTL if result is None else None)
+    return result
+
 def save_user(user_id, username, first_name):
-    run_query('INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)', 
-              (user_id, username, first_name), commit=True)
+    """Сохраняет пользователя. Пишет в БД только для новых пользователей или при смене имени.
+
+    Пользователь, который снова пишет боту, больше не считается заблокировавшим его.
+    """
+    if user_registry.is_current(user_id, username, first_name):
+        return
+    result = run_query('''
+        INSERT INTO users (user_id, username, first_name, created_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+                                           bot_blocked = 0
+    ''', (user_id, username, first_name, db_timestamp()), commit=True)
+    if result is not None:
+        user_registry.remember(user_id, username, first_name)
 
 def create_anon_link(user_id, title, description, is_sponsor=False, sponsor_owner_id=None, custom_id=None):
     if custom_id:
@@ -215,55 +1620,65 @@ def create_anon_link(user_id, title, description, is_sponsor=False, sponsor_owne
         link_id = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(10))
     
     expires_at = datetime.now() + timedelta(days=365)
-    run_query('INSERT INTO links (link_id, user_id, title, description, expires_at, is_sponsor, sponsor_owner_id, custom_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', 
-              (link_id, user_id, title, description, expires_at, is_sponsor, sponsor_owner_id, custom_id), commit=True)
-    push_db_to_github(f"Create link for user {user_id}")
+    run_query('INSERT INTO links (link_id, user_id, title, description, created_at, expires_at, is_sponsor, sponsor_owner_id, custom_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+              (link_id, user_id, title, description, db_timestamp(), expires_at, is_sponsor, sponsor_owner_id, custom_id), commit=True)
+    invalidate_link(link_id)
+    mark_db_dirty(f"Create link for user {user_id}")
     return link_id
 
 def save_message(link_id, from_user_id, to_user_id, message_text, message_type='text', file_id=None, file_size=None, file_name=None):
     message_id = run_query(
-        'INSERT INTO messages (link_id, from_user_id, to_user_id, message_text, message_type, file_id, file_size, file_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', 
-        (link_id, from_user_id, to_user_id, message_text, message_type, file_id, file_size, file_name), 
+        'INSERT INTO messages (link_id, from_user_id, to_user_id, message_text, message_type, file_id, file_size, file_name, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+        (link_id, from_user_id, to_user_id, message_text, message_type, file_id, file_size, file_name, db_timestamp()), 
         commit=True
     )
-    push_db_to_github(f"Save message from {from_user_id} to {to_user_id}")
+    mark_db_dirty(f"Save message from {from_user_id} to {to_user_id}")
     return message_id
 
 def save_reply(message_id, from_user_id, reply_text):
-    run_query('INSERT INTO replies (message_id, from_user_id, reply_text) VALUES (?, ?, ?)', 
-              (message_id, from_user_id, reply_text), commit=True)
-    push_db_to_github(f"Save reply to message {message_id}")
+    run_query('INSERT INTO replies (message_id, from_user_id, reply_text, created_at) VALUES (?, ?, ?, ?)', 
+              (message_id, from_user_id, reply_text, db_timestamp()), commit=True)
+    mark_db_dirty(f"Save reply to message {message_id}")
 
 def save_admin_message(from_admin_id, to_user_id, message_text):
-    run_query('INSERT INTO admin_messages (from_admin_id, to_user_id, message_text) VALUES (?, ?, ?)', 
-              (from_admin_id, to_user_id, message_text), commit=True)
-    push_db_to_github(f"Save admin message to user {to_user_id}")
+    run_query('INSERT INTO admin_messages (from_admin_id, to_user_id, message_text, created_at) VALUES (?, ?, ?, ?)', 
+              (from_admin_id, to_user_id, message_text, db_timestamp()), commit=True)
+    mark_db_dirty(f"Save admin message to user {to_user_id}")
 
 def get_link_info(link_id):
-    return run_query('SELECT l.link_id, l.user_id, l.title, l.description, u.username FROM links l LEFT JOIN users u ON l.user_id = u.user_id WHERE l.link_id = ? AND l.is_active = 1', (link_id,), fetch="one")
+    return cached_link_query('info', LINK_INFO_SQL, link_id)
 
 def get_user_links(user_id):
-    return run_query('SELECT link_id, title, description, created_at FROM links WHERE user_id = ? AND is_active = 1', (user_id,), fetch="all")
+    return run_query(USER_LINKS_SQL, (user_id,), fetch="all")
 
-def get_user_messages_with_replies(user_id, limit=50):
-    return run_query('''
-        SELECT m.message_id, m.message_text, m.message_type, m.file_id, m.file_size, m.file_name, 
-               m.created_at, l.title as link_title, l.link_id,
-               (SELECT COUNT(*) FROM replies r WHERE r.message_id = m.message_id AND r.is_active = 1) as reply_count
-        FROM messages m 
-        JOIN links l ON m.link_id = l.link_id 
-        WHERE m.to_user_id = ? AND m.is_active = 1
-        ORDER BY m.created_at DESC LIMIT ?
-    ''', (user_id, limit), fetch="all")
+def get_user_messages_page(user_id, cursor=None, direction="next", limit=None):
+    """Возвращает одну страницу входящих сообщений пользователя (новые сверху).
+
+    Пагинация по ключу (created_at, message_id) через idx_messages_to_user,
+    текст обрезается в запросе до длины превью.
+    Строки: message_id, preview, message_type, created_at, link_title.
+    Возвращает (rows, has_prev, has_next).
+    """
+    limit = limit or MESSAGES_PAGE_SIZE
+    if cursor is None:
+        rows = run_query(USER_MESSAGES_FIRST_SQL, (MESSAGE_PREVIEW_LENGTH + 1, user_id, limit + 1), fetch="all") or []
+        return rows[:limit], False, len(rows) > limit
+    if direction == "prev":
+        rows = run_query(USER_MESSAGES_NEWER_SQL, (MESSAGE_PREVIEW_LENGTH + 1, user_id, *cursor, limit + 1), fetch="all") or []
+        return list(reversed(rows[:limit])), len(rows) > limit, True
+    rows = run_query(USER_MESSAGES_OLDER_SQL, (MESSAGE_PREVIEW_LENGTH + 1, user_id, *cursor, limit + 1), fetch="all") or []
+    return rows[:limit], True, len(rows) > limit
+
+def get_reply_counts(message_ids):
+    """Возвращает {message_id: число активных ответов} одним сгруппированным запросом."""
+    if not message_ids:
+        return {}
+    placeholders = ",".join("?" * len(message_ids))
+    rows = run_query(REPLY_COUNTS_SQL.format(placeholders=placeholders), tuple(message_ids), fetch="all") or []
+    return dict(rows)
 
 def get_message_replies(message_id):
-    return run_query('''
-        SELECT r.reply_id, r.reply_text, r.created_at, u.username, u.first_name
-        FROM replies r
-        LEFT JOIN users u ON r.from_user_id = u.user_id
-        WHERE r.message_id = ? AND r.is_active = 1
-        ORDER BY r.created_at ASC
-    ''', (message_id,), fetch="all")
+    return run_query(MESSAGE_REPLIES_SQL, (message_id,), fetch="all")
 
 def get_conversation_for_link(link_id):
     """Получает полную переписку по ссылке"""
@@ -314,9 +1729,9 @@ def get_conversation_for_link(link_id):
         ORDER BY created_at ASC
     ''', (link_id, link_id), fetch="all")
 
-def get_conversation_for_user(user_id):
-    """Получает полную переписку пользователя"""
-    return run_query('''
+def iter_conversation_for_user(user_id):
+    """Построчно отдает полную переписку пользователя: сообщение и по строке на каждый ответ к нему"""
+    return iter_query('''
         SELECT 
             m.message_id,
             m.message_text,
@@ -340,7 +1755,8 @@ def get_conversation_for_user(user_id):
             CASE 
                 WHEN r.reply_id IS NOT NULL THEN 'reply'
                 ELSE 'message'
-            END as type
+            END as type,
+            r.created_at as reply_created_at
         FROM messages m
         LEFT JOIN users u_from ON m.from_user_id = u_from.user_id
         LEFT JOIN users u_to ON m.to_user_id = u_to.user_id
@@ -349,85 +1765,372 @@ def get_conversation_for_user(user_id):
         LEFT JOIN users u_reply ON r.from_user_id = u_reply.user_id
         WHERE (m.from_user_id = ? OR m.to_user_id = ? OR r.from_user_id = ?) 
           AND m.is_active = 1
-        ORDER BY m.created_at ASC, r.created_at ASC
-    ''', (user_id, user_id, user_id), fetch="all")
+        ORDER BY m.created_at ASC, m.message_id ASC, r.created_at ASC
+    ''', (user_id, user_id, user_id))
 
-def get_all_users_for_admin():
-    result = run_query("SELECT user_id, username, first_name, created_at, is_banned, ban_reason FROM users ORDER BY created_at DESC", fetch="all")
-    return result or []
+# --- ЗАДАНИЯ РАССЫЛКИ ---
 
-def get_user_links_for_admin(user_id):
-    result = run_query('''
-        SELECT l.link_id, l.title, l.description, l.created_at,
-               (SELECT COUNT(*) FROM messages m WHERE m.link_id = l.link_id AND m.is_active = 1) as message_count
-        FROM links l
-        WHERE l.user_id = ? AND l.is_active = 1
-        ORDER BY l.created_at DESC
-    ''', (user_id,), fetch="all")
-    return result or []
+def create_broadcast_job(admin_id, message_text, progress_chat_id, progress_message_id):
+    """Создает задание рассылки и список получателей (без забаненных и заблокировавших бота)."""
+    with db_transaction() as cursor:
+        cursor.execute(
+            'INSERT INTO broadcast_jobs (admin_id, message_text, progress_chat_id, progress_message_id, created_at) VALUES (?, ?, ?, ?, ?)',
+            (admin_id, message_text, progress_chat_id, progress_message_id, db_timestamp())
+        )
+        job_id = cursor.lastrowid
+        cursor.execute('''
+            INSERT INTO broadcast_recipients (job_id, user_id)
+            SELECT ?, user_id FROM users
+            WHERE COALESCE(is_banned, 0) = 0 AND COALESCE(bot_blocked, 0) = 0
+        ''', (job_id,))
+    mark_db_dirty(f"Create broadcast job {job_id}")
+    return job_id
 
-def get_admin_stats():
-    stats = {}
-    try:
-        stats['users'] = run_query("SELECT COUNT(*) FROM users", fetch="one")[0] or 0
-        stats['links'] = run_query("SELECT COUNT(*) FROM links WHERE is_active = 1", fetch="one")[0] or 0
-        stats['messages'] = run_query("SELECT COUNT(*) FROM messages WHERE is_active = 1", fetch="one")[0] or 0
-        stats['replies'] = run_query("SELECT COUNT(*) FROM replies WHERE is_active = 1", fetch="one")[0] or 0
-        
-        stats['photos'] = run_query("SELECT COUNT(*) FROM messages WHERE message_type = 'photo' AND is_active = 1", fetch="one")[0] or 0
-        stats['videos'] = run_query("SELECT COUNT(*) FROM messages WHERE message_type = 'video' AND is_active = 1", fetch="one")[0] or 0
-        stats['documents'] = run_query("SELECT COUNT(*) FROM messages WHERE message_type = 'document' AND is_active = 1", fetch="one")[0] or 0
-        stats['voice'] = run_query("SELECT COUNT(*) FROM messages WHERE message_type = 'voice' AND is_active = 1", fetch="one")[0] or 0
-        stats['video_note'] = run_query("SELECT COUNT(*) FROM messages WHERE message_type = 'video_note' AND is_active = 1", fetch="one")[0] or 0
-        
-        stats['banned'] = run_query("SELECT COUNT(*) FROM users WHERE is_banned = 1", fetch="one")[0] or 0
-        stats['sponsor_links'] = run_query("SELECT COUNT(*) FROM links WHERE is_sponsor = 1", fetch="one")[0] or 0
-    except Exception as e:
-        logging.error(f"Ошибка при получении статистики: {e}")
-        stats = {'users': 0, 'links': 0, 'messages': 0, 'replies': 0, 'photos': 0, 'videos': 0, 'documents': 0, 'voice': 0, 'video_note': 0, 'banned': 0, 'sponsor_links': 0}
-    
-    return stats
+def get_pending_broadcast_recipients(job_id, after_user_id=0, limit=500):
+    """Следующая пачка получателей, которым еще не отправлено сообщение."""
+    rows = run_query('''
+        SELECT user_id FROM broadcast_recipients
+        WHERE job_id = ? AND status = 'pending' AND user_id > ?
+        ORDER BY user_id LIMIT ?
+    ''', (job_id, after_user_id, limit), fetch="all")
+    return [row[0] for row in rows or []]
+
+def save_broadcast_results(job_id, results):
+    """Сохраняет контрольную точку: results - список (user_id, status, error)."""
+    if not results:
+        return
+    with db_transaction() as cursor:
+        cursor.executemany(
+            'UPDATE broadcast_recipients SET status = ?, error = ? WHERE job_id = ? AND user_id = ?',
+            [(status, error, job_id, user_id) for user_id, status, error in results]
+        )
+        blocked = [(user_id,) for user_id, status, _ in results if status == 'blocked']
+        if blocked:
+            cursor.executemany('UPDATE users SET bot_blocked = 1 WHERE user_id = ?', blocked)
+    if blocked:
+        user_registry.set_bot_blocked(user_id for (user_id,) in blocked)
+    mark_db_dirty(f"Broadcast job {job_id}: {len(results)} deliveries")
+
+def get_broadcast_job_counts(job_id):
+    rows = run_query('SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status',
+                     (job_id,), fetch="all")
+    counts = {'pending': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+    counts.update(dict(rows or []))
+    return counts
+
+def finish_broadcast_job(job_id):
+    run_query("UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE job_id = ?",
+              (db_timestamp(), job_id), commit=True)
+    mark_db_dirty(f"Finish broadcast job {job_id}")
+
+def get_unfinished_broadcast_jobs():
+    return run_query('''
+        SELECT job_id, message_text, progress_chat_id, progress_message_id
+        FROM broadcast_jobs WHERE status = 'running'
+    ''', fetch="all") or []
+
+# --- ФУНКЦИИ ДЛЯ ОЧЕРЕДИ ОТПРАВКИ ---
+
+def enqueue_outbox(chat_id, method, payload):
+    """Ставит сообщение в сохраняемую очередь отправки.
+
+    Ошибка записи пробрасывается: отправитель не должен получить "отправлено",
+    если уведомление не попало в очередь.
+    """
+    now = time.time()
+    with db_transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO outbox (chat_id, method, payload, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (chat_id, method, payload, now, now))
+    mark_db_dirty(f"Queue {method} to {chat_id}")
+
+# Первое неотправленное сообщение чата; следующие сообщения этого чата ждут его отправки
+OUTBOX_HEAD_FILTER = '''
+    o.status = 'pending' AND NOT EXISTS (
+        SELECT 1 FROM outbox p
+        WHERE p.chat_id = o.chat_id AND p.status = 'pending' AND p.id < o.id
+    )
+'''
+
+def get_due_outbox(now, limit):
+    """Первые неотправленные сообщения каждого чата, время которых подошло.
+
+    Следующее сообщение чата не выдается, пока не отправлено предыдущее, поэтому порядок
+    доставки в один чат сохраняется даже при повторных попытках.
+    """
+    return run_query(f'''
+        SELECT o.id, o.chat_id, o.method, o.payload, o.attempts
+        FROM outbox o
+        WHERE {OUTBOX_HEAD_FILTER} AND o.next_attempt_at <= ?
+        ORDER BY o.id
+        LIMIT ?
+    ''', (now, limit), fetch="all") or []
+
+def next_outbox_due():
+    """Ближайшее время попытки среди тех же сообщений, что выдает get_due_outbox.
+
+    Сообщение за головой очереди чата может быть "готово" раньше головы, но выдано
+    не будет; если учитывать его, отправитель просыпался бы без работы в цикле.
+    """
+    result = run_query(f"SELECT MIN(o.next_attempt_at) FROM outbox o WHERE {OUTBOX_HEAD_FILTER}", fetch="one")
+    return result[0] if result else None
+
+def purge_failed_outbox(cutoff):
+    """Удаляет недоставленные сообщения, поставленные в очередь раньше cutoff."""
+    with db_transaction() as cursor:
+        purged = cursor.execute("DELETE FROM outbox WHERE status = 'failed' AND created_at < ?", (cutoff,)).rowcount
+    if purged:
+        mark_db_dirty(f"Purge {purged} undelivered queued messages")
+    return purged
+
+def get_outbox_counts():
+    rows = run_query("SELECT status, COUNT(*) FROM outbox GROUP BY status", fetch="all")
+    counts = {'pending': 0, 'failed': 0}
+    counts.update(dict(rows or []))
+    return counts
+
+def complete_outbox(results):
+    """Сохраняет итоги отправки: sent — удалить, retry/delay — перенести, failed — оставить с ошибкой."""
+    with db_transaction() as cursor:
+        for outbox_id, outcome, error, next_attempt_at in results:
+            if outcome == 'sent':
+                cursor.execute('DELETE FROM outbox WHERE id = ?', (outbox_id,))
+            elif outcome == 'failed':
+                cursor.execute("UPDATE outbox SET status = 'failed', error = ? WHERE id = ?", (error, outbox_id))
+            else:
+                # delay (RetryAfter) не расходует попытку, retry (сетевая ошибка) — расходует
+                cursor.execute('''
+                    UPDATE outbox SET attempts = attempts + ?, next_attempt_at = ?, error = ? WHERE id = ?
+                ''', (1 if outcome == 'retry' else 0, next_attempt_at, error, outbox_id))
+    mark_db_dirty(f"Deliver {len(results)} queued messages")
+
+def get_admin_users_page(cursor=None, direction="next", limit=None):
+    """Возвращает одну страницу пользователей для админки (новые сверху).
+
+    Пагинация по ключу (created_at, user_id): cursor — ключ крайней строки
+    текущей страницы, direction — "next" (старше) или "prev" (новее).
+    Читается не больше limit + 1 строк по индексу idx_users_created.
+    Возвращает (rows, has_prev, has_next).
+    """
+    limit = limit or ADMIN_USERS_PAGE_SIZE
+    if cursor is None:
+        rows = run_query(ADMIN_USERS_FIRST_SQL, (limit + 1,), fetch="all") or []
+        return rows[:limit], False, len(rows) > limit
+    if direction == "prev":
+        rows = run_query(ADMIN_USERS_NEWER_SQL, (*cursor, limit + 1), fetch="all") or []
+        return list(reversed(rows[:limit])), len(rows) > limit, True
+    rows = run_query(ADMIN_USERS_OLDER_SQL, (*cursor, limit + 1), fetch="all") or []
+    return rows[:limit], True, len(rows) > limit
+
+def get_user_links_for_admin(user_id):
+    result = run_query(ADMIN_USER_LINKS_SQL, (user_id,), fetch="all")
+    return result or []
+
+def get_admin_stats():
+    """Возвращает статистику из счетчиков stats_counters (поддерживаются триггерами)."""
+    stats = {}
+    try:
+        counters = dict(run_query("SELECT key, value FROM stats_counters", fetch="all"))
+        for key in ('users', 'links', 'messages', 'replies', 'banned', 'sponsor_links'):
+            stats[key] = counters.get(key, 0)
+        
+        stats['photos'] = counters.get('type:photo', 0)
+        stats['videos'] = counters.get('type:video', 0)
+        stats['documents'] = counters.get('type:document', 0)
+        stats['voice'] = counters.get('type:voice', 0)
+        stats['video_note'] = counters.get('type:video_note', 0)
+    except Exception as e:
+        logging.error(f"Ошибка при получении статистики: {e}")
+        stats = {'users': 0, 'links': 0, 'messages': 0, 'replies': 0, 'photos': 0, 'videos': 0, 'documents': 0, 'voice': 0, 'video_note': 0, 'banned': 0, 'sponsor_links': 0}
+    
+    return stats
+
+# --- СОСТОЯНИЕ ДИАЛОГОВ ---
+
+# Ключи user_data, которые живут только в памяти процесса. БД с user_state пушится в GitHub,
+# поэтому вход в админку не должен переживать перезапуск и попадать в историю репозитория
+TRANSIENT_USER_KEYS = frozenset({'admin_authenticated'})
+
+def persistent_user_data(data):
+    """Копия user_data без ключей из TRANSIENT_USER_KEYS."""
+    return {key: value for key, value in data.items() if key not in TRANSIENT_USER_KEYS}
+
+def load_user_states(ttl):
+    """Загружает сохраненные user_data, удаляя состояния старше ttl секунд.
+
+    Ключи из TRANSIENT_USER_KEYS, сохраненные прежними версиями, вычищаются из БД.
+    """
+    cutoff = time.time() - ttl
+    states = {}
+    scrubbed = 0
+    with db_transaction() as cursor:
+        cursor.execute('DELETE FROM user_state WHERE updated_at < ?', (cutoff,))
+        rows = cursor.execute('SELECT user_id, data FROM user_state').fetchall()
+        for user_id, data in rows:
+            try:
+                state = json.loads(data)
+            except ValueError:
+                logging.warning(f"Поврежденное состояние пользователя {user_id} пропущено")
+                continue
+            cleaned = persistent_user_data(state)
+            if len(cleaned) != len(state):
+                scrubbed += 1
+                if cleaned:
+                    cursor.execute('UPDATE user_state SET data = ? WHERE user_id = ?',
+                                   (json.dumps(cleaned, ensure_ascii=False, default=str), user_id))
+                else:
+                    cursor.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+            if cleaned:
+                states[user_id] = cleaned
+    if scrubbed:
+        mark_db_dirty(f"Drop transient dialog state for {scrubbed} users")
+    return states
+
+def save_user_states(states):
+    """Сохраняет пачку user_data одной транзакцией: пустые состояния удаляются."""
+    now = time.time()
+    with db_transaction() as cursor:
+        for user_id, data in states.items():
+            if data:
+                cursor.execute('''
+                    INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                ''', (user_id, json.dumps(data, ensure_ascii=False, default=str), now))
+            else:
+                cursor.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+    mark_db_dirty(f"Save dialog state for {len(states)} users")
+
+class SQLitePersistence(BasePersistence):
+    """Хранит context.user_data в таблице user_state той же SQLite БД.
+
+    PTB вызывает update_user_data раз в update_interval секунд только для измененных
+    пользователей; изменения копятся в памяти и пишутся одной транзакцией в фоне,
+    поэтому обработка обновления не ждет записи в БД. Состояния без активности дольше
+    ttl секунд сбрасываются: при загрузке и при следующем обновлении пользователя.
+    Ключи из TRANSIENT_USER_KEYS (вход в админку) не сохраняются.
+    Остальные данные PTB (chat_data, bot_data, callback_data) не сохраняются.
+    """
+
+    def __init__(self, ttl=USER_STATE_TTL, update_interval=USER_STATE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.ttl = ttl
+        self._pending = {}
+        self._flush_task = None
+        self._last_seen = {}
+
+    async def get_user_data(self):
+        states = await db.write(load_user_states, self.ttl)
+        now = time.time()
+        self._last_seen = {user_id: now for user_id in states}
+        logging.info(f"Восстановлено состояние диалогов: {len(states)} пользователей")
+        return states
+
+    async def update_user_data(self, user_id, data):
+        self._pending[user_id] = persistent_user_data(data)
+        # Все вызовы одного цикла сохранения PTB попадают в одну транзакцию
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            await db.write(save_user_states, batch)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения состояния диалогов: {e}")
+            # Вернем в очередь, если за это время не пришло более свежее состояние
+            for user_id, data in batch.items():
+                self._pending.setdefault(user_id, data)
+
+    async def refresh_user_data(self, user_id, user_data):
+        now = time.time()
+        last_seen = self._last_seen.get(user_id)
+        if last_seen is not None and now - last_seen > self.ttl and user_data:
+            logging.info(f"Состояние пользователя {user_id} устарело и сброшено")
+            user_data.clear()
+        if user_data:
+            self._last_seen[user_id] = now
+        else:
+            self._last_seen.pop(user_id, None)
+
+    async def drop_user_data(self, user_id):
+        self._last_seen.pop(user_id, None)
+        await self.update_user_data(user_id, {})
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+
+    # chat_data, bot_data, callback_data и ConversationHandler не используются
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ ---
 
 def ban_user(user_id, reason=None):
     """Блокирует пользователя"""
-    return run_query('UPDATE users SET is_banned = 1, ban_reason = ? WHERE user_id = ?', 
-                    (reason, user_id), commit=True)
+    result = run_query('UPDATE users SET is_banned = 1, ban_reason = ? WHERE user_id = ?', 
+                       (reason, user_id), commit=True)
+    if result is None:
+        return False
+    if user_registry.is_known(user_id):
+        user_registry.set_banned(user_id, True)
+    mark_db_dirty(f"Ban user {user_id}")
+    return True
 
 def unban_user(user_id):
     """Разблокирует пользователя"""
-    return run_query('UPDATE users SET is_banned = 0, ban_reason = NULL WHERE user_id = ?', 
-                    (user_id,), commit=True)
-
-def delete_user(user_id):
-    """Полностью удаляет пользователя и все его данные"""
-    try:
-        # Получаем все ссылки пользователя
-        user_links = get_user_links_for_admin(user_id)
-        
-        # Удаляем все ссылки пользователя
-        for link in user_links:
-            delete_link_completely(link[0])
-        
-        # Удаляем сообщения пользователя
-        run_query('DELETE FROM messages WHERE from_user_id = ? OR to_user_id = ?', (user_id, user_id), commit=True)
-        
-        # Удаляем ответы пользователя
-        run_query('DELETE FROM replies WHERE from_user_id = ?', (user_id,), commit=True)
-        
-        # Удаляем пользователя
-        run_query('DELETE FROM users WHERE user_id = ?', (user_id,), commit=True)
-        
-        push_db_to_github(f"Completely delete user {user_id}")
-        return True
-    except Exception as e:
-        logging.error(f"Ошибка при удалении пользователя: {e}")
+    result = run_query('UPDATE users SET is_banned = 0, ban_reason = NULL WHERE user_id = ?', 
+                       (user_id,), commit=True)
+    if result is None:
         return False
+    user_registry.set_banned(user_id, False)
+    mark_db_dirty(f"Unban user {user_id}")
+    return True
 
 def is_user_banned(user_id):
     """Проверяет, забанен ли пользователь"""
-    result = run_query('SELECT is_banned FROM users WHERE user_id = ?', (user_id,), fetch="one")
+    if user_registry.loaded:
+        return user_registry.is_banned(user_id)
+    result = run_query(USER_BANNED_SQL, (user_id,), fetch="one")
     return result and result[0] == 1
 
 def create_sponsor_link(admin_id, title, description, target_user_id=None, custom_id=None):
@@ -436,49 +2139,113 @@ def create_sponsor_link(admin_id, title, description, target_user_id=None, custo
 
 def get_sponsor_links(admin_id):
     """Получает спонсорские ссылки админа"""
-    return run_query('SELECT link_id, title, description, created_at, user_id, custom_id FROM links WHERE is_sponsor = 1 AND sponsor_owner_id = ?', (admin_id,), fetch="all")
+    return run_query(SPONSOR_LINKS_SQL, (admin_id,), fetch="all")
 
 def transfer_sponsor_link(link_id, new_user_id):
-    """Передает спонсорскую ссылку другому пользователю"""
-    return run_query('UPDATE links SET user_id = ? WHERE link_id = ?', (new_user_id, link_id), commit=True)
+    """Передает спонсорскую ссылку другому пользователю. Возвращает True, если ссылка найдена и передана."""
+    try:
+        with db_transaction() as cursor:
+            # lastrowid у UPDATE всегда 0, успех определяем по числу измененных строк
+            transferred = cursor.execute('UPDATE links SET user_id = ? WHERE link_id = ?',
+                                         (new_user_id, link_id)).rowcount > 0
+    except Exception as e:
+        logging.error(f"Ошибка при передаче спонсорской ссылки: {e}")
+        return False
+    if transferred:
+        invalidate_link(link_id)
+        mark_db_dirty(f"Transfer sponsor link {link_id} to user {new_user_id}")
+    return transferred
 
 # --- ФУНКЦИИ УДАЛЕНИЯ ---
 
+# Каскадное удаление: ответы -> сообщения -> ссылки -> пользователь.
+# Каждый шаг — один DELETE по набору строк через подзапрос, все шаги в одной транзакции.
+# Шаги каскада: (таблица, запрос, фрагменты плана, обязательные для check_query_plans)
+USER_CASCADE = (
+    ('replies', "DELETE FROM replies WHERE message_id IN (SELECT m.message_id FROM messages m JOIN links l ON m.link_id = l.link_id WHERE l.user_id = :id)",
+     ['idx_replies_message (message_id=?)', 'idx_links_user_created (user_id=?)', 'idx_messages_link (link_id=?)']),
+    ('replies', "DELETE FROM replies WHERE message_id IN (SELECT message_id FROM messages WHERE from_user_id = :id UNION ALL SELECT message_id FROM messages WHERE to_user_id = :id)",
+     ['idx_replies_message (message_id=?)', 'idx_messages_from_user (from_user_id=?)', 'idx_messages_to_user (to_user_id=?)']),
+    ('replies', "DELETE FROM replies WHERE from_user_id = :id", ['idx_replies_from_user (from_user_id=?)']),
+    ('messages', "DELETE FROM messages WHERE link_id IN (SELECT link_id FROM links WHERE user_id = :id)",
+     ['idx_messages_link (link_id=?)', 'idx_links_user_created (user_id=?)']),
+    ('messages', "DELETE FROM messages WHERE from_user_id = :id", ['idx_messages_from_user (from_user_id=?)']),
+    ('messages', "DELETE FROM messages WHERE to_user_id = :id", ['idx_messages_to_user (to_user_id=?)']),
+    ('links', "DELETE FROM links WHERE user_id = :id", ['idx_links_user_created (user_id=?)']),
+    ('users', "DELETE FROM users WHERE user_id = :id", ['users USING INTEGER PRIMARY KEY (rowid=?)']),
+    ('user_state', "DELETE FROM user_state WHERE user_id = :id", ['user_state USING INTEGER PRIMARY KEY (rowid=?)']),
+)
+
+LINK_CASCADE = (
+    ('replies', "DELETE FROM replies WHERE message_id IN (SELECT message_id FROM messages WHERE link_id = :id)",
+     ['idx_replies_message (message_id=?)', 'idx_messages_link (link_id=?)']),
+    ('messages', "DELETE FROM messages WHERE link_id = :id", ['idx_messages_link (link_id=?)']),
+    ('links', "DELETE FROM links WHERE link_id = :id", ['sqlite_autoindex_links_1 (link_id=?)']),
+)
+
+MESSAGE_CASCADE = (
+    ('replies', "DELETE FROM replies WHERE message_id = :id", ['idx_replies_message (message_id=?)']),
+    ('messages', "DELETE FROM messages WHERE message_id = :id", ['messages USING INTEGER PRIMARY KEY (rowid=?)']),
+)
+
+for _name, _steps in (('user', USER_CASCADE), ('link', LINK_CASCADE), ('message', MESSAGE_CASCADE)):
+    for _i, (_table, _query, _expected) in enumerate(_steps):
+        HOT_QUERIES[f'delete_{_name}_{_i}'] = (_query, {'id': 1}, _expected)
+
+def _run_cascade(cursor, steps, item_id):
+    """Выполняет шаги каскада и возвращает число удаленных строк по таблицам."""
+    counts = {}
+    for table, query, _ in steps:
+        cursor.execute(query, {'id': item_id})
+        counts[table] = counts.get(table, 0) + cursor.rowcount
+    return counts
+
+def delete_user(user_id):
+    """Полностью удаляет пользователя и все его данные одной транзакцией.
+
+    Возвращает словарь {таблица: удалено строк} или None при ошибке.
+    """
+    try:
+        with db_transaction() as cursor:
+            link_ids = [row[0] for row in cursor.execute('SELECT link_id FROM links WHERE user_id = ?', (user_id,))]
+            counts = _run_cascade(cursor, USER_CASCADE, user_id)
+    except Exception as e:
+        logging.error(f"Ошибка при удалении пользователя: {e}")
+        return None
+    user_registry.forget(user_id)
+    for link_id in link_ids:
+        invalidate_link(link_id)
+    mark_db_dirty(f"Completely delete user {user_id}")
+    return counts
+
 def delete_link_completely(link_id):
-    """Полностью удаляет ссылку и все связанные данные"""
+    """Полностью удаляет ссылку и все связанные данные одной транзакцией.
+
+    Возвращает словарь {таблица: удалено строк} или None при ошибке.
+    """
     try:
-        # Удаляем ответы
-        run_query('''
-            DELETE FROM replies 
-            WHERE message_id IN (SELECT message_id FROM messages WHERE link_id = ?)
-        ''', (link_id,), commit=True)
-        
-        # Удаляем сообщения
-        run_query('DELETE FROM messages WHERE link_id = ?', (link_id,), commit=True)
-        
-        # Удаляем ссылку
-        run_query('DELETE FROM links WHERE link_id = ?', (link_id,), commit=True)
-        
-        push_db_to_github(f"Completely delete link {link_id}")
-        return True
+        with db_transaction() as cursor:
+            counts = _run_cascade(cursor, LINK_CASCADE, link_id)
     except Exception as e:
         logging.error(f"Ошибка при удалении ссылки: {e}")
-        return False
+        return None
+    invalidate_link(link_id)
+    mark_db_dirty(f"Completely delete link {link_id}")
+    return counts
 
 def delete_message_completely(message_id):
-    """Полностью удаляет сообщение и ответы"""
+    """Полностью удаляет сообщение и ответы одной транзакцией.
+
+    Возвращает словарь {таблица: удалено строк} или None при ошибке.
+    """
     try:
-        # Удаляем ответы
-        run_query('DELETE FROM replies WHERE message_id = ?', (message_id,), commit=True)
-        
-        # Удаляем сообщение
-        run_query('DELETE FROM messages WHERE message_id = ?', (message_id,), commit=True)
-        
-        push_db_to_github(f"Completely delete message {message_id}")
-        return True
+        with db_transaction() as cursor:
+            counts = _run_cascade(cursor, MESSAGE_CASCADE, message_id)
     except Exception as e:
         logging.error(f"Ошибка при удалении сообщения: {e}")
-        return False
+        return None
+    mark_db_dirty(f"Completely delete message {message_id}")
+    return counts
 
 def get_message_info(message_id):
     """Получает информацию о сообщении"""
@@ -486,7 +2253,7 @@ def get_message_info(message_id):
         SELECT m.message_text, m.message_type, m.file_name, m.created_at, 
                u_from.username as from_username, u_from.first_name as from_first_name,
                u_to.username as to_username, u_to.first_name as to_first_name,
-               l.title as link_title, l.link_id
+               l.title as link_title, l.link_id, m.from_user_id
         FROM messages m
         LEFT JOIN users u_from ON m.from_user_id = u_from.user_id
         LEFT JOIN users u_to ON m.to_user_id = u_to.user_id
@@ -496,83 +2263,89 @@ def get_message_info(message_id):
 
 def get_link_owner(link_id):
     """Получает владельца ссылки"""
-    return run_query('SELECT user_id FROM links WHERE link_id = ?', (link_id,), fetch="one")
+    return cached_link_query('owner', 'SELECT user_id FROM links WHERE link_id = ?', link_id)
 
 def get_message_owner(message_id):
     """Получает отправителя сообщения"""
     return run_query('SELECT from_user_id FROM messages WHERE message_id = ?', (message_id,), fetch="one")
 
-def get_all_data_for_html():
-    data = {}
-    try:
-        data['stats'] = get_admin_stats()
-        data['users'] = run_query('''
-            SELECT u.user_id, u.username, u.first_name, u.created_at, u.is_banned, u.ban_reason,
-                   (SELECT COUNT(*) FROM links l WHERE l.user_id = u.user_id AND l.is_active = 1) as link_count,
-                   (SELECT COUNT(*) FROM messages m WHERE m.to_user_id = u.user_id AND m.is_active = 1) as received_messages,
-                   (SELECT COUNT(*) FROM messages m WHERE m.from_user_id = u.user_id AND m.is_active = 1) as sent_messages
+class ReportDataProvider:
+    """Отдает данные для HTML отчета по секциям.
+
+    Каждая секция — отдельный запрос с LIMIT и только нужными столбцами,
+    строки читаются пачками по мере рендера. Тяжелые секции включаются флагами.
+    """
+
+    def __init__(self, users_limit=REPORT_USERS_LIMIT, links_limit=REPORT_LINKS_LIMIT,
+                 messages_limit=REPORT_MESSAGES_LIMIT, include_conversations=REPORT_INCLUDE_CONVERSATIONS,
+                 conversations_limit=REPORT_CONVERSATIONS_LIMIT):
+        self.users_limit = users_limit
+        self.links_limit = links_limit
+        self.messages_limit = messages_limit
+        self.include_conversations = include_conversations
+        self.conversations_limit = conversations_limit
+
+    def stats(self):
+        return get_admin_stats()
+
+    def users(self):
+        """user_id, username, first_name, created_at, is_banned, link_count, received, sent"""
+        return iter_query('''
+            SELECT u.user_id, u.username, u.first_name, u.created_at, u.is_banned,
+                   (SELECT COUNT(*) FROM links l WHERE l.user_id = u.user_id AND l.is_active = 1),
+                   (SELECT COUNT(*) FROM messages m WHERE m.to_user_id = u.user_id AND m.is_active = 1),
+                   (SELECT COUNT(*) FROM messages m WHERE m.from_user_id = u.user_id AND m.is_active = 1)
             FROM users u
             ORDER BY u.created_at DESC
-        ''', fetch="all") or []
-        
-        data['links'] = run_query('''
-            SELECT l.link_id, l.title, l.description, l.created_at, l.expires_at, l.is_sponsor,
-                   u.username, u.first_name, u.user_id,
-                   (SELECT COUNT(*) FROM messages m WHERE m.link_id = l.link_id AND m.is_active = 1) as message_count
+            LIMIT ?
+        ''', (self.users_limit,))
+
+    def links(self):
+        """link_id, title, created_at, is_sponsor, username, first_name, user_id, message_count"""
+        return iter_query('''
+            SELECT l.link_id, l.title, l.created_at, l.is_sponsor,
+                   u.username, u.first_name, l.user_id,
+                   (SELECT COUNT(*) FROM messages m WHERE m.link_id = l.link_id AND m.is_active = 1)
             FROM links l
             LEFT JOIN users u ON l.user_id = u.user_id
             WHERE l.is_active = 1
             ORDER BY l.created_at DESC
-        ''', fetch="all") or []
-        
-        data['recent_messages'] = run_query('''
-            SELECT m.message_id, m.message_text, m.message_type, m.file_size, m.file_name, m.created_at,
-                   u_from.username as from_username, u_from.first_name as from_first_name, u_from.user_id as from_user_id,
-                   u_to.username as to_username, u_to.first_name as to_first_name, u_to.user_id as to_user_id,
-                   l.title as link_title, l.link_id
+            LIMIT ?
+        ''', (self.links_limit,))
+
+    def recent_messages(self):
+        """message_id, message_type, created_at, from_username, from_first_name, from_user_id,
+        to_username, to_first_name, to_user_id, link_title"""
+        return iter_query('''
+            SELECT m.message_id, m.message_type, m.created_at,
+                   u_from.username, u_from.first_name, m.from_user_id,
+                   u_to.username, u_to.first_name, m.to_user_id,
+                   l.title
             FROM messages m
             LEFT JOIN users u_from ON m.from_user_id = u_from.user_id
             LEFT JOIN users u_to ON m.to_user_id = u_to.user_id
             LEFT JOIN links l ON m.link_id = l.link_id
             WHERE m.is_active = 1
             ORDER BY m.created_at DESC
-            LIMIT 200
-        ''', fetch="all") or []
-        
-        # Новые данные для детального отчета
-        data['conversations'] = run_query('''
-            SELECT l.link_id, l.title, l.description, l.created_at,
-                   u.username, u.first_name, u.user_id,
-                   COUNT(m.message_id) as message_count,
-                   MAX(m.created_at) as last_activity
+            LIMIT ?
+        ''', (self.messages_limit,))
+
+    def conversations(self):
+        """link_id, title, username, first_name, user_id, message_count, last_activity"""
+        if not self.include_conversations:
+            return iter(())
+        return iter_query('''
+            SELECT l.link_id, l.title, u.username, u.first_name, l.user_id,
+                   COUNT(m.message_id) AS message_count,
+                   MAX(m.created_at) AS last_activity
             FROM links l
             LEFT JOIN users u ON l.user_id = u.user_id
             LEFT JOIN messages m ON l.link_id = m.link_id AND m.is_active = 1
             WHERE l.is_active = 1
             GROUP BY l.link_id
             ORDER BY last_activity DESC
-        ''', fetch="all") or []
-        
-        data['detailed_messages'] = run_query('''
-            SELECT m.message_id, m.message_text, m.message_type, m.file_size, m.file_name, m.created_at,
-                   u_from.username as from_username, u_from.first_name as from_first_name, u_from.user_id as from_user_id,
-                   u_to.username as to_username, u_to.first_name as to_first_name, u_to.user_id as to_user_id,
-                   l.title as link_title, l.link_id,
-                   (SELECT COUNT(*) FROM replies r WHERE r.message_id = m.message_id AND r.is_active = 1) as reply_count
-            FROM messages m
-            LEFT JOIN users u_from ON m.from_user_id = u_from.user_id
-            LEFT JOIN users u_to ON m.to_user_id = u_to.user_id
-            LEFT JOIN links l ON m.link_id = l.link_id
-            WHERE m.is_active = 1
-            ORDER BY m.created_at DESC
-            LIMIT 500
-        ''', fetch="all") or []
-        
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных для HTML: {e}")
-        data = {'stats': get_admin_stats(), 'users': [], 'links': [], 'recent_messages': [], 'conversations': [], 'detailed_messages': []}
-    
-    return data
+            LIMIT ?
+        ''', (self.conversations_limit,))
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
@@ -707,31 +2480,82 @@ def admin_keyboard():
 def user_management_keyboard(user_id):
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("🔗 Ссылки", callback_data=f"admin_user_links_{user_id}"),
-            InlineKeyboardButton("📨 Переписка", callback_data=f"admin_view_conversation_{user_id}")
+            InlineKeyboardButton("🔗 Ссылки", callback_data=pack_callback("admin_user_links_", user_id)),
+            InlineKeyboardButton("📨 Переписка", callback_data=pack_callback("admin_view_conversation_", user_id))
         ],
         [
-            InlineKeyboardButton("🚫 Забанить", callback_data=f"admin_ban_user_{user_id}"),
-            InlineKeyboardButton("✅ Разбанить", callback_data=f"admin_unban_user_{user_id}")
+            InlineKeyboardButton("🚫 Забанить", callback_data=pack_callback("admin_ban_user_", user_id)),
+            InlineKeyboardButton("✅ Разбанить", callback_data=pack_callback("admin_unban_user_", user_id))
         ],
         [
-            InlineKeyboardButton("🗑️ Удалить", callback_data=f"admin_delete_user_{user_id}"),
-            InlineKeyboardButton("✉️ Написать", callback_data=f"admin_message_user_{user_id}")
+            InlineKeyboardButton("🗑️ Удалить", callback_data=pack_callback("admin_delete_user_", user_id)),
+            InlineKeyboardButton("✉️ Написать", callback_data=pack_callback("admin_message_user_", user_id))
         ],
         [InlineKeyboardButton("🔙 Назад", callback_data="admin_users")]
     ])
 
+def page_navigation(prefix, first_key, last_key, has_prev, has_next):
+    """Кнопки листания для keyset-пагинации, параметр кнопки — <n|p>_<created_at>_<id>.
+
+    Ключ — (created_at, id) крайней строки страницы; created_at не содержит '_'.
+    Возвращает список кнопок (может быть пустым).
+    """
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=pack_callback(f"{prefix}_", f"p_{first_key[0]}_{first_key[1]}")))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Далее ➡️", callback_data=pack_callback(f"{prefix}_", f"n_{last_key[0]}_{last_key[1]}")))
+    return navigation
+
+def parse_page_param(raw):
+    """Разбирает <n|p>_<created_at>_<id> из кнопки листания в (cursor, direction)."""
+    direction, _, key = raw.partition("_")
+    created_at, _, row_id = key.rpartition("_")
+    if direction not in ("n", "p") or not created_at:
+        raise ValueError(f"Неверный курсор страницы: {raw}")
+    return (created_at, int(row_id)), "prev" if direction == "p" else "next"
+
+def admin_users_keyboard(users, has_prev, has_next):
+    keyboard_buttons = []
+    for u in users:
+        username_display = f"@{u[1]}" if u[1] else (u[2] or f"ID:{u[0]}")
+        keyboard_buttons.append([
+            InlineKeyboardButton(f"👤 {username_display}", callback_data=pack_callback("admin_user_manage_", u[0]))
+        ])
+
+    navigation = page_navigation("admin_users", (users[0][3], users[0][0]), (users[-1][3], users[-1][0]), has_prev, has_next)
+    if navigation:
+        keyboard_buttons.append(navigation)
+
+    keyboard_buttons.append([InlineKeyboardButton("🔙 Админ панель", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(keyboard_buttons)
+
+def my_messages_keyboard(messages, has_prev, has_next):
+    keyboard_buttons = []
+    for msg in messages:
+        keyboard_buttons.append([
+            InlineKeyboardButton(f"💬 Ответить {msg[4][:30]}", callback_data=pack_callback("reply_", msg[0])),
+            InlineKeyboardButton(f"🗑️ Удалить", callback_data=pack_callback("confirm_delete_message_", msg[0]))
+        ])
+
+    navigation = page_navigation("my_messages", (messages[0][3], messages[0][0]), (messages[-1][3], messages[-1][0]), has_prev, has_next)
+    if navigation:
+        keyboard_buttons.append(navigation)
+
+    keyboard_buttons.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(keyboard_buttons)
+
 def message_actions_keyboard(message_id):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💬 Ответить", callback_data=f"reply_{message_id}")],
-        [InlineKeyboardButton("🗑️ Удалить", callback_data=f"confirm_delete_message_{message_id}")],
+        [InlineKeyboardButton("💬 Ответить", callback_data=pack_callback("reply_", message_id))],
+        [InlineKeyboardButton("🗑️ Удалить", callback_data=pack_callback("confirm_delete_message_", message_id))],
         [InlineKeyboardButton("🔙 Назад", callback_data="my_messages")]
     ])
 
 def delete_confirmation_keyboard(item_type, item_id):
     """Клавиатура подтверждения удаления"""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_{item_type}_{item_id}")],
+        [InlineKeyboardButton("✅ Да, удалить", callback_data=pack_callback(f"delete_{item_type}_", item_id))],
         [InlineKeyboardButton("❌ Отмена", callback_data="cancel_delete")]
     ])
 
@@ -755,27 +2579,670 @@ def sponsor_links_keyboard():
 def sponsor_link_actions_keyboard(link_id):
     """Клавиатура действий для спонсорской ссылки"""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔄 Передать ссылку", callback_data=f"admin_transfer_sponsor_{link_id}")],
-        [InlineKeyboardButton("🗑️ Удалить ссылку", callback_data=f"admin_delete_sponsor_{link_id}")],
+        [InlineKeyboardButton("🔄 Передать ссылку", callback_data=pack_callback("admin_transfer_sponsor_", link_id))],
+        [InlineKeyboardButton("🗑️ Удалить ссылку", callback_data=pack_callback("admin_delete_sponsor_", link_id))],
         [InlineKeyboardButton("🔙 Назад", callback_data="admin_my_sponsor_links")]
     ])
 
+# --- РАССЫЛКА ---
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        self._refill(time.monotonic())
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def time_until(self, tokens=1):
+        """Сколько секунд ждать, пока накопится нужное число токенов."""
+        self._refill(time.monotonic())
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.time_until(tokens))
+
+# Один bucket на все исходящие сообщения бота: рассылка и уведомления вместе не превышают SEND_RATE
+send_bucket = TokenBucket(SEND_RATE, max(1, int(SEND_RATE)))
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after бывает числом или timedelta в зависимости от версии PTB."""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class BroadcastEngine:
+    """Фоновая рассылка по сохраненному заданию с ограничением скорости и учетом RetryAfter.
+
+    Статус каждого получателя сохраняется в broadcast_recipients контрольными точками,
+    поэтому после перезапуска рассылка продолжается с неотправленных получателей.
+    """
+
+    def __init__(self, bot, job_id, text, progress_chat_id, progress_message_id):
+        self.bot = bot
+        self.job_id = job_id
+        self.text = text
+        self.progress_chat_id = progress_chat_id
+        self.progress_message_id = progress_message_id
+        self.bucket = send_bucket
+        self._paused_until = 0.0
+        self._results = []
+        self._stopping = False
+        self.counts = {'pending': 0, 'sent': 0, 'failed': 0, 'blocked': 0}
+        self.started_at = None
+
+    def stop(self):
+        """Просит рассылку остановиться после текущих отправок; задание останется незавершенным."""
+        self._stopping = True
+
+    async def _wait_for_slot(self):
+        # После RetryAfter Telegram ограничивает весь бот, поэтому пауза общая для всех воркеров
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await self.bucket.acquire()
+
+    async def _send(self, user_id):
+        """Отправляет сообщение и возвращает (статус, ошибка)."""
+        error = None
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            await self._wait_for_slot()
+            try:
+                await self.bot.send_message(
+                    user_id,
+                    f"📢 *Оповещение от администратора*\n\n{self.text}",
+                    parse_mode='MarkdownV2'
+                )
+                return 'sent', None
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                error = str(e)
+                logging.warning(f"Рассылка: RetryAfter {delay}с")
+            except Forbidden as e:
+                # Пользователь заблокировал бота - в следующих рассылках он будет пропущен
+                return 'blocked', str(e)
+            except BadRequest as e:
+                logging.info(f"Рассылка: пользователь {user_id} недоступен: {e}")
+                return 'failed', str(e)
+            except (TimedOut, NetworkError) as e:
+                error = str(e)
+                logging.warning(f"Рассылка: сетевая ошибка для {user_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Ошибка отправки пользователю {user_id}: {e}")
+                return 'failed', str(e)
+        return 'failed', error
+
+    async def _worker(self, queue):
+        while not self._stopping:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status, error = await self._send(user_id)
+            self.counts['pending'] -= 1
+            self.counts[status] += 1
+            self._results.append((user_id, status, error))
+
+    async def _checkpoint(self):
+        results, self._results = self._results, []
+        if results:
+            await db.write(save_broadcast_results, self.job_id, results)
+
+    def _progress_text(self, finished=False):
+        sent, failed, blocked = self.counts['sent'], self.counts['failed'], self.counts['blocked']
+        total = sum(self.counts.values())
+        elapsed = time.monotonic() - self.started_at
+        if finished:
+            header = "✅ *Рассылка завершена\\!*"
+        else:
+            header = f"🔄 *Отправка рассылки\\.\\.\\.* {sent + failed + blocked}/{total}"
+        return (
+            f"{header}\n\n"
+            f"• 📨 Успешно отправлено\\: {sent}\n"
+            f"• ❌ Не удалось отправить\\: {failed}\n"
+            f"• 🚷 Заблокировали бота\\: {blocked}\n"
+            f"• ⏱ Время\\: {int(elapsed)} с"
+        )
+
+    async def _edit_progress(self, finished=False):
+        try:
+            await self.bot.edit_message_text(
+                self._progress_text(finished),
+                chat_id=self.progress_chat_id,
+                message_id=self.progress_message_id,
+                parse_mode='MarkdownV2',
+                reply_markup=admin_keyboard() if finished else None
+            )
+        except Exception as e:
+            logging.debug(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._checkpoint()
+            await self._edit_progress()
+
+    async def run(self):
+        self.started_at = time.monotonic()
+        self.counts = await db.read(get_broadcast_job_counts, self.job_id)
+        logging.info(f"Рассылка {self.job_id} запущена: осталось {self.counts['pending']} получателей")
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            last_user_id = 0
+            while not self._stopping:
+                batch = await db.read(get_pending_broadcast_recipients, self.job_id, last_user_id, BROADCAST_BATCH_SIZE)
+                if not batch:
+                    break
+                last_user_id = batch[-1]
+                queue = asyncio.Queue()
+                for user_id in batch:
+                    queue.put_nowait(user_id)
+                workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_CONCURRENCY)]
+                await asyncio.gather(*workers)
+                await self._checkpoint()
+        finally:
+            reporter.cancel()
+            await self._checkpoint()
+        if self._stopping:
+            logging.info(f"Рассылка {self.job_id} приостановлена до перезапуска: {self.counts}")
+            return
+        await db.write(finish_broadcast_job, self.job_id)
+        await self._edit_progress(finished=True)
+        logging.info(f"Рассылка {self.job_id} завершена: {self.counts}")
+
+# Запущенные рассылки; не через application.create_task, потому что Application.stop()
+# ждет такие задачи до конца, а рассылку нужно приостановить и продолжить после перезапуска
+active_broadcasts = {}
+
+def start_broadcast(engine):
+    task = asyncio.create_task(engine.run())
+    active_broadcasts[task] = engine
+    task.add_done_callback(lambda t: active_broadcasts.pop(t, None))
+    return task
+
+async def stop_broadcasts():
+    """Приостанавливает все рассылки, сохраняя контрольные точки."""
+    for engine in list(active_broadcasts.values()):
+        engine.stop()
+    if active_broadcasts:
+        await asyncio.gather(*active_broadcasts, return_exceptions=True)
+
+async def resume_broadcast_jobs(application: Application):
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    jobs = await db.read(get_unfinished_broadcast_jobs)
+    for job_id, message_text, chat_id, message_id in jobs:
+        logging.info(f"Возобновление рассылки {job_id}")
+        start_broadcast(BroadcastEngine(application.bot, job_id, message_text, chat_id, message_id))
+
+# --- ОЧЕРЕДЬ ОТПРАВКИ ---
+
+class OutboxSender:
+    """Доставляет уведомления из таблицы outbox в фоне.
+
+    Обработчик только сохраняет сообщение в очередь и сразу отвечает отправителю.
+    Очередь переживает перезапуск; сообщения в один чат уходят строго по порядку,
+    разные чаты — параллельно, с общим ограничением скорости. После RetryAfter
+    пауза общая для всего бота, сетевые ошибки повторяются с растущей задержкой.
+    Недоставленные сообщения хранятся OUTBOX_FAILED_RETENTION секунд и затем удаляются.
+    """
+
+    METHODS = {'send_message', 'send_photo', 'send_video', 'send_document', 'send_voice', 'send_video_note'}
+
+    def __init__(self):
+        self.bot = None
+        self.bucket = send_bucket
+        self._slots = None
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._paused_until = 0.0
+        self._purged_at = float('-inf')
+        self.counts = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    def start(self, bot):
+        self.bot = bot
+        self._slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дожидается текущих отправок; остальное останется в очереди до перезапуска."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def send(self, chat_id, method, **kwargs):
+        """Ставит вызов bot.<method>(chat_id, **kwargs) в очередь доставки."""
+        if method not in self.METHODS:
+            raise ValueError(f"Метод {method} не поддерживается очередью отправки")
+        if kwargs.get('reply_markup') is not None:
+            kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+        await db.write(enqueue_outbox, chat_id, method, json.dumps(kwargs, ensure_ascii=False))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                batch = await db.read(get_due_outbox, time.time(), OUTBOX_BATCH_SIZE)
+                if not batch:
+                    if time.monotonic() - self._purged_at >= OUTBOX_PURGE_INTERVAL:
+                        self._purged_at = time.monotonic()
+                        await db.write(purge_failed_outbox, time.time() - OUTBOX_FAILED_RETENTION)
+                    due = await db.read(next_outbox_due)
+                    timeout = None if due is None else max(0.0, due - time.time())
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                results = await asyncio.gather(*(self._deliver(*row) for row in batch))
+                await db.write(complete_outbox, results)
+            except Exception as e:
+                logging.error(f"Ошибка очереди отправки: {e}")
+                await asyncio.sleep(5)
+
+    async def _deliver(self, outbox_id, chat_id, method, payload, attempts):
+        """Отправляет одно сообщение и возвращает (id, итог, ошибка, время следующей попытки)."""
+        async with self._slots:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+            try:
+                kwargs = json.loads(payload)
+                if kwargs.get('reply_markup') is not None:
+                    kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], self.bot)
+                await getattr(self.bot, method)(chat_id, **kwargs)
+                self.counts['sent'] += 1
+                return outbox_id, 'sent', None, None
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logging.warning(f"Очередь отправки: RetryAfter {delay}с")
+                return outbox_id, 'delay', str(e), time.time() + delay
+            except (Forbidden, BadRequest) as e:
+                # Получатель заблокировал бота или сообщение некорректно — повтор не поможет
+                self.counts['failed'] += 1
+                logging.info(f"Очередь отправки: {method} в {chat_id} отклонен: {e}")
+                return outbox_id, 'failed', str(e), None
+            except Exception as e:
+                if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                    self.counts['failed'] += 1
+                    logging.error(f"Очередь отправки: {method} в {chat_id} не доставлен после {attempts + 1} попыток: {e}")
+                    return outbox_id, 'failed', str(e), None
+                self.counts['retried'] += 1
+                delay = min(2 ** attempts, OUTBOX_MAX_BACKOFF)
+                logging.warning(f"Очередь отправки: ошибка {method} в {chat_id}, повтор через {delay}с: {e}")
+                return outbox_id, 'retry', str(e), time.time() + delay
+
+    def metrics(self):
+        return dict(self.counts)
+
+outbox = OutboxSender()
+
+# --- ОБРАБОТКА ОБНОВЛЕНИЙ ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но обновления одного пользователя — строго по очереди.
+
+    Состояние диалогов (creating_link, replying_to, current_link, broadcasting...) хранится
+    в context.user_data, поэтому два обновления одного пользователя не должны выполняться
+    одновременно. Обновления разных пользователей обрабатываются параллельно, не более
+    workers одновременно; остальные ждут в очереди (до max_pending).
+    """
+
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING):
+        # Семафор базового класса ограничивает число ожидающих обновлений, а workers —
+        # число выполняемых. Слот worker'а берется только после блокировки пользователя,
+        # чтобы очередь одного пользователя не занимала слоты остальных.
+        super().__init__(max(max_pending, workers))
+        self.workers = workers
+        self._worker_slots = asyncio.BoundedSemaphore(workers)
+        self._locks = {}  # ключ -> [asyncio.Lock, число ожидающих]
+        self._active = 0
+        self._processed = 0
+
+    @staticmethod
+    def update_key(update):
+        """Ключ сериализации: пользователь, а если его нет — чат."""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            async with self._worker_slots:
+                await self._run(coroutine)
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._worker_slots:
+                    await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    async def _run(self, coroutine):
+        self._active += 1
+        try:
+            await coroutine
+        finally:
+            self._active -= 1
+            self._processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def metrics(self):
+        return {
+            'workers': self.workers,
+            'active': self._active,
+            'users_in_queue': len(self._locks),
+            'processed': self._processed,
+        }
+
+update_processor = PerUserUpdateProcessor()
+
+# --- ЗАЩИТА ОТ ФЛУДА ---
+
+class FloodLimiter:
+    """Ограничивает входящие сообщения token bucket'ами по нескольким областям.
+
+    scopes: {область: (токенов в секунду, запас)}, например отправитель, ссылка и весь бот.
+    Сообщение проходит, только если токен есть во всех своих корзинах, и тогда списывается
+    из каждой. Корзина, простоявшая дольше времени полного пополнения, ничем не отличается
+    от новой и удаляется; кроме того, в каждой области хранится не больше max_keys корзин.
+    """
+
+    def __init__(self, scopes, max_keys=FLOOD_MAX_KEYS):
+        self.scopes = scopes
+        self.max_keys = max_keys
+        self._buckets = {scope: OrderedDict() for scope in scopes}
+        self.allowed = 0
+        self.throttled = {scope: 0 for scope in scopes}
+
+    def _bucket(self, scope, key, now):
+        buckets = self._buckets[scope]
+        rate, burst = self.scopes[scope]
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+            bucket.notified = False
+        else:
+            buckets.move_to_end(key)
+        # В начале словаря — корзины, к которым обращались давнее всего
+        idle_after = burst / rate
+        while buckets:
+            oldest_key, oldest = next(iter(buckets.items()))
+            if oldest is bucket or (now - oldest.updated < idle_after and len(buckets) <= self.max_keys):
+                break
+            del buckets[oldest_key]
+        return bucket
+
+    def check(self, keys):
+        """keys: {область: ключ или None}. Возвращает (пропустить, сколько ждать, сообщить ли о лимите)."""
+        now = time.monotonic()
+        buckets = [(scope, self._bucket(scope, key, now)) for scope, key in keys.items() if key is not None]
+        for scope, bucket in buckets:
+            wait = bucket.time_until()
+            if wait > 0:
+                self.throttled[scope] += 1
+                # О превышении лимита пишем один раз, а не на каждое лишнее сообщение
+                first = buckets[0][1]
+                notify = not first.notified
+                first.notified = True
+                return False, wait, notify
+        for scope, bucket in buckets:
+            bucket.try_acquire()
+        buckets[0][1].notified = False
+        self.allowed += 1
+        return True, 0.0, False
+
+    def metrics(self):
+        return {
+            'allowed': self.allowed,
+            'throttled': dict(self.throttled),
+            'keys': sum(len(buckets) for buckets in self._buckets.values()),
+        }
+
+flood_limiter = FloodLimiter({
+    'user': (FLOOD_USER_RATE, FLOOD_USER_BURST),
+    'link': (FLOOD_LINK_RATE, FLOOD_LINK_BURST),
+    'global': (FLOOD_GLOBAL_RATE, FLOOD_GLOBAL_BURST),
+})
+
+async def allow_incoming_message(update, context):
+    """Проверяет лимиты до любой работы с БД; админ не ограничивается."""
+    user = update.effective_user
+    if user.username == ADMIN_USERNAME or user.id == ADMIN_ID:
+        return True
+    allowed, wait, notify = flood_limiter.check({
+        'user': user.id,
+        'link': context.user_data.get('current_link'),
+        'global': 'all',
+    })
+    if not allowed and notify:
+        try:
+            await update.message.reply_text(f"⏳ Слишком много сообщений. Подождите {max(1, round(wait))} сек. и попробуйте снова.")
+        except TelegramError as e:
+            logging.warning(f"Не удалось сообщить о лимите пользователю {user.id}: {e}")
+    return allowed
+
+# --- МАРШРУТИЗАЦИЯ КНОПОК ---
+
+def int_param(raw):
+    """Параметр кнопки — целое число (id пользователя, сообщения)."""
+    return int(raw)
+
+def str_param(raw):
+    """Параметр кнопки — непустая строка (id ссылки)."""
+    if not raw or raw == "None":
+        raise ValueError("Пустой параметр кнопки")
+    return raw
+
+class CallbackRoute:
+    __slots__ = ("handler", "param", "admin", "invalid", "code", "legacy")
+
+    def __init__(self, handler, param, admin, invalid, code, legacy):
+        self.handler = handler
+        self.param = param
+        self.admin = admin
+        self.invalid = invalid
+        self.code = code
+        self.legacy = legacy
+
+class CallbackRouter:
+    """Таблица маршрутов для callback_data кнопок.
+
+    Точные маршруты ("main_menu") ищутся в словаре. Маршруты с параметром
+    регистрируются префиксом с '_' на конце и постоянным числовым кодом.
+
+    Кнопки с параметром кодируются компактно (encode): '~' + base64url от
+    [версия][код маршрута][вид параметра][параметр][HMAC-тег]. Подделанные,
+    устаревшие по версии и неизвестные кнопки отбрасываются до вызова обработчика.
+    Длинные строковые параметры, не влезающие в 64 байта, хранятся в ограниченном
+    LRU на сервере, а в кнопку попадает только ссылка на них.
+
+    Старые кнопки вида <префикс>_<параметр> не подписаны, поэтому принимаются только
+    в переходный период до legacy_until (CALLBACK_LEGACY_UNTIL) и никогда — для
+    маршрутов с legacy=False (удаление, блокировка). Они разбираются по префиксам:
+    проверяются только границы '_' внутри callback_data, от длинной к короткой.
+    """
+
+    VERSION = 1
+    MARKER = "~"
+    TAG_SIZE = 6
+    NO_PARAM, INT_PARAM, STR_PARAM, STORED_PARAM = range(4)
+
+    def __init__(self, secret, store_size=CALLBACK_STORE_SIZE, legacy_until=None):
+        self.legacy_until = legacy_until  # unix-время окончания переходного периода или None
+        self._exact = {}
+        self._prefixes = {}
+        self._codes = {}
+        self._mac = hmac.new(secret, digestmod=hashlib.sha256)
+        self._store = OrderedDict()
+        self._store_size = store_size
+        self.rejected = 0
+
+    def route(self, pattern, param=None, admin=False, invalid="Ошибка: неверные данные кнопки", code=None, legacy=True):
+        """Регистрирует обработчик async def handler(query, context, value).
+
+        code — постоянный номер маршрута для компактных кнопок, обязателен для маршрутов с параметром.
+        legacy=False — не принимать для маршрута старые неподписанные кнопки даже в переходный период.
+        """
+        def decorator(handler):
+            table = self._prefixes if param else self._exact
+            if pattern in table:
+                raise ValueError(f"Маршрут {pattern} уже зарегистрирован")
+            route = CallbackRoute(handler, param, admin, invalid, code, legacy)
+            table[pattern] = route
+            if code is not None:
+                if code in self._codes or not 0 <= code <= 255:
+                    raise ValueError(f"Неверный или повторный код маршрута {pattern}: {code}")
+                self._codes[code] = route
+            return handler
+        return decorator
+
+    def _tag(self, body):
+        mac = self._mac.copy()
+        mac.update(body)
+        return mac.digest()[:self.TAG_SIZE]
+
+    def encode(self, pattern, value):
+        """Возвращает компактную callback_data для маршрута с параметром."""
+        route = self._prefixes[pattern]
+        if isinstance(value, int):
+            kind = self.INT_PARAM
+            payload = value.to_bytes(value.bit_length() // 8 + 1, "big", signed=True)
+        else:
+            kind = self.STR_PARAM
+            payload = str(value).encode()
+        data = self._pack(route.code, kind, payload)
+        if len(data) > 64:
+            token = secrets.token_bytes(6)
+            self._store[token] = str(value)
+            if len(self._store) > self._store_size:
+                self._store.popitem(last=False)
+            data = self._pack(route.code, self.STORED_PARAM, token)
+        return data
+
+    def _pack(self, code, kind, payload):
+        body = bytes((self.VERSION, code, kind)) + payload
+        return self.MARKER + base64.urlsafe_b64encode(body + self._tag(body)).decode().rstrip("=")
+
+    def _unpack(self, data):
+        """Разбирает компактную кнопку в (route, необработанный параметр) или (None, None)."""
+        try:
+            encoded = data[1:]
+            raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        except ValueError:
+            return None, None
+        body, tag = raw[:-self.TAG_SIZE], raw[-self.TAG_SIZE:]
+        if len(body) < 3 or body[0] != self.VERSION or not hmac.compare_digest(tag, self._tag(body)):
+            return None, None
+        route = self._codes.get(body[1])
+        if route is None:
+            return None, None
+        kind, payload = body[2], body[3:]
+        if kind == self.INT_PARAM:
+            return route, str(int.from_bytes(payload, "big", signed=True))
+        if kind == self.STR_PARAM:
+            return route, payload.decode(errors="replace")
+        if kind == self.STORED_PARAM:
+            value = self._store.get(payload)
+            if value is None:
+                return None, None
+            self._store.move_to_end(payload)
+            return route, value
+        return None, None
+
+    def resolve(self, data):
+        """Возвращает (route, необработанный параметр) или (None, None)."""
+        if data.startswith(self.MARKER):
+            route, raw = self._unpack(data)
+            if route is None:
+                self.rejected += 1
+            return route, raw
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        if self.legacy_until is None or time.time() >= self.legacy_until:
+            self.rejected += 1
+            return None, None
+        end = data.rfind("_")
+        while end > 0:
+            route = self._prefixes.get(data[:end + 1])
+            if route is not None:
+                if not route.legacy:
+                    break
+                return route, data[end + 1:]
+            end = data.rfind("_", 0, end)
+        self.rejected += 1
+        return None, None
+
+callback_router = CallbackRouter(
+    CALLBACK_SECRET,
+    legacy_until=datetime.fromisoformat(CALLBACK_LEGACY_UNTIL).timestamp() if CALLBACK_LEGACY_UNTIL else None,
+)
+
+def pack_callback(pattern, value):
+    """callback_data для кнопки маршрута с параметром, например pack_callback("reply_", message_id)."""
+    return callback_router.encode(pattern, value)
+
 # --- ОСНОВНЫЕ ОБРАБОТЧИКИ ---
 
+async def check_banned(user_id):
+    """Проверка бана в обработчиках: из кэша в памяти, пока он не загружен — запросом в потоке-читателе."""
+    if user_registry.loaded:
+        return user_registry.is_banned(user_id)
+    return await db.read(is_user_banned, user_id)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
         
         # Проверяем, не забанен ли пользователь
-        if is_user_banned(user.id):
+        if await check_banned(user.id):
             await update.message.reply_text("❌ Вы заблокированы в этом боте и не можете использовать его функции.")
             return
         
-        save_user(user.id, user.username, user.first_name)
+        if not user_registry.is_current(user.id, user.username, user.first_name):
+            await db.write(save_user, user.id, user.username, user.first_name)
         
         if context.args:
             link_id = context.args[0]
-            link_info = get_link_info(link_id)
+            link_info = await db.read(get_link_info, link_id)
             if link_info:
                 context.user_data['current_link'] = link_id
                 text = f"🔗 *Анонимная ссылка*\n\n📝 *{escape_markdown_v2(link_info[2])}*\n📋 {escape_markdown_v2(link_info[3])}\n\n✍️ Напишите анонимное сообщение или отправьте медиафайл\\."
@@ -788,15 +3255,25 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.error(f"Ошибка в команде start: {e}")
         await update.message.reply_text("❌ Произошла ошибка\\. Попробуйте позже\\.", parse_mode='MarkdownV2')
 
+def admin_session_active(user_data):
+    """Вход в админку действует ADMIN_SESSION_TTL секунд с момента ввода пароля."""
+    authenticated_at = user_data.get('admin_authenticated')
+    if type(authenticated_at) is not float:
+        return False
+    if time.time() - authenticated_at > ADMIN_SESSION_TTL:
+        user_data.pop('admin_authenticated', None)
+        return False
+    return True
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /admin"""
     try:
         user = update.effective_user
         if user.username == ADMIN_USERNAME or user.id == ADMIN_ID:
             # Проверяем пароль, если он еще не введен
-            if not context.user_data.get('admin_authenticated'):
+            if not admin_session_active(context.user_data):
                 if context.args and context.args[0] == ADMIN_PASSWORD:
-                    context.user_data['admin_authenticated'] = True
+                    context.user_data['admin_authenticated'] = time.time()
                     # Удаляем сообщение с паролем
                     try:
                         await update.message.delete()
@@ -823,567 +3300,545 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.error(f"Ошибка в команде admin: {e}")
         await update.message.reply_text("❌ Произошла ошибка\\. Попробуйте позже\\.", parse_mode='MarkdownV2')
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        await query.answer()
-        user = query.from_user
-        data = query.data
-        is_admin = user.username == ADMIN_USERNAME or user.id == ADMIN_ID
+# Основные команды меню
 
-        # Основные команды меню
-        if data == "main_menu":
-            text = "🎭 *Главное меню*"
-            await query.edit_message_text(text, reply_markup=main_keyboard(), parse_mode='MarkdownV2')
-            return
-        
-        elif data == "my_links":
-            links = get_user_links(user.id)
-            if links:
-                text = "🔗 *Ваши анонимные ссылки:*\n\n"
-                for link in links:
-                    bot_username = context.bot.username
-                    link_url = f"https://t.me/{bot_username}?start={link[0]}"
-                    created = format_datetime(link[3])
-                    text += f"📝 *{escape_markdown_v2(link[1])}*\n📋 {escape_markdown_v2(link[2])}\n🔗 `{escape_markdown_v2(link_url)}`\n🕒 `{created}`\n\n"
-                
-                # Добавляем кнопки удаления для каждой ссылки
-                keyboard_buttons = []
-                for link in links:
-                    keyboard_buttons.append([InlineKeyboardButton(f"🗑️ Удалить {link[1]}", callback_data=f"confirm_delete_link_{link[0]}")])
-                
-                keyboard_buttons.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
-                keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                
-                await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-            else:
-                await query.edit_message_text("У вас пока нет созданных ссылок\\.", parse_mode='MarkdownV2', reply_markup=main_keyboard())
-            return
-        
-        elif data == "my_messages":
-            messages = get_user_messages_with_replies(user.id)
-            if messages:
-                text = "📨 *Ваши последние сообщения:*\n\n"
-                for msg in messages:
-                    msg_id, msg_text, msg_type, file_id, file_size, file_name, created, link_title, link_id, reply_count = msg
-                    
-                    type_icon = {"text": "📝", "photo": "🖼️", "video": "🎥", "document": "📄", "voice": "🎤", "video_note": "⭕️"}.get(msg_type, "📄")
-                    
-                    preview = safe_str(msg_text) or f"*{msg_type}*"
-                    if len(preview) > 50:
-                        preview = preview[:50] + "\\.\\.\\."
-                        
-                    created_str = format_datetime(created)
-                    text += f"{type_icon} *{escape_markdown_v2(link_title)}*\n`{preview}`\n🕒 `{created_str}` \\| 💬 Ответов\\: {reply_count}\n\n"
-                
-                # Добавляем кнопки действий для сообщений
-                keyboard_buttons = []
-                for msg in messages:
-                    keyboard_buttons.append([
-                        InlineKeyboardButton(f"💬 Ответить {msg[7]}", callback_data=f"reply_{msg[0]}"),
-                        InlineKeyboardButton(f"🗑️ Удалить", callback_data=f"confirm_delete_message_{msg[0]}")
-                    ])
-                
-                keyboard_buttons.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
-                keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                
-                await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-            else:
-                await query.edit_message_text("У вас пока нет сообщений\\.", parse_mode='MarkdownV2', reply_markup=main_keyboard())
-            return
-        
-        elif data == "create_link":
-            context.user_data['creating_link'] = True
-            context.user_data['link_stage'] = 'title'
-            await query.edit_message_text("📝 Введите *название* для вашей ссылки:", parse_mode='MarkdownV2', reply_markup=cancel_keyboard())
-            return
-        
-        # Ответ на сообщение
-        elif data.startswith("reply_"):
-            try:
-                message_id_str = data.replace("reply_", "")
-                if message_id_str and message_id_str != "None":
-                    message_id = safe_int(message_id_str)
-                    context.user_data['replying_to'] = message_id
-                    await query.edit_message_text(
-                        "💬 *Режим ответа*\n\nВведите ваш ответ на это сообщение:",
-                        parse_mode='MarkdownV2',
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="my_messages")]])
-                    )
-                else:
-                    await query.answer("Ошибка: сообщение не найдено", show_alert=True)
-            except (ValueError, TypeError) as e:
-                logging.error(f"Ошибка преобразования message_id: {e}")
-                await query.answer("Ошибка: неверный идентификатор сообщения", show_alert=True)
-            return
-        
-        # Управление удалением
-        elif data.startswith("confirm_delete_link_"):
-            link_id = data.replace("confirm_delete_link_", "")
-            if link_id and link_id != "None":
-                link_info = get_link_info(link_id)
-                
-                if link_info:
-                    text = f"🗑️ *Подтверждение удаления ссылки*\n\n"
-                    text += f"📝 *Название:* {escape_markdown_v2(link_info[2])}\n"
-                    text += f"📋 *Описание:* {escape_markdown_v2(link_info[3])}\n\n"
-                    text += "❓ *Вы уверены, что хотите удалить эту ссылку?*\n"
-                    text += "⚠️ *Все сообщения через эту ссылку также будут удалены\\!*"
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', 
-                                               reply_markup=delete_confirmation_keyboard("link", link_id))
-            else:
-                await query.answer("Ошибка: ссылка не найдена", show_alert=True)
-            return
-        
-        elif data.startswith("confirm_delete_message_"):
-            message_id_str = data.replace("confirm_delete_message_", "")
-            if message_id_str and message_id_str != "None":
-                message_id = safe_int(message_id_str)
-                message_info = get_message_info(message_id)
-                
-                if message_info:
-                    msg_text, msg_type, file_name, created, from_user, from_name, to_user, to_name, link_title, link_id = message_info
-                    
-                    text = f"🗑️ *Подтверждение удаления сообщения*\n\n"
-                    text += f"📝 *Сообщение:*\n`{safe_str(msg_text) if msg_text else f'Медиафайл: {msg_type}'}`\n\n"
-                    text += f"❓ *Вы уверены, что хотите удалить это сообщение?*"
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', 
-                                               reply_markup=delete_confirmation_keyboard("message", message_id))
-            else:
-                await query.answer("Ошибка: сообщение не найдено", show_alert=True)
-            return
-        
-        elif data.startswith("delete_link_"):
-            link_id = data.replace("delete_link_", "")
-            if link_id and link_id != "None":
-                success = delete_link_completely(link_id)
-                
-                if success:
-                    await query.edit_message_text("✅ *Ссылка и все связанные сообщения успешно удалены\\!*", 
-                                               parse_mode='MarkdownV2', 
-                                               reply_markup=main_keyboard())
-                else:
-                    await query.edit_message_text("❌ *Ошибка при удалении ссылки*", 
-                                               parse_mode='MarkdownV2', 
-                                               reply_markup=main_keyboard())
-            else:
-                await query.answer("Ошибка: ссылка не найдена", show_alert=True)
-            return
-        
-        elif data.startswith("delete_message_"):
-            message_id_str = data.replace("delete_message_", "")
-            if message_id_str and message_id_str != "None":
-                message_id = safe_int(message_id_str)
-                success = delete_message_completely(message_id)
-                
-                if success:
-                    await query.edit_message_text("✅ *Сообщение успешно удалено\\!*", 
-                                               parse_mode='MarkdownV2', 
-                                               reply_markup=main_keyboard())
-                else:
-                    await query.edit_message_text("❌ *Ошибка при удалении сообщения*", 
-                                               parse_mode='MarkdownV2', 
-                                               reply_markup=main_keyboard())
-            else:
-                await query.answer("Ошибка: сообщение не найдено", show_alert=True)
-            return
-        
-        elif data == "cancel_delete":
-            await query.edit_message_text("❌ *Удаление отменено*", 
-                                       parse_mode='MarkdownV2', 
-                                       reply_markup=main_keyboard())
+@callback_router.route("main_menu")
+async def on_main_menu(query, context, value):
+    text = "🎭 *Главное меню*"
+    await query.edit_message_text(text, reply_markup=main_keyboard(), parse_mode='MarkdownV2')
+
+@callback_router.route("my_links")
+async def on_my_links(query, context, value):
+    links = await db.read(get_user_links, query.from_user.id)
+    if links:
+        text = "🔗 *Ваши анонимные ссылки:*\n\n"
+        for link in links:
+            bot_username = context.bot.username
+            link_url = f"https://t.me/{bot_username}?start={link[0]}"
+            created = format_datetime(link[3])
+            text += f"📝 *{escape_markdown_v2(link[1])}*\n📋 {escape_markdown_v2(link[2])}\n🔗 `{escape_markdown_v2(link_url)}`\n🕒 `{created}`\n\n"
+
+        # Добавляем кнопки удаления для каждой ссылки
+        keyboard_buttons = []
+        for link in links:
+            keyboard_buttons.append([InlineKeyboardButton(f"🗑️ Удалить {link[1]}", callback_data=pack_callback("confirm_delete_link_", link[0]))])
+
+        keyboard_buttons.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
+        keyboard = InlineKeyboardMarkup(keyboard_buttons)
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+    else:
+        await query.edit_message_text("У вас пока нет созданных ссылок\\.", parse_mode='MarkdownV2', reply_markup=main_keyboard())
+
+@callback_router.route("my_messages")
+@callback_router.route("my_messages_", param=parse_page_param, code=1)
+async def on_my_messages(query, context, page):
+    user_id = query.from_user.id
+    if page is None:
+        messages, has_prev, has_next = await db.read(get_user_messages_page, user_id)
+    else:
+        cursor, direction = page
+        messages, has_prev, has_next = await db.read(get_user_messages_page, user_id, cursor, direction)
+        if not messages:
+            messages, has_prev, has_next = await db.read(get_user_messages_page, user_id)
+    if messages:
+        reply_counts = await db.read(get_reply_counts, [msg[0] for msg in messages])
+        text = "📨 *Ваши последние сообщения:*\n\n"
+        # Не поместившиеся в лимит Telegram сообщения переходят на следующую страницу
+        shown = []
+        for msg in messages:
+            msg_id, msg_text, msg_type, created, link_title = msg
+
+            type_icon = {"text": "📝", "photo": "🖼️", "video": "🎥", "document": "📄", "voice": "🎤", "video_note": "⭕️"}.get(msg_type, "📄")
+
+            preview = safe_str(msg_text)
+            if len(preview) > MESSAGE_PREVIEW_LENGTH:
+                preview = preview[:MESSAGE_PREVIEW_LENGTH] + "..."
+            preview = preview.replace("\\", "\\\\").replace("`", "\\`") or msg_type
+
+            created_str = format_datetime(created)
+            entry = f"{type_icon} *{escape_markdown_v2(safe_str(link_title)[:40])}*\n`{preview}`\n🕒 `{created_str}` \\| 💬 Ответов\\: {reply_counts.get(msg_id, 0)}\n\n"
+            if len(text) + len(entry) > TELEGRAM_TEXT_LIMIT:
+                has_next = True
+                break
+            text += entry
+            shown.append(msg)
+
+        keyboard = my_messages_keyboard(shown, has_prev, has_next)
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+    else:
+        await query.edit_message_text("У вас пока нет сообщений\\.", parse_mode='MarkdownV2', reply_markup=main_keyboard())
+
+@callback_router.route("create_link")
+async def on_create_link(query, context, value):
+    context.user_data['creating_link'] = True
+    context.user_data['link_stage'] = 'title'
+    await query.edit_message_text("📝 Введите *название* для вашей ссылки:", parse_mode='MarkdownV2', reply_markup=cancel_keyboard())
+
+# Ответ на сообщение
+@callback_router.route("reply_", param=int_param, invalid="Ошибка: неверный идентификатор сообщения", code=2)
+async def on_reply(query, context, message_id):
+    context.user_data['replying_to'] = message_id
+    await query.edit_message_text(
+        "💬 *Режим ответа*\n\nВведите ваш ответ на это сообщение:",
+        parse_mode='MarkdownV2',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="my_messages")]])
+    )
+
+# Управление удалением
+@callback_router.route("confirm_delete_link_", param=str_param, invalid="Ошибка: ссылка не найдена", code=3)
+async def on_confirm_delete_link(query, context, link_id):
+    link_info = await db.read(get_link_info, link_id)
+
+    if link_info:
+        text = f"🗑️ *Подтверждение удаления ссылки*\n\n"
+        text += f"📝 *Название:* {escape_markdown_v2(link_info[2])}\n"
+        text += f"📋 *Описание:* {escape_markdown_v2(link_info[3])}\n\n"
+        text += "❓ *Вы уверены, что хотите удалить эту ссылку?*\n"
+        text += "⚠️ *Все сообщения через эту ссылку также будут удалены\\!*"
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2',
+                                   reply_markup=delete_confirmation_keyboard("link", link_id))
+
+@callback_router.route("confirm_delete_message_", param=int_param, invalid="Ошибка: сообщение не найдено", code=4)
+async def on_confirm_delete_message(query, context, message_id):
+    message_info = await db.read(get_message_info, message_id)
+
+    if message_info:
+        msg_text, msg_type, file_name, created, from_user, from_name, to_user, to_name, link_title, link_id, from_user_id = message_info
+
+        text = f"🗑️ *Подтверждение удаления сообщения*\n\n"
+        text += f"📝 *Сообщение:*\n`{safe_str(msg_text) if msg_text else f'Медиафайл: {msg_type}'}`\n\n"
+        text += f"❓ *Вы уверены, что хотите удалить это сообщение?*"
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2',
+                                   reply_markup=delete_confirmation_keyboard("message", message_id))
+
+@callback_router.route("delete_link_", param=str_param, invalid="Ошибка: ссылка не найдена", code=5, legacy=False)
+async def on_delete_link(query, context, link_id):
+    success = await db.write(delete_link_completely, link_id)
+
+    if success:
+        await query.edit_message_text("✅ *Ссылка и все связанные сообщения успешно удалены\\!*",
+                                   parse_mode='MarkdownV2',
+                                   reply_markup=main_keyboard())
+    else:
+        await query.edit_message_text("❌ *Ошибка при удалении ссылки*",
+                                   parse_mode='MarkdownV2',
+                                   reply_markup=main_keyboard())
+
+@callback_router.route("delete_message_", param=int_param, invalid="Ошибка: сообщение не найдено", code=6, legacy=False)
+async def on_delete_message(query, context, message_id):
+    success = await db.write(delete_message_completely, message_id)
+
+    if success:
+        await query.edit_message_text("✅ *Сообщение успешно удалено\\!*",
+                                   parse_mode='MarkdownV2',
+                                   reply_markup=main_keyboard())
+    else:
+        await query.edit_message_text("❌ *Ошибка при удалении сообщения*",
+                                   parse_mode='MarkdownV2',
+                                   reply_markup=main_keyboard())
+
+@callback_router.route("cancel_delete")
+async def on_cancel_delete(query, context, value):
+    await query.edit_message_text("❌ *Удаление отменено*",
+                               parse_mode='MarkdownV2',
+                               reply_markup=main_keyboard())
+
+# АДМИН ПАНЕЛЬ
+
+@callback_router.route("admin_panel", admin=True)
+async def on_admin_panel(query, context, value):
+    await query.edit_message_text(
+        "🛠️ *Панель администратора*",
+        reply_markup=admin_keyboard(),
+        parse_mode='MarkdownV2'
+    )
+
+@callback_router.route("admin_stats", admin=True)
+async def on_admin_stats(query, context, value):
+    stats = await db.read(get_admin_stats)
+    sync = persistence.metrics()
+    cache = link_cache.metrics()
+    updates = update_processor.metrics()
+    flood = flood_limiter.metrics()
+    delivery = outbox.metrics()
+    queued = await db.read(get_outbox_counts)
+    latency = f"{sync['last_push_latency']:.1f} с" if sync['last_push_latency'] is not None else "—"
+    started = escape_markdown_v2(format_startup_timings() or "—")
+    remote = sync['remote']
+    if remote['state'] == CircuitBreaker.OPEN:
+        remote_state = f"🔴 недоступен, повтор через {remote['retry_in']:.0f} с"
+    elif remote['state'] == CircuitBreaker.HALF_OPEN:
+        remote_state = "🟡 пробная отправка"
+    else:
+        remote_state = "🟢 доступен"
+    remote_state = escape_markdown_v2(f"{remote_state} (неудач подряд: {remote['failures']}, отключений: {remote['trips']})")
+    text = f"""📊 *Статистика бота\\:*
+
+👥 *Пользователи\\:*
+• Всего пользователей\\: {stats['users']}
+• Заблокированных\\: {stats['banned']}
+• Активных ссылок\\: {stats['links']}
+• Спонсорских ссылок\\: {stats['sponsor_links']}
+
+💌 *Сообщения\\:*
+• Всего сообщений\\: {stats['messages']}
+• Ответов\\: {stats['replies']}
+
+📁 *Файлы\\:*
+• Фотографий\\: {stats['photos']}
+• Видео\\: {stats['videos']}
+• Документов\\: {stats['documents']}
+• Голосовых\\: {stats['voice']}
+• Кружков\\: {stats['video_note']}
+
+💾 *Синхронизация с GitHub\\:*
+• GitHub\\: {remote_state}
+• Ожидают отправки\\: {sync['pending_changes']}
+• Успешных отправок\\: {sync['pushes']}
+• Ошибок отправки\\: {sync['push_failures']}
+• Последняя отправка\\: {escape_markdown_v2(latency)}
+• Запуск\\: {started}
+
+⚡️ *Кэш ссылок\\:*
+• Записей\\: {cache['size']}
+• Попаданий\\: {cache['hits']} \\| Промахов\\: {cache['misses']}
+
+⚙️ *Обработка обновлений\\:*
+• Выполняется\\: {updates['active']} из {updates['workers']}
+• Пользователей в очереди\\: {updates['users_in_queue']}
+• Обработано\\: {updates['processed']}
+
+🛡 *Защита от флуда\\:*
+• Пропущено\\: {flood['allowed']} \\| Активных корзин\\: {flood['keys']}
+• Ограничено\\: отправитель {flood['throttled']['user']}, ссылка {flood['throttled']['link']}, бот {flood['throttled']['global']}
+
+📬 *Очередь уведомлений\\:*
+• В очереди\\: {queued['pending']} \\| Не доставлено\\: {queued['failed']}
+• Отправлено\\: {delivery['sent']} \\| Повторов\\: {delivery['retried']}"""
+    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=admin_keyboard())
+
+@callback_router.route("admin_users", admin=True)
+@callback_router.route("admin_users_", param=parse_page_param, admin=True, code=20)
+async def on_admin_users(query, context, page):
+    if page is None:
+        users, has_prev, has_next = await db.read(get_admin_users_page)
+    else:
+        cursor, direction = page
+        users, has_prev, has_next = await db.read(get_admin_users_page, cursor, direction)
+        if not users:
+            users, has_prev, has_next = await db.read(get_admin_users_page)
+    if users:
+        text = "👥 *Управление пользователями*\n\n"
+        for u in users:
+            # Безопасное получение username
+            username = u[1] if u[1] else (u[2] or f"ID:{u[0]}")
+            username_display = f"@{username}" if u[1] else username
+            created = format_datetime(u[3])
+            ban_status = "🚫 ЗАБЛОКИРОВАН" if u[4] else "✅ АКТИВЕН"
+            text += f"👤 *{escape_markdown_v2(username_display)}*\n🆔 `{u[0]}` \\| 📅 `{created}` \\| {ban_status}\n\n"
+
+        keyboard = admin_users_keyboard(users, has_prev, has_next)
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+    else:
+        await query.edit_message_text("Пользователей не найдено\\.", parse_mode='MarkdownV2', reply_markup=admin_keyboard())
+
+@callback_router.route("admin_user_manage_", param=int_param, admin=True, code=21)
+async def on_admin_user_manage(query, context, user_id):
+    user_info = await db.fetch_one("SELECT username, first_name, is_banned FROM users WHERE user_id = ?", (user_id,))
+
+    if user_info:
+        username, first_name, is_banned = user_info
+        user_display = f"@{username}" if username else (first_name or f"ID:{user_id}")
+        status = "🚫 ЗАБЛОКИРОВАН" if is_banned else "✅ АКТИВЕН"
+
+        text = f"👤 *Управление пользователем*\n\n"
+        text += f"*Информация:*\n"
+        text += f"• ID\\: `{user_id}`\n"
+        text += f"• Имя\\: {escape_markdown_v2(user_display)}\n"
+        text += f"• Статус\\: {status}\n\n"
+        text += f"*Доступные действия:*"
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
+    else:
+        await query.answer("Пользователь не найден", show_alert=True)
+
+@callback_router.route("admin_ban_user_", param=int_param, admin=True, code=22, legacy=False)
+async def on_admin_ban_user(query, context, user_id):
+    context.user_data['banning_user'] = user_id
+    await query.edit_message_text(
+        f"🚫 *Блокировка пользователя {user_id}*\n\nВведите причину блокировки \\(или нажмите отмена\\):",
+        parse_mode='MarkdownV2',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=pack_callback("admin_user_manage_", user_id))]])
+    )
+
+@callback_router.route("admin_unban_user_", param=int_param, admin=True, code=23)
+async def on_admin_unban_user(query, context, user_id):
+    success = await db.write(unban_user, user_id)
+
+    if success:
+        # Пытаемся уведомить пользователя о разблокировке
+        try:
+            await context.bot.send_message(
+                user_id,
+                "✅ *Ваша блокировка в боте снята\\!*\n\nТеперь вы снова можете использовать все функции бота\\.",
+                parse_mode='MarkdownV2'
+            )
+        except:
+            pass
+
+        await query.edit_message_text(
+            f"✅ *Пользователь {user_id} разблокирован\\!*",
+            parse_mode='MarkdownV2',
+            reply_markup=user_management_keyboard(user_id)
+        )
+    else:
+        await query.answer("Ошибка при разблокировке пользователя", show_alert=True)
+
+@callback_router.route("admin_delete_user_", param=int_param, admin=True, code=24)
+async def on_admin_delete_user(query, context, user_id):
+    text = f"🗑️ *УДАЛЕНИЕ ПОЛЬЗОВАТЕЛЯ*\n\n"
+    text += f"❓ *Вы уверены, что хотите полностью удалить пользователя {user_id}?*\n\n"
+    text += "⚠️ *ВНИМАНИЕ\\! Это действие нельзя отменить\\!*\n"
+    text += "• Все ссылки пользователя будут удалены\n"
+    text += "• Все сообщения пользователя будут удалены\n"
+    text += "• Все ответы пользователя будут удалены\n"
+    text += "• Пользователь будет полностью удален из системы"
+
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ ДА, УДАЛИТЬ", callback_data=pack_callback("admin_confirm_delete_user_", user_id))],
+        [InlineKeyboardButton("❌ ОТМЕНА", callback_data=pack_callback("admin_user_manage_", user_id))]
+    ])
+
+    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+
+@callback_router.route("admin_confirm_delete_user_", param=int_param, admin=True, code=25, legacy=False)
+async def on_admin_confirm_delete_user(query, context, user_id):
+    counts = await db.write(delete_user, user_id)
+
+    if counts:
+        context.application.drop_user_data(user_id)
+        await query.edit_message_text(
+            f"✅ *Пользователь {user_id} и все его данные полностью удалены\\!*\n\n"
+            f"🔗 Ссылок\\: {counts['links']} \\| 📨 Сообщений\\: {counts['messages']} \\| 💬 Ответов\\: {counts['replies']}",
+            parse_mode='MarkdownV2',
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К списку пользователей", callback_data="admin_users")]])
+        )
+    else:
+        await query.answer("Ошибка при удалении пользователя", show_alert=True)
+
+@callback_router.route("admin_message_user_", param=int_param, admin=True, code=26)
+async def on_admin_message_user(query, context, user_id):
+    context.user_data['admin_messaging_user'] = user_id
+    await query.edit_message_text(
+        f"✉️ *Отправка сообщения пользователю {user_id}*\n\nВведите сообщение, которое будет отправлено от имени бота:",
+        parse_mode='MarkdownV2',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=pack_callback("admin_user_manage_", user_id))]])
+    )
+
+@callback_router.route("admin_sponsor_links", admin=True)
+async def on_admin_sponsor_links(query, context, value):
+    await query.edit_message_text(
+        "🔗 *Управление спонсорскими ссылками*\n\nСпонсорские ссылки могут быть созданы для любого пользователя и переданы им позже\\.",
+        parse_mode='MarkdownV2',
+        reply_markup=sponsor_links_keyboard()
+    )
+
+@callback_router.route("admin_create_sponsor_link", admin=True)
+async def on_admin_create_sponsor_link(query, context, value):
+    context.user_data['creating_sponsor_link'] = True
+    context.user_data['sponsor_stage'] = 'title'
+    await query.edit_message_text(
+        "🔗 *Создание спонсорской ссылки*\n\nВведите *название* для спонсорской ссылки:",
+        parse_mode='MarkdownV2',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_sponsor_links")]])
+    )
+
+@callback_router.route("admin_my_sponsor_links", admin=True)
+async def on_admin_my_sponsor_links(query, context, value):
+    sponsor_links = await db.read(get_sponsor_links, query.from_user.id)
+    if sponsor_links:
+        text = "🔗 *Ваши спонсорские ссылки:*\n\n"
+        for link in sponsor_links:
+            link_id, title, description, created, target_user_id, custom_id = link
+            bot_username = context.bot.username
+            link_url = f"https://t.me/{bot_username}?start={link_id}"
+            created_str = format_datetime(created)
+            custom_info = f"\n🆔 Кастомный ID: `{custom_id}`" if custom_id else ""
+            text += f"📝 *{escape_markdown_v2(title)}*\n📋 {escape_markdown_v2(description)}\n👤 Владелец\\: `{target_user_id}`{custom_info}\n🔗 `{escape_markdown_v2(link_url)}`\n🕒 `{created_str}`\n\n"
+
+        # Добавляем кнопки действий для каждой ссылки
+        keyboard_buttons = []
+        for link in sponsor_links:
+            keyboard_buttons.append([InlineKeyboardButton(f"🔄 {link[1]}", callback_data=pack_callback("admin_sponsor_actions_", link[0]))])
+
+        keyboard_buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_sponsor_links")])
+        keyboard = InlineKeyboardMarkup(keyboard_buttons)
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+    else:
+        await query.edit_message_text(
+            "У вас пока нет спонсорских ссылок\\.",
+            parse_mode='MarkdownV2',
+            reply_markup=sponsor_links_keyboard()
+        )
+
+@callback_router.route("admin_sponsor_actions_", param=str_param, admin=True, invalid="Ссылка не найдена", code=27)
+async def on_admin_sponsor_actions(query, context, link_id):
+    link_info = await db.read(get_link_info, link_id)
+
+    if link_info:
+        text = f"🔗 *Управление спонсорской ссылкой*\n\n"
+        text += f"*Название:* {escape_markdown_v2(link_info[2])}\n"
+        text += f"*Описание:* {escape_markdown_v2(link_info[3])}\n"
+        text += f"*ID ссылки:* `{link_id}`\n\n"
+        text += f"*Доступные действия:*"
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=sponsor_link_actions_keyboard(link_id))
+    else:
+        await query.answer("Ссылка не найдена", show_alert=True)
+
+@callback_router.route("admin_transfer_sponsor_", param=str_param, admin=True, invalid="Ссылка не найдена", code=28)
+async def on_admin_transfer_sponsor(query, context, link_id):
+    context.user_data['transferring_sponsor_link'] = link_id
+    await query.edit_message_text(
+        f"🔄 *Передача спонсорской ссылки*\n\nВведите *ID пользователя*, которому хотите передать ссылку:",
+        parse_mode='MarkdownV2',
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=pack_callback("admin_sponsor_actions_", link_id))]])
+    )
+
+@callback_router.route("admin_delete_sponsor_", param=str_param, admin=True, invalid="Ссылка не найдена", code=29, legacy=False)
+async def on_admin_delete_sponsor(query, context, link_id):
+    success = await db.write(delete_link_completely, link_id)
+
+    if success:
+        await query.edit_message_text(
+            "✅ *Спонсорская ссылка успешно удалена\\!*",
+            parse_mode='MarkdownV2',
+            reply_markup=sponsor_links_keyboard()
+        )
+    else:
+        await query.answer("Ошибка при удалении ссылки", show_alert=True)
+
+@callback_router.route("admin_html_report", admin=True)
+async def on_admin_html_report(query, context, value):
+    await query.edit_message_text("🔄 *Генерация HTML отчета\\.\\.\\.*", parse_mode='MarkdownV2')
+
+    report = await db.read(render_report, iter_admin_report)
+
+    with report as f:
+        await query.message.reply_document(
+            document=f,
+            filename=f"admin_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
+            caption="🎨 *Красивый HTML отчет администратора*",
+            parse_mode='MarkdownV2'
+        )
+
+    await query.edit_message_text("✅ *HTML отчет сгенерирован и отправлен\\!*", parse_mode='MarkdownV2', reply_markup=admin_keyboard())
+
+@callback_router.route("admin_broadcast", admin=True)
+async def on_admin_broadcast(query, context, value):
+    context.user_data['broadcasting'] = True
+    context.user_data['broadcast_message'] = ""
+    await query.edit_message_text(
+        "📢 *Режим рассылки*\n\nВведите сообщение для рассылки всем пользователям:",
+        parse_mode='MarkdownV2',
+        reply_markup=broadcast_formatting_keyboard()
+    )
+
+@callback_router.route("broadcast_send", admin=True)
+async def on_broadcast_send(query, context, value):
+    if context.user_data.get('broadcasting'):
+        message_text = context.user_data.get('broadcast_message', '')
+        if not message_text or not message_text.strip():
+            await query.answer("Сообщение не может быть пустым!", show_alert=True)
             return
 
-        # АДМИН ПАНЕЛЬ
-        if is_admin:
-            # Проверка аутентификации админа
-            if not context.user_data.get('admin_authenticated'):
-                await query.edit_message_text(
-                    "🔐 *Требуется аутентификация*\n\nИспользуйте команду /admin с паролем",
-                    parse_mode='MarkdownV2'
-                )
-                return
+        context.user_data.pop('broadcasting', None)
+        context.user_data.pop('broadcast_message', None)
 
-            if data == "admin_panel":
-                await query.edit_message_text(
-                    "🛠️ *Панель администратора*",
-                    reply_markup=admin_keyboard(),
-                    parse_mode='MarkdownV2'
-                )
-                return
+        # Простое форматирование для рассылки
+        formatted_text = message_text.strip()
 
-            elif data == "admin_stats":
-                stats = get_admin_stats()
-                text = f"""📊 *Статистика бота\\:*
+        progress = await query.edit_message_text("🔄 *Отправка рассылки\\.\\.\\.*", parse_mode='MarkdownV2')
+        job_id = await db.write(create_broadcast_job, query.from_user.id, formatted_text, progress.chat_id, progress.message_id)
 
-👥 *Пользователи\\:*
-• Всего пользователей\\: {stats['users']}
-• Заблокированных\\: {stats['banned']}
-• Активных ссылок\\: {stats['links']}
-• Спонсорских ссылок\\: {stats['sponsor_links']}
+        # Рассылка идет в фоне, обработчик кнопки сразу освобождается
+        start_broadcast(BroadcastEngine(context.bot, job_id, formatted_text, progress.chat_id, progress.message_id))
 
-💌 *Сообщения\\:*
-• Всего сообщений\\: {stats['messages']}
-• Ответов\\: {stats['replies']}
+@callback_router.route("admin_user_links_", param=int_param, admin=True, invalid="Ошибка: пользователь не найден", code=30)
+async def on_admin_user_links(query, context, user_id):
+    user_links = await db.read(get_user_links_for_admin, user_id)
 
-📁 *Файлы\\:*
-• Фотографий\\: {stats['photos']}
-• Видео\\: {stats['videos']}
-• Документов\\: {stats['documents']}
-• Голосовых\\: {stats['voice']}
-• Кружков\\: {stats['video_note']}"""
-                await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=admin_keyboard())
-                return
-            
-            elif data == "admin_users":
-                users = get_all_users_for_admin()
-                if users:
-                    text = "👥 *Управление пользователями*\n\n"
-                    for u in users[:15]:
-                        # Безопасное получение username
-                        username = u[1] if u[1] else (u[2] or f"ID:{u[0]}")
-                        username_display = f"@{username}" if u[1] else username
-                        created = format_datetime(u[3])
-                        ban_status = "🚫 ЗАБЛОКИРОВАН" if u[4] else "✅ АКТИВЕН"
-                        text += f"👤 *{escape_markdown_v2(username_display)}*\n🆔 `{u[0]}` \\| 📅 `{created}` \\| {ban_status}\n\n"
-                    
-                    # Добавляем кнопки управления для каждого пользователя
-                    keyboard_buttons = []
-                    for u in users[:15]:
-                        username_display = f"@{u[1]}" if u[1] else (u[2] or f"ID:{u[0]}")
-                        keyboard_buttons.append([
-                            InlineKeyboardButton(f"👤 {username_display}", callback_data=f"admin_user_manage_{u[0]}")
-                        ])
-                    
-                    keyboard_buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
-                    keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-                else:
-                    await query.edit_message_text("Пользователей не найдено\\.", parse_mode='MarkdownV2', reply_markup=admin_keyboard())
-                return
-            
-            elif data.startswith("admin_user_manage_"):
-                user_id_str = data.replace("admin_user_manage_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    user_info = run_query("SELECT username, first_name, is_banned FROM users WHERE user_id = ?", (user_id,), fetch="one")
-                    
-                    if user_info:
-                        username, first_name, is_banned = user_info
-                        user_display = f"@{username}" if username else (first_name or f"ID:{user_id}")
-                        status = "🚫 ЗАБЛОКИРОВАН" if is_banned else "✅ АКТИВЕН"
-                        
-                        text = f"👤 *Управление пользователем*\n\n"
-                        text += f"*Информация:*\n"
-                        text += f"• ID\\: `{user_id}`\n"
-                        text += f"• Имя\\: {escape_markdown_v2(user_display)}\n"
-                        text += f"• Статус\\: {status}\n\n"
-                        text += f"*Доступные действия:*"
-                        
-                        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
-                    else:
-                        await query.answer("Пользователь не найден", show_alert=True)
-                return
-            
-            elif data.startswith("admin_ban_user_"):
-                user_id_str = data.replace("admin_ban_user_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    context.user_data['banning_user'] = user_id
-                    await query.edit_message_text(
-                        f"🚫 *Блокировка пользователя {user_id}*\n\nВведите причину блокировки \\(или нажмите отмена\\):",
-                        parse_mode='MarkdownV2',
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=f"admin_user_manage_{user_id}")]])
-                    )
-                return
-            
-            elif data.startswith("admin_unban_user_"):
-                user_id_str = data.replace("admin_unban_user_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    success = unban_user(user_id)
-                    
-                    if success:
-                        # Пытаемся уведомить пользователя о разблокировке
-                        try:
-                            await context.bot.send_message(
-                                user_id, 
-                                "✅ *Ваша блокировка в боте снята\\!*\n\nТеперь вы снова можете использовать все функции бота\\.",
-                                parse_mode='MarkdownV2'
-                            )
-                        except:
-                            pass
-                        
-                        await query.edit_message_text(
-                            f"✅ *Пользователь {user_id} разблокирован\\!*",
-                            parse_mode='MarkdownV2',
-                            reply_markup=user_management_keyboard(user_id)
-                        )
-                    else:
-                        await query.answer("Ошибка при разблокировке пользователя", show_alert=True)
-                return
-            
-            elif data.startswith("admin_delete_user_"):
-                user_id_str = data.replace("admin_delete_user_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    
-                    text = f"🗑️ *УДАЛЕНИЕ ПОЛЬЗОВАТЕЛЯ*\n\n"
-                    text += f"❓ *Вы уверены, что хотите полностью удалить пользователя {user_id}?*\n\n"
-                    text += "⚠️ *ВНИМАНИЕ\\! Это действие нельзя отменить\\!*\n"
-                    text += "• Все ссылки пользователя будут удалены\n"
-                    text += "• Все сообщения пользователя будут удалены\n"
-                    text += "• Все ответы пользователя будут удалены\n"
-                    text += "• Пользователь будет полностью удален из системы"
-                    
-                    keyboard = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ ДА, УДАЛИТЬ", callback_data=f"admin_confirm_delete_user_{user_id}")],
-                        [InlineKeyboardButton("❌ ОТМЕНА", callback_data=f"admin_user_manage_{user_id}")]
-                    ])
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-                return
-            
-            elif data.startswith("admin_confirm_delete_user_"):
-                user_id_str = data.replace("admin_confirm_delete_user_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    success = delete_user(user_id)
-                    
-                    if success:
-                        await query.edit_message_text(
-                            f"✅ *Пользователь {user_id} и все его данные полностью удалены\\!*",
-                            parse_mode='MarkdownV2',
-                            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К списку пользователей", callback_data="admin_users")]])
-                        )
-                    else:
-                        await query.answer("Ошибка при удалении пользователя", show_alert=True)
-                return
-            
-            elif data.startswith("admin_message_user_"):
-                user_id_str = data.replace("admin_message_user_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    context.user_data['admin_messaging_user'] = user_id
-                    await query.edit_message_text(
-                        f"✉️ *Отправка сообщения пользователю {user_id}*\n\nВведите сообщение, которое будет отправлено от имени бота:",
-                        parse_mode='MarkdownV2',
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=f"admin_user_manage_{user_id}")]])
-                    )
-                return
-            
-            elif data == "admin_sponsor_links":
-                await query.edit_message_text(
-                    "🔗 *Управление спонсорскими ссылками*\n\nСпонсорские ссылки могут быть созданы для любого пользователя и переданы им позже\\.",
-                    parse_mode='MarkdownV2',
-                    reply_markup=sponsor_links_keyboard()
-                )
-                return
-            
-            elif data == "admin_create_sponsor_link":
-                context.user_data['creating_sponsor_link'] = True
-                context.user_data['sponsor_stage'] = 'title'
-                await query.edit_message_text(
-                    "🔗 *Создание спонсорской ссылки*\n\nВведите *название* для спонсорской ссылки:",
-                    parse_mode='MarkdownV2',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="admin_sponsor_links")]])
-                )
-                return
-            
-            elif data == "admin_my_sponsor_links":
-                sponsor_links = get_sponsor_links(user.id)
-                if sponsor_links:
-                    text = "🔗 *Ваши спонсорские ссылки:*\n\n"
-                    for link in sponsor_links:
-                        link_id, title, description, created, target_user_id, custom_id = link
-                        bot_username = context.bot.username
-                        link_url = f"https://t.me/{bot_username}?start={link_id}"
-                        created_str = format_datetime(created)
-                        custom_info = f"\n🆔 Кастомный ID: `{custom_id}`" if custom_id else ""
-                        text += f"📝 *{escape_markdown_v2(title)}*\n📋 {escape_markdown_v2(description)}\n👤 Владелец\\: `{target_user_id}`{custom_info}\n🔗 `{escape_markdown_v2(link_url)}`\n🕒 `{created_str}`\n\n"
-                    
-                    # Добавляем кнопки действий для каждой ссылки
-                    keyboard_buttons = []
-                    for link in sponsor_links:
-                        keyboard_buttons.append([InlineKeyboardButton(f"🔄 {link[1]}", callback_data=f"admin_sponsor_actions_{link[0]}")])
-                    
-                    keyboard_buttons.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_sponsor_links")])
-                    keyboard = InlineKeyboardMarkup(keyboard_buttons)
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-                else:
-                    await query.edit_message_text(
-                        "У вас пока нет спонсорских ссылок\\.",
-                        parse_mode='MarkdownV2',
-                        reply_markup=sponsor_links_keyboard()
-                    )
-                return
-            
-            elif data.startswith("admin_sponsor_actions_"):
-                link_id = data.replace("admin_sponsor_actions_", "")
-                link_info = get_link_info(link_id)
-                
-                if link_info:
-                    text = f"🔗 *Управление спонсорской ссылкой*\n\n"
-                    text += f"*Название:* {escape_markdown_v2(link_info[2])}\n"
-                    text += f"*Описание:* {escape_markdown_v2(link_info[3])}\n"
-                    text += f"*ID ссылки:* `{link_id}`\n\n"
-                    text += f"*Доступные действия:*"
-                    
-                    await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=sponsor_link_actions_keyboard(link_id))
-                else:
-                    await query.answer("Ссылка не найдена", show_alert=True)
-                return
-            
-            elif data.startswith("admin_transfer_sponsor_"):
-                link_id = data.replace("admin_transfer_sponsor_", "")
-                context.user_data['transferring_sponsor_link'] = link_id
-                await query.edit_message_text(
-                    f"🔄 *Передача спонсорской ссылки*\n\nВведите *ID пользователя*, которому хотите передать ссылку:",
-                    parse_mode='MarkdownV2',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data=f"admin_sponsor_actions_{link_id}")]])
-                )
-                return
-            
-            elif data.startswith("admin_delete_sponsor_"):
-                link_id = data.replace("admin_delete_sponsor_", "")
-                success = delete_link_completely(link_id)
-                
-                if success:
-                    await query.edit_message_text(
-                        "✅ *Спонсорская ссылка успешно удалена\\!*",
-                        parse_mode='MarkdownV2',
-                        reply_markup=sponsor_links_keyboard()
-                    )
-                else:
-                    await query.answer("Ошибка при удалении ссылки", show_alert=True)
-                return
+    if user_links:
+        text = f"🔗 *Ссылки пользователя {user_id}:*\n\n"
+        for link in user_links:
+            created = format_datetime(link[3])
+            text += f"📝 *{escape_markdown_v2(link[1])}*\n📋 {escape_markdown_v2(link[2])}\n🕒 `{created}` \\| 💬 Сообщений\\: {link[4]}\n\n"
 
-            elif data == "admin_html_report":
-                await query.edit_message_text("🔄 *Генерация HTML отчета\\.\\.\\.*", parse_mode='MarkdownV2')
-                
-                html_content = generate_beautiful_html_report()
-                
-                report_path = "/tmp/admin_report.html"
-                with open(report_path, 'w', encoding='utf-8') as f:
-                    f.write(html_content)
-                
-                with open(report_path, 'rb') as f:
-                    await query.message.reply_document(
-                        document=f,
-                        filename=f"admin_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
-                        caption="🎨 *Красивый HTML отчет администратора*",
-                        parse_mode='MarkdownV2'
-                    )
-                
-                await query.edit_message_text("✅ *HTML отчет сгенерирован и отправлен\\!*", parse_mode='MarkdownV2', reply_markup=admin_keyboard())
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("👁️ Посмотреть переписку", callback_data=pack_callback("admin_view_conversation_", user_id))],
+            [InlineKeyboardButton("🔙 Назад", callback_data=pack_callback("admin_user_manage_", user_id))]
+        ])
+
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+    else:
+        await query.edit_message_text("У пользователя нет ссылок\\.", parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
+
+@callback_router.route("admin_view_conversation_", param=int_param, admin=True, invalid="Ошибка: пользователь не найден", code=31)
+async def on_admin_view_conversation(query, context, user_id):
+    await query.edit_message_text("🔄 *Генерация отчета переписки\\.\\.\\.*", parse_mode='MarkdownV2')
+
+    # Генерируем HTML отчет переписки
+    report = await db.read(render_report, iter_conversation_report, user_id)
+
+    with report as f:
+        await query.message.reply_document(
+            document=f,
+            filename=f"conversation_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
+            caption=f"💬 *Переписка пользователя {user_id}*",
+            parse_mode='MarkdownV2'
+        )
+
+    await query.edit_message_text("✅ *Отчет переписки отправлен\\!*", parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query = update.callback_query
+        await query.answer()
+        user = query.from_user
+        data = query.data
+
+        route, raw_value = callback_router.resolve(data)
+        if route is None:
+            logging.warning(f"Неизвестная или устаревшая кнопка: {data}")
+            await query.edit_message_text("⌛️ *Кнопка устарела*\\. Откройте меню заново\\.", reply_markup=main_keyboard(), parse_mode='MarkdownV2')
+            return
+
+        if route.admin:
+            if not (user.username == ADMIN_USERNAME or user.id == ADMIN_ID):
                 return
-            
-            elif data == "admin_broadcast":
-                context.user_data['broadcasting'] = True
-                context.user_data['broadcast_message'] = ""
+            # Проверка аутентификации админа
+            if not admin_session_active(context.user_data):
                 await query.edit_message_text(
-                    "📢 *Режим рассылки*\n\nВведите сообщение для рассылки всем пользователям:",
-                    parse_mode='MarkdownV2', 
-                    reply_markup=broadcast_formatting_keyboard()
+                    "🔐 *Требуется аутентификация*\n\nИспользуйте команду /admin с паролем",
+                    parse_mode='MarkdownV2'
                 )
                 return
-            
-            elif data == "broadcast_send":
-                if context.user_data.get('broadcasting'):
-                    message_text = context.user_data.get('broadcast_message', '')
-                    if not message_text or not message_text.strip():
-                        await query.answer("Сообщение не может быть пустым!", show_alert=True)
-                        return
-                    
-                    context.user_data.pop('broadcasting', None)
-                    context.user_data.pop('broadcast_message', None)
-                    
-                    # Простое форматирование для рассылки
-                    formatted_text = message_text.strip()
-                    
-                    users = get_all_users_for_admin()
-                    success_count = 0
-                    failed_count = 0
-                    
-                    await query.edit_message_text(f"🔄 *Отправка рассылки...*", parse_mode='MarkdownV2')
-                    
-                    for u in users:
-                        try:
-                            await context.bot.send_message(
-                                u[0], 
-                                f"📢 *Оповещение от администратора*\n\n{formatted_text}", 
-                                parse_mode='MarkdownV2'
-                            )
-                            success_count += 1
-                            await asyncio.sleep(0.1)
-                        except Exception as e:
-                            logging.error(f"Ошибка отправки пользователю {u[0]}: {e}")
-                            failed_count += 1
-                    
-                    await query.edit_message_text(
-                        f"✅ *Рассылка завершена\\!*\n\n"
-                        f"• 📨 Успешно отправлено\\: {success_count}\n"
-                        f"• ❌ Не удалось отправить\\: {failed_count}",
-                        parse_mode='MarkdownV2', 
-                        reply_markup=admin_keyboard()
-                    )
-                return
 
-            # Оригинальные обработчики админ-панели
-            elif data.startswith("admin_user_links_"):
-                user_id_str = data.replace("admin_user_links_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    user_links = get_user_links_for_admin(user_id)
-                    
-                    if user_links:
-                        text = f"🔗 *Ссылки пользователя {user_id}:*\n\n"
-                        for link in user_links:
-                            created = format_datetime(link[3])
-                            text += f"📝 *{escape_markdown_v2(link[1])}*\n📋 {escape_markdown_v2(link[2])}\n🕒 `{created}` \\| 💬 Сообщений\\: {link[4]}\n\n"
-                        
-                        keyboard = InlineKeyboardMarkup([
-                            [InlineKeyboardButton("👁️ Посмотреть переписку", callback_data=f"admin_view_conversation_{user_id}")],
-                            [InlineKeyboardButton("🔙 Назад", callback_data=f"admin_user_manage_{user_id}")]
-                        ])
-                        
-                        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
-                    else:
-                        await query.edit_message_text("У пользователя нет ссылок\\.", parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
-                else:
-                    await query.answer("Ошибка: пользователь не найден", show_alert=True)
-                return
-            
-            elif data.startswith("admin_view_conversation_"):
-                user_id_str = data.replace("admin_view_conversation_", "")
-                if user_id_str and user_id_str != "None":
-                    user_id = safe_int(user_id_str)
-                    await query.edit_message_text("🔄 *Генерация отчета переписки\\.\\.\\.*", parse_mode='MarkdownV2')
-                    
-                    # Генерируем HTML отчет переписки
-                    html_content = generate_conversation_report(user_id)
-                    
-                    report_path = f"/tmp/conversation_{user_id}.html"
-                    with open(report_path, 'w', encoding='utf-8') as f:
-                        f.write(html_content)
-                    
-                    with open(report_path, 'rb') as f:
-                        await query.message.reply_document(
-                            document=f,
-                            filename=f"conversation_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
-                            caption=f"💬 *Переписка пользователя {user_id}*",
-                            parse_mode='MarkdownV2'
-                        )
-                    
-                    await query.edit_message_text("✅ *Отчет переписки отправлен\\!*", parse_mode='MarkdownV2', reply_markup=user_management_keyboard(user_id))
-                else:
-                    await query.answer("Ошибка: пользователь не найден", show_alert=True)
+        value = None
+        if route.param:
+            try:
+                value = route.param(raw_value)
+            except (ValueError, TypeError) as e:
+                logging.error(f"Неверный параметр кнопки {data}: {e}")
+                await query.answer(route.invalid, show_alert=True)
                 return
 
+        await route.handler(query, context, value)
+
     except Exception as e:
         logging.error(f"Ошибка в обработчике кнопок: {e}")
         try:
@@ -1396,12 +3851,16 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         
         # Проверяем, не забанен ли пользователь
-        if is_user_banned(user.id):
+        if await check_banned(user.id):
             await update.message.reply_text("❌ Вы заблокированы в этом боте и не можете использовать его функции.")
             return
+
+        if not await allow_incoming_message(update, context):
+            return
         
         text = update.message.text
-        save_user(user.id, user.username, user.first_name)
+        if not user_registry.is_current(user.id, user.username, user.first_name):
+            await db.write(save_user, user.id, user.username, user.first_name)
         is_admin = user.username == ADMIN_USERNAME or user.id == ADMIN_ID
 
         # Удаляем сообщение пользователя
@@ -1413,7 +3872,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Обработка блокировки пользователя
         if context.user_data.get('banning_user'):
             user_id = context.user_data.pop('banning_user')
-            success = ban_user(user_id, text)
+            success = await db.write(ban_user, user_id, text)
             
             if success:
                 # Пытаемся уведомить пользователя о блокировке
@@ -1426,7 +3885,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text(
                     f"✅ *Пользователь {user_id} заблокирован\\!*\n*Причина:* {text}",
                     parse_mode='MarkdownV2',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=f"admin_user_manage_{user_id}")]])
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=pack_callback("admin_user_manage_", user_id))]])
                 )
             else:
                 await update.message.reply_text("❌ Ошибка при блокировке пользователя")
@@ -1445,12 +3904,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 
                 # Сохраняем в историю
-                save_admin_message(user.id, target_user_id, text)
+                await db.write(save_admin_message, user.id, target_user_id, text)
                 
                 await update.message.reply_text(
                     f"✅ *Сообщение отправлено пользователю {target_user_id}\\!*",
                     parse_mode='MarkdownV2',
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=f"admin_user_manage_{target_user_id}")]])
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=pack_callback("admin_user_manage_", target_user_id))]])
                 )
             except Exception as e:
                 logging.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}")
@@ -1465,7 +3924,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             link_id = context.user_data.pop('transferring_sponsor_link')
             try:
                 new_user_id = int(text)
-                success = transfer_sponsor_link(link_id, new_user_id)
+                success = await db.write(transfer_sponsor_link, link_id, new_user_id)
                 
                 if success:
                     await update.message.reply_text(
@@ -1516,7 +3975,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 try:
                     target_user_id = int(text) if text != '0' else None
-                    link_id = create_sponsor_link(user.id, title, description, target_user_id, custom_id)
+                    link_id = await db.write(create_sponsor_link, user.id, title, description, target_user_id, custom_id)
                     
                     if link_id is None:
                         await update.message.reply_text(
@@ -1546,20 +4005,17 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Ответ на сообщение
         if context.user_data.get('replying_to'):
             message_id = context.user_data.pop('replying_to')
-            message_info = get_message_info(message_id)
+            message_info = await db.read(get_message_info, message_id)
             
             if message_info:
                 # Сохраняем ответ
-                save_reply(message_id, user.id, text)
+                await db.write(save_reply, message_id, user.id, text)
                 
                 # Отправляем уведомление получателю (простой текст)
-                msg_text, msg_type, file_name, created, from_user, from_name, to_user, to_name, link_title, link_id = message_info
+                msg_text, msg_type, file_name, created, from_user, from_name, to_user, to_name, link_title, link_id, from_user_id = message_info
                 
-                notification = f"💬 *Новый ответ на ваше сообщение*\n\n{text}"
-                try:
-                    await context.bot.send_message(to_user, notification, parse_mode='MarkdownV2')
-                except Exception as e:
-                    logging.error(f"Failed to send reply notification to {to_user}: {e}")
+                notification = f"💬 *Новый ответ на ваше сообщение*\n\n{escape_markdown_v2(text)}"
+                await outbox.send(from_user_id, 'send_message', text=notification, parse_mode='MarkdownV2')
                 
                 await update.message.reply_text("✅ *Ответ отправлен\\!*", parse_mode='MarkdownV2', reply_markup=main_keyboard())
             return
@@ -1575,7 +4031,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 title = context.user_data.pop('link_title')
                 context.user_data.pop('creating_link')
                 context.user_data.pop('link_stage')
-                link_id = create_anon_link(user.id, title, text)
+                link_id = await db.write(create_anon_link, user.id, title, text)
                 bot_username = context.bot.username
                 link_url = f"https://t.me/{bot_username}?start={link_id}"
                 await update.message.reply_text(
@@ -1588,15 +4044,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Отправка анонимного сообщения
         if context.user_data.get('current_link'):
             link_id = context.user_data.pop('current_link')
-            link_info = get_link_info(link_id)
+            link_info = await db.read(get_link_info, link_id)
             if link_info:
-                msg_id = save_message(link_id, user.id, link_info[1], text)
-                notification = f"📨 *Новое анонимное сообщение*\n\n{text}"
-                try:
-                    await context.bot.send_message(link_info[1], notification, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
-                except Exception as e:
-                    logging.error(f"Failed to send message notification: {e}")
-                    # Если не удалось отправить уведомление, все равно сообщаем пользователю
+                msg_id = await db.write(save_message, link_id, user.id, link_info[1], text)
+                notification = f"📨 *Новое анонимное сообщение*\n\n{escape_markdown_v2(text)}"
+                await outbox.send(link_info[1], 'send_message', text=notification, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
                 
                 await update.message.reply_text("✅ Ваше сообщение отправлено анонимно\\!", reply_markup=main_keyboard(), parse_mode='MarkdownV2')
             return
@@ -1627,11 +4079,15 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         
         # Проверяем, не забанен ли пользователь
-        if is_user_banned(user.id):
+        if await check_banned(user.id):
             await update.message.reply_text("❌ Вы заблокированы в этом боте и не можете использовать его функции.")
             return
+
+        if not await allow_incoming_message(update, context):
+            return
             
-        save_user(user.id, user.username, user.first_name)
+        if not user_registry.is_current(user.id, user.username, user.first_name):
+            await db.write(save_user, user.id, user.username, user.first_name)
         msg = update.message
         caption = msg.caption or ""
         file_id, msg_type, file_size, file_name = None, "unknown", None, None
@@ -1662,9 +4118,9 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if context.user_data.get('current_link') and file_id:
             link_id = context.user_data.pop('current_link')
-            link_info = get_link_info(link_id)
+            link_info = await db.read(get_link_info, link_id)
             if link_info:
-                msg_id = save_message(link_id, user.id, link_info[1], caption, msg_type, file_id, file_size, file_name)
+                msg_id = await db.write(save_message, link_id, user.id, link_info[1], caption, msg_type, file_id, file_size, file_name)
                 
                 file_info = ""
                 if file_size:
@@ -1672,24 +4128,16 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if file_name:
                     file_info += f"\n📄 `{escape_markdown_v2(file_name)}`"
                 
-                user_caption = f"📨 *Новый анонимный {msg_type}*{file_info}\n\n{caption}"
+                user_caption = f"📨 *Новый анонимный {msg_type}*{file_info}\n\n{escape_markdown_v2(caption)}"
                 
-                try:
-                    if msg_type == 'photo': 
-                        await context.bot.send_photo(link_info[1], file_id, caption=user_caption, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
-                    elif msg_type == 'video': 
-                        await context.bot.send_video(link_info[1], file_id, caption=user_caption, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
-                    elif msg_type == 'document': 
-                        await context.bot.send_document(link_info[1], file_id, caption=user_caption, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
-                    elif msg_type == 'voice': 
-                        await context.bot.send_voice(link_info[1], file_id, caption=user_caption, parse_mode='MarkdownV2', reply_markup=message_actions_keyboard(msg_id))
-                    elif msg_type == 'video_note': 
-                        await context.bot.send_video_note(link_info[1], file_id, reply_markup=message_actions_keyboard(msg_id))
-                        if caption:
-                            await context.bot.send_message(link_info[1], f"📝 *Подпись к кружку:*\n\n{caption}", parse_mode='MarkdownV2')
-                except Exception as e: 
-                    logging.error(f"Failed to send media to user: {e}")
-                    # Если не удалось отправить, все равно сообщаем пользователю
+                # Доставка идет через очередь: при сбое Telegram уведомление будет отправлено повторно
+                keyboard = message_actions_keyboard(msg_id)
+                if msg_type == 'video_note':
+                    await outbox.send(link_info[1], 'send_video_note', video_note=file_id, reply_markup=keyboard)
+                    if caption:
+                        await outbox.send(link_info[1], 'send_message', text=f"📝 *Подпись к кружку:*\n\n{escape_markdown_v2(caption)}", parse_mode='MarkdownV2')
+                elif msg_type in ('photo', 'video', 'document', 'voice'):
+                    await outbox.send(link_info[1], f'send_{msg_type}', **{msg_type: file_id}, caption=user_caption, parse_mode='MarkdownV2', reply_markup=keyboard)
                 
                 await update.message.reply_text("✅ Ваше медиа отправлено анонимно\\!", reply_markup=main_keyboard(), parse_mode='MarkdownV2')
 
@@ -1697,11 +4145,24 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.error(f"Ошибка в обработчике медиа: {e}")
         await update.message.reply_text("❌ Произошла ошибка при отправке медиа\\.", parse_mode='MarkdownV2')
 
-def generate_conversation_report(user_id):
-    """Генерирует HTML отчет переписки пользователя"""
-    conversations = get_conversation_for_user(user_id)
-    
-    html_content = f'''
+def render_report(iter_report, *args):
+    """Записывает части HTML отчета во временный файл по мере генерации.
+
+    Возвращает файловый объект, открытый на чтение с начала; закрыть его должен вызывающий код.
+    """
+    report = tempfile.TemporaryFile(mode='w+b')
+    try:
+        for chunk in iter_report(*args):
+            report.write(chunk.encode('utf-8'))
+        report.seek(0)
+    except Exception:
+        report.close()
+        raise
+    return report
+
+def iter_conversation_report(user_id):
+    """Генерирует HTML отчет переписки пользователя по частям"""
+    yield f'''
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -1806,15 +4267,16 @@ def generate_conversation_report(user_id):
             <div class="messages">
     '''
     
-    if conversations:
-        for conv in conversations:
-            if conv[16] == 'message':  # Обычное сообщение
-                media_info = ""
-                if conv[2] and conv[2] != 'text':
-                    file_size = f" ({conv[4] // 1024} KB)" if conv[4] else ""
-                    media_info = f'<div class="media-info">📁 Тип: {conv[2].upper()}{file_size}<br>Файл: {conv[5] or "Без названия"}</div>'
-                
-                html_content += f'''
+    last_message_id = None
+    for conv in iter_conversation_for_user(user_id):
+        if conv[0] != last_message_id:  # Новое сообщение
+            last_message_id = conv[0]
+            media_info = ""
+            if conv[2] and conv[2] != 'text':
+                file_size = f" ({conv[4] // 1024} KB)" if conv[4] else ""
+                media_info = f'<div class="media-info">📁 Тип: {conv[2].upper()}{file_size}<br>Файл: {html.escape(conv[5] or "Без названия")}</div>'
+            
+            yield f'''
                 <div class="message">
                     <div class="message-header">
                         <span>📨 От: {html.escape(conv[7] or conv[8] or 'Аноним')}</span>
@@ -1826,35 +4288,34 @@ def generate_conversation_report(user_id):
                     </div>
                 </div>
                 '''
-            else:  # Ответ
-                html_content += f'''
+        if conv[16] is not None:  # Ответ на сообщение
+            yield f'''
                 <div class="message reply">
                     <div class="message-header">
-                        <span>💬 Ответ от: {html.escape(conv[18] or conv[19] or 'Аноним')}</span>
-                        <span class="timestamp">{format_datetime(conv[6])}</span>
+                        <span>💬 Ответ от: {html.escape(conv[17] or conv[18] or 'Аноним')}</span>
+                        <span class="timestamp">{format_datetime(conv[20])}</span>
                     </div>
                     <div class="message-content">
-                        {html.escape(conv[15])}
+                        {html.escape(conv[15] or '')}
                     </div>
                 </div>
                 '''
-    else:
-        html_content += '<div class="message"><div class="message-content">Нет данных о переписке</div></div>'
+    if last_message_id is None:
+        yield '<div class="message"><div class="message-content">Нет данных о переписке</div></div>'
     
-    html_content += '''
+    yield '''
             </div>
         </div>
     </body>
     </html>
     '''
-    
-    return html_content
 
-def generate_beautiful_html_report():
-    """Генерирует красивый HTML отчет с твоим стилем"""
-    data = get_all_data_for_html()
+def iter_admin_report(provider=None):
+    """Генерирует красивый HTML отчет с твоим стилем по частям"""
+    provider = provider or ReportDataProvider()
+    stats = provider.stats()
     
-    html_content = f'''
+    yield f'''
     <!DOCTYPE html>
     <html lang="ru">
     <head>
@@ -2075,19 +4536,19 @@ def generate_beautiful_html_report():
             <!-- Основная статистика -->
             <div class="stats-grid">
                 <div class="stat-card">
-                    <h3>{data['stats']['users']}</h3>
+                    <h3>{stats['users']}</h3>
                     <p>👥 Всего пользователей</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['banned']}</h3>
+                    <h3>{stats['banned']}</h3>
                     <p>🚫 Заблокированных</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['links']}</h3>
+                    <h3>{stats['links']}</h3>
                     <p>🔗 Активных ссылок</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['sponsor_links']}</h3>
+                    <h3>{stats['sponsor_links']}</h3>
                     <p>🎁 Спонсорских ссылок</p>
                 </div>
             </div>
@@ -2095,23 +4556,23 @@ def generate_beautiful_html_report():
             <!-- Статистика сообщений -->
             <div class="stats-grid">
                 <div class="stat-card">
-                    <h3>{data['stats']['messages']}</h3>
+                    <h3>{stats['messages']}</h3>
                     <p>📨 Всего сообщений</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['replies']}</h3>
+                    <h3>{stats['replies']}</h3>
                     <p>💬 Ответов</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['photos']}</h3>
+                    <h3>{stats['photos']}</h3>
                     <p>🖼️ Фотографий</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['videos']}</h3>
+                    <h3>{stats['videos']}</h3>
                     <p>🎥 Видео</p>
                 </div>
                 <div class="stat-card">
-                    <h3>{data['stats']['video_note']}</h3>
+                    <h3>{stats['video_note']}</h3>
                     <p>⭕️ Кружков</p>
                 </div>
             </div>
@@ -2132,10 +4593,10 @@ def generate_beautiful_html_report():
                     <tbody>
     '''
     
-    for user in data['users'][:20]:
+    for user in provider.users():
         username_display = f"@{user[1]}" if user[1] else (html.escape(user[2]) if user[2] else f"ID:{user[0]}")
         status = f'<span class="user-banned">🚫 ЗАБЛОКИРОВАН</span>' if user[4] else f'<span class="user-active">✅ АКТИВЕН</span>'
-        html_content += f'''
+        yield f'''
                         <tr>
                             <td><strong>{user[0]}</strong></td>
                             <td>{username_display}</td>
@@ -2145,7 +4606,7 @@ def generate_beautiful_html_report():
                         </tr>
         '''
     
-    html_content += '''
+    yield '''
                     </tbody>
                 </table>
             </div>
@@ -2167,21 +4628,21 @@ def generate_beautiful_html_report():
                     <tbody>
     '''
     
-    for link in data['links'][:25]:
-        owner = f"@{link[6]}" if link[6] else (html.escape(link[7]) if link[7] else f"ID:{link[8]}")
-        link_type = "🎁 СПОНСОР" if link[5] else "🔗 ОБЫЧНАЯ"
-        html_content += f'''
+    for link in provider.links():
+        owner = f"@{link[4]}" if link[4] else (html.escape(link[5]) if link[5] else f"ID:{link[6]}")
+        link_type = "🎁 СПОНСОР" if link[3] else "🔗 ОБЫЧНАЯ"
+        yield f'''
                         <tr>
                             <td><code>{link[0]}</code></td>
                             <td>{html.escape(link[1])}</td>
                             <td>{owner}</td>
                             <td>{link_type}</td>
-                            <td>{link[9]} сообщ.</td>
-                            <td>{link[3].split()[0] if isinstance(link[3], str) else link[3].strftime("%Y-%m-%d")}</td>
+                            <td>{link[7]} сообщ.</td>
+                            <td>{link[2].split()[0] if isinstance(link[2], str) else link[2].strftime("%Y-%m-%d")}</td>
                         </tr>
         '''
     
-    html_content += '''
+    yield '''
                     </tbody>
                 </table>
             </div>
@@ -2203,7 +4664,7 @@ def generate_beautiful_html_report():
                     <tbody>
     '''
     
-    for msg in data['recent_messages'][:15]:
+    for msg in provider.recent_messages():
         msg_type_icon = {
             "text": "📝",
             "photo": "🖼️", 
@@ -2211,27 +4672,65 @@ def generate_beautiful_html_report():
             "document": "📄",
             "voice": "🎤",
             "video_note": "⭕️"
-        }.get(msg[2], "📄")
+        }.get(msg[1], "📄")
         
-        from_user = f"@{msg[6]}" if msg[6] else (html.escape(msg[7]) if msg[7] else f"ID:{msg[8]}")
-        to_user = f"@{msg[9]}" if msg[9] else (html.escape(msg[10]) if msg[10] else f"ID:{msg[11]}")
+        from_user = f"@{msg[3]}" if msg[3] else (html.escape(msg[4]) if msg[4] else f"ID:{msg[5]}")
+        to_user = f"@{msg[6]}" if msg[6] else (html.escape(msg[7]) if msg[7] else f"ID:{msg[8]}")
         
-        html_content += f'''
+        yield f'''
                         <tr>
                             <td>#{msg[0]}</td>
                             <td>{msg_type_icon}</td>
                             <td>{from_user}</td>
                             <td>{to_user}</td>
-                            <td>{html.escape(msg[12])}</td>
-                            <td>{msg[5].split()[0] if isinstance(msg[5], str) else msg[5].strftime("%Y-%m-%d")}</td>
+                            <td>{html.escape(msg[9] or "")}</td>
+                            <td>{msg[2].split()[0] if isinstance(msg[2], str) else msg[2].strftime("%Y-%m-%d")}</td>
                         </tr>
         '''
     
-    html_content += '''
+    yield '''
                     </tbody>
                 </table>
             </div>
-            
+    '''
+    
+    if provider.include_conversations:
+        yield '''
+            <!-- Диалоги -->
+            <div class="section">
+                <h2>💬 АКТИВНЫЕ ДИАЛОГИ</h2>
+                <table>
+                    <thead>
+                        <tr>
+                            <th>ID Ссылки</th>
+                            <th>Название</th>
+                            <th>Владелец</th>
+                            <th>Сообщения</th>
+                            <th>Последняя активность</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+        '''
+        
+        for conv in provider.conversations():
+            owner = f"@{conv[2]}" if conv[2] else (html.escape(conv[3]) if conv[3] else f"ID:{conv[4]}")
+            yield f'''
+                        <tr>
+                            <td><code>{conv[0]}</code></td>
+                            <td>{html.escape(conv[1])}</td>
+                            <td>{owner}</td>
+                            <td>{conv[5]} сообщ.</td>
+                            <td>{conv[6] or "—"}</td>
+                        </tr>
+            '''
+        
+        yield '''
+                    </tbody>
+                </table>
+            </div>
+        '''
+    
+    yield '''
             <!-- Футер -->
             <div class="footer">
                 <div class="footer-text">
@@ -2242,8 +4741,55 @@ def generate_beautiful_html_report():
     </body>
     </html>
     '''
-    
-    return html_content
+
+async def on_startup(application: Application):
+    """Возобновляет фоновые задачи, сохраненные до перезапуска."""
+    outbox.start(application.bot)
+    await resume_broadcast_jobs(application)
+    startup_timings['total'] = time.monotonic() - process_started
+    logging.info(f"Бот готов к работе: {format_startup_timings()}")
+
+async def on_stop(application: Application):
+    """Приостанавливает фоновые задачи, пока бот еще может обращаться к Telegram."""
+    await stop_broadcasts()
+    await outbox.stop()
+
+async def on_shutdown(application: Application):
+    """Дожидается записи в БД и отправляет накопленные изменения перед завершением работы."""
+    await asyncio.to_thread(db.shutdown)
+    await asyncio.to_thread(persistence.stop)
+
+def run_application(application: Application):
+    """Запускает получение обновлений: вебхук, если задан WEBHOOK_URL, иначе long polling."""
+    if not WEBHOOK_URL:
+        logging.info("Режим получения обновлений: polling")
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+            pool_timeout=20,
+            read_timeout=20,
+            connect_timeout=20
+        )
+        return
+
+    secret_token = WEBHOOK_SECRET
+    if not secret_token:
+        # Без секрета любой, кто знает адрес, мог бы присылать поддельные обновления
+        secret_token = secrets.token_urlsafe(32)
+        logging.warning("WEBHOOK_SECRET не задан, используется случайный секрет до перезапуска")
+
+    url_path = WEBHOOK_PATH.strip("/")
+    logging.info(f"Режим получения обновлений: webhook {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path}")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=url_path,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+        secret_token=secret_token,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+    )
 
 def main():
     if not all([BOT_TOKEN, ADMIN_ID]):
@@ -2253,12 +4799,44 @@ def main():
     # Инициализация репозитория и БД
     try:
         setup_repo()
-        init_db()
+        if changelog is not None:
+            with startup_phase('replay'):
+                changelog.restore(DB_PATH)
+    except Exception as e:
+        # Снимок поврежден: запуск на пустой БД потерял бы данные, поэтому останавливаемся
+        logging.critical(f"Не удалось восстановить БД, запуск остановлен: {e}")
+        return
+    
+    try:
+        with startup_phase('init_db'):
+            init_db()
+        if changelog is not None:
+            changelog.ensure_snapshot()
     except Exception as e:
         logging.error(f"Ошибка при инициализации: {e}")
     
+    try:
+        check_query_plans()
+    except QueryPlanError as e:
+        # Бот работает и без индекса, но медленнее; в CI это ловит python anon.py --check-query-plans
+        logging.error(str(e))
+    
+    persistence.start()
+    
     # Создание приложения
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(update_processor)
+        .persistence(SQLitePersistence())
+    )
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip('/')
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    application = builder.build()
     
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start))
@@ -2275,15 +4853,22 @@ def main():
     
     try:
         # Запуск бота
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True,
-            pool_timeout=20,
-            read_timeout=20,
-            connect_timeout=20
-        )
+        run_application(application)
     except Exception as e:
         logging.critical(f"Критическая ошибка при запуске бота: {e}")
 
+def check_query_plans_main():
+    """Проверка планов без запуска бота: python anon.py --check-query-plans, код выхода 1 при регрессии."""
+    init_db()
+    try:
+        check_query_plans()
+    except QueryPlanError as e:
+        logging.critical(str(e))
+        return 1
+    logging.info(f"Планы горячих запросов в порядке: {len(HOT_QUERIES)} запросов используют индексы")
+    return 0
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--check-query-plans"]:
+        sys.exit(check_query_plans_main())
     main()
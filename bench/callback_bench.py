@@ -0,0 +1,73 @@
+"""Замер стоимости маршрутизации callback_data кнопок через callback_router.
+
+Для каждого зарегистрированного маршрута строится кнопка того вида, который
+выдает бот: точная строка или компактная подписанная кнопка с параметром.
+Замеряется resolve() вместе с разбором параметра — то, что button_handler
+делает до вызова обработчика.
+
+    python bench/callback_bench.py [-n 200000] [--legacy]
+
+--legacy дополнительно замеряет старые неподписанные кнопки <префикс>_<параметр>
+в переходный период (разбор по границам '_').
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import anon  # noqa: E402
+
+SAMPLE_VALUES = {
+    anon.int_param: 123456789,
+    anon.str_param: "AbC12xYz",
+    anon.parse_page_param: "n_2025-01-01 10:00:00_55",
+}
+
+
+def build_samples(router, legacy):
+    samples = list(router._exact)
+    for pattern, route in router._prefixes.items():
+        value = SAMPLE_VALUES[route.param]
+        samples.append(f"{pattern}{value}" if legacy else router.encode(pattern, value))
+    return samples
+
+
+def dispatch(router, samples):
+    for data in samples:
+        route, raw = router.resolve(data)
+        if route.param is not None:
+            route.param(raw)
+
+
+def measure(router, samples, n):
+    rounds = max(1, n // len(samples))
+    for data in samples:
+        if router.resolve(data)[0] is None:
+            raise SystemExit(f"Кнопка не разобралась: {data!r}")
+    elapsed = timeit.timeit(lambda: dispatch(router, samples), number=rounds)
+    return elapsed / (rounds * len(samples)) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=200000, help="число разборов")
+    parser.add_argument("--legacy", action="store_true", help="замерить и старые неподписанные кнопки")
+    args = parser.parse_args()
+
+    router = anon.callback_router
+    samples = build_samples(router, legacy=False)
+    print(f"{len(router._exact)} exact + {len(router._prefixes)} prefix routes: "
+          f"{measure(router, samples, args.n):.0f} ns/callback")
+
+    if args.legacy:
+        router.legacy_until = time.time() + 3600
+        samples = [data for data in build_samples(router, legacy=True)
+                   if data in router._exact or router.resolve(data)[0] is not None]
+        print(f"legacy unsigned buttons ({len(samples)}): {measure(router, samples, args.n):.0f} ns/callback")
+
+
+if __name__ == "__main__":
+    main()
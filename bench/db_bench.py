@@ -0,0 +1,72 @@
+"""Замер стоимости обращений к БД на горячем пути входящего сообщения.
+
+Повторяет то, что handle_text делает с БД на одно анонимное сообщение:
+is_user_banned, save_user, get_link_info, save_message. БД создается во
+временном каталоге, рабочая /tmp/repo не затрагивается.
+
+    python bench/db_bench.py [-n 2000] [--connect-per-query]
+
+--connect-per-query открывает соединение на каждый запрос, как run_query
+до пула соединений, — для сравнения с текущим ConnectionPool.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import anon  # noqa: E402
+
+
+class ConnectPerQuery:
+    """Пул-заглушка: новое соединение на каждый запрос."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def connection(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def close_all(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=2000, help="число сообщений")
+    parser.add_argument("--connect-per-query", action="store_true", help="без пула соединений")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "bench.db")
+        anon.DB_PATH = path
+        anon.db_pool = anon.ConnectionPool(path)
+        anon.init_db()
+        if args.connect_per_query:
+            anon.db_pool = ConnectPerQuery(path)
+
+        anon.save_user(1, "owner", "Owner")
+        link_id = anon.create_anon_link(1, "bench", "bench")
+
+        started = time.perf_counter()
+        for i in range(args.n):
+            anon.is_user_banned(2)
+            anon.save_user(2, "sender", "Sender")
+            info = anon.get_link_info(link_id)
+            anon.save_message(link_id, 2, info[1], f"message {i}")
+        elapsed = time.perf_counter() - started
+
+        mode = "connect per query" if args.connect_per_query else "connection pool"
+        print(f"{mode}: {args.n} messages, {elapsed * 1000 / args.n:.3f} ms/message")
+    finally:
+        anon.db_pool.close_all()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()